@@ -0,0 +1,58 @@
+"""Addressing one of several capture devices
+
+Any route can be called under /devices/{device_id} (for example
+/devices/hdmi2/screenshot). The prefix is removed before routing, and the
+hardware RPCs made while handling the request go to that device
+("hdmi2.screenshot", see hardware/dispatcher.py).
+"""
+
+import contextvars
+import re
+
+# device of the request being handled (None: the main device)
+current_device = contextvars.ContextVar("current_device", default=None)
+
+DEVICE_PATH = re.compile(r"/devices/([A-Za-z0-9_-]+)(/.*)")
+
+
+def device_method(method: str) -> str:
+    """Gets the RPC name of a method of the current device"""
+    device_id = current_device.get()
+    return method if device_id is None else f"{device_id}.{method}"
+
+
+class DeviceProxy:
+    """Wraps an xmlrpc.client.ServerProxy, calling the current device's
+    methods (system.* methods are not prefixed)"""
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+
+    def __getattr__(self, name: str):
+        if name == "system":
+            return getattr(self._proxy, name)
+        return getattr(self._proxy, device_method(name))
+
+
+class DevicePrefixMiddleware:
+    """ASGI middleware setting current_device from a /devices/{device_id}
+    path prefix"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        match = None
+        if scope["type"] in ["http", "websocket"]:
+            match = DEVICE_PATH.fullmatch(scope["path"])
+        if match is None:
+            await self.app(scope, receive, send)
+            return
+
+        device_id, path = match.groups()
+        scope = dict(scope, path=path, raw_path=path.encode("utf-8"))
+        token = current_device.set(device_id)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_device.reset(token)
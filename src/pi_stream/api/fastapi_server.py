@@ -1,17 +1,34 @@
 """FastAPI Server for WebRTC Stream"""
 
+import asyncio
+import base64
 import io
+import json
 import os
+import re
 import time
 import xmlrpc.client
+import zipfile
 
-from pydantic import BaseModel, BaseSettings
+from typing import List
+
+from pydantic import BaseSettings
 from fastapi import FastAPI, BackgroundTasks, Request
-from fastapi.responses import StreamingResponse
+from fastapi import WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from loguru import logger
 import uvicorn
 
+from devices import DeviceProxy, DevicePrefixMiddleware, current_device
+from devices import device_method
+from latency import LatencyStats, stage_timings, timing_headers
+from models import BatchCall, FastScreenshotFormat, RecordingFormat
+from models import TimelapseFormat, VideoFormat
+from tracing import RequestTrace, TraceMiddleware, TracingTransport
+
 
 class Settings(BaseSettings):
     """Environment Variables"""
@@ -22,37 +39,80 @@ class Settings(BaseSettings):
     recording_files_dir: str = "/home/pi/recordings"
     verbose: bool = False
 
+    # seconds a pushed status snapshot is trusted without an RPC
+    status_max_age: float = 30.0
 
-class VideoFormat(BaseModel):
-    """v4l2-ctl video format"""
-    width: int
-    height: int
-    pixelformat: str
-    fps: int
-
-
-class RecordingFormat(BaseModel):
-    width: int
-    height: int
-    pixelformat: str
-    fps: int
-    length: int
+    # tracing (see tracing.py)
+    trace_slow_ms: float = 1000.0  # responses at least this slow are kept
+    trace_sample_rate: float = 0.0  # fraction of other requests kept
 
 
-class FastScreenshotFormat(BaseModel):
-    """fast screenshot format"""
-    inp_fmt: str = "png"  # "jpg" OR "png"
-    out_fmt: str = "png"  # "jpg" OR "png"
-    width: int = 1920
-    height: int = 1080
+# screenshot output formats: media type, file extension
+OUTPUT_FORMATS = {
+    "jpg": ("image/jpeg", "jpg"),
+    "png": ("image/png", "png"),
+    "raw": ("application/octet-stream", "raw"),  # see hardware/raw.py
+    "native": ("application/octet-stream", "raw")
+}
 
 
 # Create objects and connect to xmlrpc server
 settings = Settings()
-xc = xmlrpc.client.ServerProxy(settings.xmlrpc_addr,
-                               use_builtin_types=True,
-                               allow_none=True)
+
+
+def hardware_proxy() -> DeviceProxy:
+    """Creates an XMLRPC proxy calling the request's device (see
+    devices.py)"""
+    transport = TracingTransport(use_builtin_types=True)
+    return DeviceProxy(xmlrpc.client.ServerProxy(settings.xmlrpc_addr,
+                                                 transport=transport,
+                                                 allow_none=True))
+
+
+async def keep_trace(trace: RequestTrace):
+    """Hands a slow or sampled request's spans to the hardware service,
+    which holds them with its own (see /traces)"""
+    proxy = hardware_proxy()
+    try:
+        await run_in_threadpool(proxy.trace_keep, trace.trace_id,
+                                trace.finished_spans())
+    except (OSError, xmlrpc.client.Error) as exc:
+        logger.debug(f"trace {trace.trace_id} not kept: {exc}")
+
+
+xc = hardware_proxy()
 app = FastAPI()
+app.add_middleware(DevicePrefixMiddleware)  # /devices/{device_id}/...
+app.add_middleware(TraceMiddleware, keep=keep_trace,
+                   slow_ms=settings.trace_slow_ms,
+                   sample_rate=settings.trace_sample_rate,
+                   exclude=("/traces", "/static", "/recordings",
+                            "/internal"))
+latency_stats = LatencyStats()  # screenshot timings (see /latency)
+
+
+async def connect_hardware(initial_delay: float = 0.05,
+                           max_delay: float = 2.0):
+    """Waits for the hardware XMLRPC server, with exponential backoff.
+
+    Runs in the background so the API (and frontend) is served before the
+    hardware server is up; routes return 503 until then"""
+    # own proxy, ServerProxy connections are not thread safe
+    proxy = xmlrpc.client.ServerProxy(settings.xmlrpc_addr, allow_none=True)
+    start = time.perf_counter()
+    delay = initial_delay
+    while True:
+        try:
+            methods = await run_in_threadpool(proxy.system.listMethods)
+            break
+        except OSError:
+            logger.debug(f"xmlrpc: {settings.xmlrpc_addr} not ready, "
+                         f"retrying in {delay:.2f} s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+    logger.success(f"xmlrpc: connected to {settings.xmlrpc_addr} "
+                   f"({len(methods)} methods) after "
+                   f"{(time.perf_counter() - start) * 1000:.0f} ms")
 
 
 @app.on_event("startup")
@@ -61,6 +121,22 @@ async def startup():
     logger.success("Starting API")
     if settings.verbose:
         logger.debug("Using verbose mode")
+    app.state.connect_task = asyncio.create_task(connect_hardware())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """FastAPI shutdown"""
+    app.state.connect_task.cancel()
+
+
+@app.exception_handler(ConnectionRefusedError)
+async def hardware_unavailable(request: Request, exc: ConnectionRefusedError):
+    """The hardware server is not (yet) running"""
+    return JSONResponse(status_code=503, content={
+        "success": False,
+        "error": f"hardware server {settings.xmlrpc_addr} unavailable"
+    })
 
 # Static Files
 try:
@@ -95,6 +171,8 @@ async def start_janus():
 @app.post("/janus/stop")
 async def stop_janus():
     """Stops a Janus WebRTC server that was started with /janus/start\n
+    Escalates from SIGINT to SIGTERM to SIGKILL if Janus does not exit,
+    so this always returns within a bounded time\n
     If returns success but behavior is not as expected:\n
     1. Force-stop WebRTC (using the appropriate API call) instead"""
     return xc.stop_janus()
@@ -102,13 +180,15 @@ async def stop_janus():
 
 @app.post("/janus/force_stop")
 async def force_stop_janus():
-    """Runs pkill with SIGINT on any Janus process on the machine"""
+    """Sends SIGINT (then SIGTERM, then SIGKILL) to any Janus process on
+    the machine started with this device's arguments (config)"""
     return xc.force_stop_janus()
 
 
 @app.post("/janus/force_exists")
 async def force_exists_webrtc():
-    """Runs pgrep, looking for any Janus process on the device"""
+    """Looks for any Janus process on the device, reporting the pid,
+    CPU and memory usage of each one"""
     return xc.force_exists_janus()
 
 
@@ -133,19 +213,65 @@ async def stop_audio():
 
 @app.post("/audio/force_stop")
 async def force_stop_audio():
-    """Runs pkill with SIGINT on any gstreamer process on the device"""
+    """Sends SIGINT (then SIGTERM, then SIGKILL) to any gstreamer process on
+    the machine running this device's pipeline"""
     return xc.force_stop_gstreamer()
 
 
 @app.post("/audio/force_exists")
 async def force_exists_audio():
-    """Runs pgrep, looking for any Janus process on the device"""
+    """Looks for any gstreamer process on the device, reporting the pid,
+    CPU and memory usage of each one"""
     return xc.force_exists_gstreamer()
 
 
+@app.post("/audio/profile/set/{profile}")
+async def set_audio_profile(profile: str):
+    """Changes the audio pipeline profile, restarting gstreamer if it is
+    running\n
+    profiles:\n
+        default: gstreamer defaults, 48 kbits/s\n
+        low-latency: small ALSA buffers, 10 ms low-delay Opus frames\n
+        high-quality: 128 kbits/s\n
+        low-bandwidth: 16 kbits/s speech, 60 ms frames"""
+    return xc.set_audio_profile(profile)
+
+
+@app.post("/audio/profile")
+async def get_audio_profile():
+    """Gets the audio profile, the available profiles and the pipeline
+    latency measured with each one (requires AUDIO_LATENCY_TRACE=1)"""
+    return xc.get_audio_profile()
+
+
+@app.get("/audio/clip")
+async def audio_clip(seconds: float = 10.0):
+    """Gets the most recent audio as Ogg/Opus (no WebRTC session needed)\n
+    params:\n
+        seconds (float, optional): clip length, at most AUDIO_RING_SECONDS
+        (default: 10)"""
+    result = xc.audio_clip(seconds)
+    if not result["success"]:
+        return result
+
+    response = Response(result["data"], media_type="audio/ogg")
+    response.headers["Content-Disposition"] = "inline; filename=clip.opus"
+    response.headers["X-Duration"] = f"{result['duration']:.3f}"
+    return response
+
+
+@app.post("/audio/level")
+async def get_audio_level():
+    """Gets the current audio RMS and peak levels (dBFS per channel), and
+    whether (and for how long) the source has been silent"""
+    return xc.get_audio_level()
+
+
 @app.post("/set_format")
 async def set_format(vfmt: VideoFormat):
-    """Stops janus and sets the V4L2 video format\n
+    """Sets the V4L2 video format, restarting janus if it was running\n
+    The format is validated against the device capabilities first, and
+    unchanged settings are skipped. timings reports each step (seconds)\n
     body:\n
         width (int): video resolution width (example: 1920)\n
         height (int): video resolution height (example: 1080)\n
@@ -164,41 +290,78 @@ async def get_format():
     return xc.get_format()
 
 
+@app.post("/get_capabilities")
+async def get_capabilities(refresh: bool = False):
+    """Gets the formats supported by the capture device
+    (cached after the first call)\n
+    params:\n
+        refresh (bool, optional): query the device again (default: false)"""
+    return xc.get_capabilities(refresh)
+
+
 @app.get("/screenshot")
 async def screenshot(tasks: BackgroundTasks,
                      process: str = "cv2",
                      inp_fmt: str = "png", out_fmt: str = "png",
-                     width: int = 1920, height: int = 1080):
+                     width: int = 1920, height: int = 1080,
+                     compression: str = "",
+                     priority: int = None, deadline: float = None):
     """Stops WebRTC service (if it is on), takes and returns a screenshot,
     resets the USB, then restarts WebRTC service\n
+    Simultaneous identical requests share one capture\n
     (see docs/screenshot.md)\n
     params:\n
         process (str, optional): ffmpeg OR cv2 (default: cv2)\n
         inp_fmt (str, optional): input format jpg or png (default: png)\n
-        out_fmt (str, optional): output format jpg or png (default: png)\n
+        out_fmt (str, optional): output format jpg, png, raw or native
+        (default: png)\n
         width (int, optional): resolution width (default: 1920)\n
-        height (int, optional): resolution height (default: 1080)"""
+        height (int, optional): resolution height (default: 1080)\n
+        compression (str, optional): raw/native frames: lz4
+        (default: none)\n
+        priority (int, optional): queue priority, 0 high, 1 normal, 2 low
+        (default: 1)\n
+        deadline (float, optional): seconds; fails with DEADLINE_EXCEEDED
+        instead of queueing when the screenshot could not be done in time"""
 
     # stop janus if it is running
     # xc.stop_janus()
 
     # attempt to take the screenshot
-    result = xc.screenshot(process, inp_fmt, out_fmt, width, height)
+    # (own proxy, the request waits while other operations run)
+    proxy = hardware_proxy()
+    params = [process, inp_fmt, out_fmt, width, height, compression]
+    if priority is None and deadline is None:
+        result = await run_in_threadpool(proxy.screenshot, *params)
+    else:
+        result = await run_in_threadpool(proxy.schedule, "screenshot",
+                                         params, priority, deadline)
+    received = time.monotonic()
 
     # return immediately if not successful
     if not result["success"]:
         return result
 
-    # reset USB in the background
+    # reset USB in the background, unless the capture is kept warm (the
+    # hardware service resets it when it releases the capture), then
+    # restart janus if it was stopped by a previous (warm) screenshot
     # Note: resolution reverts to 1920x1080
-    # tasks.add_task(reset_usb_and_start_janus)
-    tasks.add_task(xc.reset_usb)  # Note: resolution reverts to 1920x1080
+    if result.get("restart_janus"):
+        tasks.add_task(reset_usb_and_start_janus)
+    elif not result.get("warm"):
+        tasks.add_task(xc.reset_usb)  # Note: resolution reverts to 1920x1080
 
     # prepare response
-    mime_type = "image/{}".format({"jpg": "jpeg", "png": "png"}[out_fmt])
-    content = io.BytyesIO(result["data"])
+    mime_type, extension = OUTPUT_FORMATS[out_fmt]
+    content = io.BytesIO(result["data"])
     response = StreamingResponse(content, media_type=mime_type)
-    response.headers["Content-Disposition"] = f"inline; filename=ss.{out_fmt}"
+    disposition = f"inline; filename=ss.{extension}"
+    response.headers["Content-Disposition"] = disposition
+
+    timings = stage_timings(result, received)
+    latency_stats.record(
+        "screenshot_warm" if result.get("reused") else "screenshot", timings)
+    response.headers.update(timing_headers(timings))
 
     return response
 
@@ -211,13 +374,47 @@ async def fast_screenshot_mode_start(sfmt: FastScreenshotFormat):
     (see docs/screenshot.md)\n
     body:\n
         inp_fmt (str, optional): input format jpg or png (default: png)\n
-        out_fmt (str, optional): output format jpg or png (default: png)\n
+        out_fmt (str, optional): output format jpg, png, raw or native
+        (default: png)\n
         width (int, optional): resolution width (default: 1920)\n
-        height (int, optional): resolution height (default: 1080)"""
+        height (int, optional): resolution height (default: 1080)\n
+        compression (str, optional): raw/native frames: lz4
+        (default: none)"""
     return xc.fast_screenshot_mode_start(sfmt.inp_fmt,
                                          sfmt.out_fmt,
                                          sfmt.width,
-                                         sfmt.height)
+                                         sfmt.height,
+                                         sfmt.compression)
+
+
+@app.get("/fast_screenshot/burst")
+async def fast_screenshot_burst(count: int = 10, interval: float = 0.0):
+    """Captures a sequence of frames while in fast screenshot mode and
+    returns them as a zip (frames plus timestamps.json)\n
+    (see docs/screenshot.md)\n
+    params:\n
+        count (int, optional): number of frames (default: 10)\n
+        interval (float, optional): minimum seconds between frames
+        (default: 0, every frame)"""
+    # own proxy, ServerProxy connections are not thread safe
+    proxy = hardware_proxy()
+    result = await run_in_threadpool(proxy.fast_screenshot_burst, count,
+                                     interval)
+    if not result["success"]:
+        return result
+
+    extension = OUTPUT_FORMATS[result["format"]][1]
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w", zipfile.ZIP_STORED) as archive:
+        for i, data in enumerate(result["data"]):
+            archive.writestr(f"{i:04d}.{extension}", data)
+        archive.writestr("timestamps.json", json.dumps(result["timestamps"]))
+    content.seek(0)
+
+    response = StreamingResponse(content, media_type="application/zip")
+    response.headers["Content-Disposition"] = "attachment; filename=burst.zip"
+    response.headers["X-Frame-Count"] = str(len(result["data"]))
+    return response
 
 
 @app.post("/fast_screenshot/stop")
@@ -239,15 +436,19 @@ async def fast_screenshot():
     Should be quicker than the normal screenshot method\n
     (see docs/screenshot.md)"""
     result = xc.fast_screenshot()
+    received = time.monotonic()
 
     if result["success"]:
-        out_fmt = result["format"]
-
-        mime_type = "image/{}".format({"jpg": "jpeg", "png": "png"}[out_fmt])
+        mime_type, extension = OUTPUT_FORMATS[result["format"]]
         content = io.BytesIO(result["data"])
         response = StreamingResponse(content, media_type=mime_type)
-        disposition = f"inline; filename=ss.{out_fmt}"
+        disposition = f"inline; filename=ss.{extension}"
         response.headers["Content-Disposition"] = disposition
+        response.headers["X-Sequence"] = str(result["sequence"])
+
+        timings = stage_timings(result, received)
+        latency_stats.record("fast_screenshot", timings)
+        response.headers.update(timing_headers(timings))
 
         if result:
             return response
@@ -255,6 +456,98 @@ async def fast_screenshot():
     return result
 
 
+@app.get("/fast_screenshot/wait_change")
+async def fast_screenshot_wait_change(sequence: int = None,
+                                      threshold: float = 0.01,
+                                      x: int = 0, y: int = 0,
+                                      width: int = 0, height: int = 0,
+                                      timeout: float = 10.0):
+    """Waits (while in fast screenshot mode) until the screen changes,
+    then returns the changed frame\n
+    X-Sequence is the changed frame's number (pass it as sequence to wait
+    for the next change), X-Change-Box its x,y,width,height\n
+    (see docs/screenshot.md)\n
+    params:\n
+        sequence (int, optional): reference frame, from X-Sequence
+        (default: the frame at call time)\n
+        threshold (float, optional): fraction of pixels that must change
+        (default: 0.01)\n
+        x, y, width, height (int, optional): region to watch
+        (default: whole frame)\n
+        timeout (float, optional): seconds to wait (default: 10)"""
+    roi = [x, y, width, height] if width and height else None
+
+    # own proxy, ServerProxy connections are not thread safe
+    proxy = hardware_proxy()
+    result = await run_in_threadpool(proxy.fast_screenshot_wait_change,
+                                     sequence, threshold, roi, timeout)
+    if not result["success"] or not result["changed"]:
+        return result
+
+    mime_type, extension = OUTPUT_FORMATS[result["format"]]
+    response = Response(result["data"], media_type=mime_type)
+    disposition = f"inline; filename=ss.{extension}"
+    response.headers["Content-Disposition"] = disposition
+    response.headers["X-Sequence"] = str(result["sequence"])
+    response.headers["X-Change-Box"] = ",".join(map(str, result["box"]))
+    response.headers["X-Changed-Fraction"] = f"{result['fraction']:.4f}"
+    return response
+
+
+@app.post("/templates/upload/{name}")
+async def template_upload(name: str, request: Request):
+    """Uploads a template image (png or jpg request body) to find in
+    frames while in fast screenshot mode\n
+    (see docs/screenshot.md)"""
+    return xc.template_upload(name, await request.body())
+
+
+@app.post("/templates/delete/{name}")
+async def template_delete(name: str):
+    """Removes an uploaded template"""
+    return xc.template_delete(name)
+
+
+@app.post("/templates/list")
+async def template_list():
+    """Gets the uploaded templates (name, width, height)"""
+    return xc.template_list()
+
+
+@app.get("/templates/match/{name}")
+async def template_match(name: str,
+                         threshold: float = 0.8,
+                         x: int = 0, y: int = 0,
+                         width: int = 0, height: int = 0,
+                         level: int = 1,
+                         timeout: float = 0.0):
+    """Finds an uploaded template in the captured frame (fast screenshot
+    mode), optionally waiting until it matches\n
+    (see docs/screenshot.md)\n
+    params:\n
+        threshold (float, optional): minimum score, -1 to 1 (default: 0.8)\n
+        x, y, width, height (int, optional): region to search
+        (default: whole frame)\n
+        level (int, optional): 0 full, 1 half, 2 quarter resolution
+        (default: 1)\n
+        timeout (float, optional): seconds to wait for a match
+        (default: 0, match once)"""
+    region = [x, y, width, height] if width and height else None
+
+    # own proxy, ServerProxy connections are not thread safe
+    proxy = hardware_proxy()
+    return await run_in_threadpool(proxy.template_match, name, threshold,
+                                   region, level, timeout)
+
+
+@app.post("/latency")
+async def latency():
+    """Gets histograms (ms) of how long each stage of serving screenshots
+    took: capture to the hardware returning the frame (capture_age),
+    encoding (encode), the RPC (rpc) and capture to sending (age)"""
+    return latency_stats.summary()
+
+
 @app.post("/recording/start")
 async def recording_start(rfmt: RecordingFormat):
     """Stops janus and starts a recording\n
@@ -280,6 +573,47 @@ async def recording_stop():
     return xc.recording_stop()
 
 
+@app.post("/recording/status")
+async def recording_status():
+    """Gets live statistics of the current recording from ffmpeg's progress
+    output (fps, speed, dup/drop frame counts, bitrate, output size)\n
+    stats.alerts contains BEHIND_REALTIME while speed is below 1.0x
+    and DROPPED_FRAMES once ffmpeg has dropped a frame"""
+    return xc.recording_status()
+
+
+@app.post("/timelapse/start")
+async def timelapse_start(tfmt: TimelapseFormat):
+    """Stops janus and captures a frame every interval seconds into an
+    MJPEG AVI file, listed with the recordings\n
+    (see docs/timelapse.md)\n
+    body:\n
+        interval (float, optional): seconds between frames (default: 5)\n
+        width (int, optional): resolution width (default: 1920)\n
+        height (int, optional): resolution height (default: 1080)\n
+        inp_fmt (str, optional): jpg (MJPEG) or png (YUYV) (default: jpg)\n
+        length (float, optional): seconds, 0 until stopped (default: 0)\n
+        fps (float, optional): playback frame rate (default: 10)\n
+        name (str, optional): recording name"""
+    return xc.timelapse_start(tfmt.interval, tfmt.width, tfmt.height,
+                              tfmt.inp_fmt, tfmt.length, tfmt.fps,
+                              tfmt.name)
+
+
+@app.post("/timelapse/stop")
+async def timelapse_stop():
+    """Ends the timelapse, finishing its file(s)"""
+    return xc.timelapse_stop()
+
+
+@app.post("/timelapse/status")
+async def timelapse_status():
+    """Gets the progress of the timelapse: frames captured and skipped,
+    elapsed and CPU seconds (cpu_fraction of one core), bytes written and
+    files"""
+    return xc.timelapse_status()
+
+
 @app.post("/recording/delete/{filename}")
 async def recording_delete(filename: str):
     """Deletes a recording
@@ -304,46 +638,306 @@ async def recordings_list(request: Request):
     return recordings
 
 
+# latest controller snapshot pushed by the hardware service
+snapshot_cache = {
+    "snapshot": None,
+    "received": 0.0  # time.monotonic()
+}
+
+
+def cache_snapshot(snapshot: dict) -> bool:
+    """Stores a snapshot unless a newer one is already cached
+
+    Returns:
+        bool: whether the snapshot was stored
+    """
+    current = snapshot_cache["snapshot"]
+    if (current is not None
+            and snapshot["instance"] == current["instance"]
+            and snapshot["version"] < current["version"]):
+        return False
+    snapshot_cache["snapshot"] = snapshot
+    snapshot_cache["received"] = time.monotonic()
+    return True
+
+
+@app.post("/internal/snapshot", include_in_schema=False)
+async def receive_snapshot(request: Request):
+    """Receives a state snapshot pushed by the hardware service"""
+    if request.client.host not in ["127.0.0.1", "::1"]:
+        return JSONResponse({"success": False}, status_code=403)
+
+    previous = snapshot_cache["snapshot"]
+    snapshot = await request.json()
+    if cache_snapshot(snapshot):
+        await broadcast_snapshot(previous, snapshot)
+    return {"success": True}
+
+
+# WebSocket control channel
+websockets = set()
+
+
+def encode(data):
+    """Makes an RPC result JSON serializable (bytes become base64)"""
+    return jsonable_encoder(data, custom_encoder={
+        bytes: lambda b: base64.b64encode(b).decode("ascii")
+    })
+
+
+async def broadcast_snapshot(previous: dict, snapshot: dict):
+    """Pushes the state transitions since the previous snapshot, then the
+    snapshot itself, to every WebSocket client"""
+    if not websockets:
+        return
+
+    events = []
+    last_version = -1
+    if previous is not None and previous["instance"] == snapshot["instance"]:
+        last_version = previous["version"]
+    for transition in snapshot.get("transitions", []):
+        if transition["version"] > last_version:
+            events.append(dict(transition, event="transition"))
+    events.append({"event": "snapshot", "snapshot": snapshot})
+
+    for ws in list(websockets):
+        try:
+            for event in events:
+                await ws.send_json(event)
+        except (WebSocketDisconnect, RuntimeError):
+            websockets.discard(ws)
+
+
+@app.websocket("/ws")
+async def control_channel(ws: WebSocket):
+    """WebSocket control channel\n
+    Send commands as {"id": any, "method": str, "params": list}, where
+    method is a hardware RPC (e.g. stop_janus, set_format, start_janus).
+    Commands may be pipelined: they run in the order they are received and
+    each result is sent as soon as it completes, as
+    {"id": id, "result": ...} or {"id": id, "error": str}.\n
+    Controller and process state transitions are pushed as
+    {"event": "transition", "source", "from", "to", "version"} followed by
+    {"event": "snapshot", "snapshot": ...} (see /status)"""
+    await ws.accept()
+    websockets.add(ws)
+
+    # own proxy, ServerProxy connections are not thread safe
+    proxy = hardware_proxy()
+    commands = asyncio.Queue()
+
+    async def execute():
+        """Runs commands one at a time, in order"""
+        while True:
+            command = await commands.get()
+            response = {"id": command.get("id")}
+            method = command.get("method", "")
+            params = command.get("params", [])
+            if not re.fullmatch(r"[a-z][a-z0-9_]*", str(method)) \
+                    or not isinstance(params, list):
+                response["error"] = f"invalid command: {method}"
+            else:
+                try:
+                    result = await run_in_threadpool(
+                        getattr(proxy, method), *params)
+                    response["result"] = encode(result)
+                except (xmlrpc.client.Error, OSError) as exc:
+                    response["error"] = str(exc)
+            await ws.send_json(response)
+
+    executor = asyncio.ensure_future(execute())
+    try:
+        # send the current state first
+        snapshot = snapshot_cache["snapshot"]
+        if snapshot is not None:
+            await ws.send_json({"event": "snapshot", "snapshot": snapshot})
+
+        while True:
+            try:
+                command = json.loads(await ws.receive_text())
+            except ValueError:
+                command = None
+            if not isinstance(command, dict):
+                command = {}
+            await commands.put(command)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        executor.cancel()
+        websockets.discard(ws)
+
+
+@app.get("/devices")
+@app.post("/devices")
+async def list_devices():
+    """Gets the capture devices served by the hardware service (id, v4l2
+    and ALSA devices, controller state)\n
+    Any route can be called for a device under /devices/{device_id}
+    (example: /devices/hdmi2/screenshot), routes without the prefix use the
+    main device"""
+    return xc.list_devices()
+
+
+@app.get("/status")
 @app.post("/status")
-async def status_webrtc():
-    """Gets status of WebRTC (Janus) and audio (gstreamer) processes"""
-    return {
-        "janus": xc.status_janus(),
-        "gstreamer": xc.status_gstreamer()
-    }
+async def status_webrtc(request: Request):
+    """Gets status of the controller, WebRTC (Janus), audio (gstreamer) and
+    recording (ffmpeg) processes, the current format and recording
+    progress, including health check and automatic restart statistics\n
+    Served from a snapshot pushed by the hardware service whenever its
+    state changes, so polling does not make any RPCs. The ETag header
+    changes with the snapshot version; send it back as If-None-Match to
+    get an empty 304 response while nothing has changed."""
+    if current_device.get() is not None:  # (only the main device's is pushed)
+        return xc.get_snapshot()
+
+    snapshot = snapshot_cache["snapshot"]
+    age = time.monotonic() - snapshot_cache["received"]
+    if snapshot is None or age > settings.status_max_age:
+        cache_snapshot(xc.get_snapshot())
+        snapshot = snapshot_cache["snapshot"]
+
+    etag = f'"{snapshot["instance"]}-{snapshot["version"]}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(snapshot, headers={"ETag": etag})
+
+
+@app.post("/logs/{name}")
+async def tail_logs(name: str, lines: int = 100):
+    """Gets the most recent output of a background process\n
+    (kept in a fixed-size in-memory buffer on the hardware service)\n
+    params:\n
+        name (str): janus, gstreamer or ffmpeg\n
+        lines (int, optional): maximum number of lines (default: 100)"""
+    return xc.tail_logs(name, lines)
 
 
 @app.post("/reset_usb")
-async def reset_usb():
+async def reset_usb(wait: bool = False):
     """Resets the USB device corresponding with the capture card\n
-    Useful for troubleshooting"""
-    return xc.reset_usb()
+    Returns immediately; the controller is in the RESET_USB state until the
+    video and audio devices are ready again (see /reset_usb/status)\n
+    Useful for troubleshooting\n
+    params:\n
+        wait (bool, optional): return once the device is ready
+        (default: false)"""
+    return xc.reset_usb(wait)
+
+
+@app.post("/scheduler")
+async def scheduler_stats():
+    """Gets the hardware operation queue: queue depth, queued and running
+    operations, and per operation the runs, calls that shared a run
+    (coalesced), calls rejected for their deadline, mean/max wait and
+    estimated run time"""
+    return xc.scheduler_stats()
+
+
+@app.get("/traces")
+@app.post("/traces")
+async def traces(limit: int = 20, min_ms: float = 0.0):
+    """Gets the kept traces (slow or sampled requests), newest first: the
+    spans of the API (request, XML-RPC calls) and of the hardware service
+    (queue wait, operation, janus, device, encoding, USB reset)\n
+    (see docs/tracing.md)\n
+    params:\n
+        limit (int, optional): number of traces (default: 20)\n
+        min_ms (float, optional): minimum request duration"""
+    proxy = hardware_proxy()
+    return await run_in_threadpool(proxy.traces, limit, min_ms)
 
 
-def reset_usb_and_start_janus():
-    """resets USB then starts webrtc (janus)"""
-    xc.reset_usb()
-    xc.start_janus()
+@app.post("/reset_usb/status")
+async def usb_status():
+    """Gets the progress of the last USB reset, including the measured
+    time until the device was ready again (recovery_time, seconds)"""
+    return xc.usb_status()
 
 
-if __name__ == "__main__":
+def multicall(calls: list) -> list:
+    """Makes several RPCs in a single request (system.multicall)
 
-    # connect to XMLRPC server...
-    addr = settings.xmlrpc_addr
-    while True:
+    Args:
+        calls (list): (method, params) tuples
+
+    Returns:
+        list: {"result": ...} or {"error": str} for each call, in order
+    """
+    batch = xmlrpc.client.MultiCall(xc)
+    for method, params in calls:
+        getattr(batch, device_method(method))(*params)
+    results = batch()
+
+    responses = []
+    for i in range(len(calls)):
         try:
-            logger.info(xc.system.listMethods())
-            logger.success(f"xmlrpc: connected to {addr}")
-            break
-        except ConnectionRefusedError:
-            logger.error(f"xmlrpc: not connected to {addr}. Trying again...")
-            time.sleep(1)
+            responses.append({"result": results[i]})
+        except xmlrpc.client.Fault as fault:
+            responses.append({"error": fault.faultString})
+    return responses
+
+
+@app.post("/batch")
+async def batch(calls: List[BatchCall]):
+    """Runs several hardware RPCs, in order, in a single round trip\n
+    body (list):\n
+        method (str): RPC name (example: get_format)\n
+        params (list, optional): positional parameters\n
+    Returns a list of {"result": ...} or {"error": str}, one per call"""
+    for call in calls:
+        if not re.fullmatch(r"[a-z][a-z0-9_]*", call.method):
+            return {
+                "success": False,
+                "error": f"invalid method: {call.method}"
+            }
+    results = multicall([(c.method, c.params) for c in calls])
+    return encode(results)
+
+
+@app.post("/dashboard")
+async def dashboard():
+    """Gets status (see /status), the current v4l2 format and a summary of
+    the stored recordings in a single round trip to the hardware"""
+    snapshot, fmt, recordings = multicall([
+        ("get_snapshot", []),
+        ("get_format", []),
+        ("recordings_list", [])
+    ])
+
+    if "result" in snapshot and current_device.get() is None:
+        cache_snapshot(snapshot["result"])
+
+    summary = recordings
+    if "result" in recordings:
+        data = recordings["result"]["data"]
+        summary = {
+            "count": len(data),
+            "total_size": sum(r["size"] or 0 for r in data),
+            "total_length": sum(r["length"] or 0 for r in data),
+            "latest": max(data, key=lambda r: r["timestamp"], default=None)
+        }
+
+    return encode({
+        "status": snapshot.get("result", snapshot),
+        "format": fmt.get("result", fmt),
+        "recordings": summary
+    })
+
+
+def reset_usb_and_start_janus():
+    """resets USB then starts webrtc (janus) in a single request"""
+    multicall([("reset_usb", []), ("start_janus", [])])
+
 
+if __name__ == "__main__":
     log_level = "info"
     if settings.verbose:
         log_level = "debug"
 
-    uvicorn.run("fastapi_server:app",
+    # pass the app itself, an import string makes uvicorn import this
+    # module a second time
+    uvicorn.run(app,
                 host=settings.host,
                 port=settings.port,
                 log_level=log_level)
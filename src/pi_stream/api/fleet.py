@@ -0,0 +1,230 @@
+"""Calls to many pi-stream API nodes at once
+
+Each node has a pool of persistent HTTP connections (keep-alive), so a
+fan-out does not pay for a TCP connection per node and call. Calls run
+concurrently on a thread pool, each with its own timeout, and a slow or
+unreachable node only affects its own result.
+"""
+
+import http.client
+import json
+import queue
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class ConnectionPool:
+    """Persistent connections to one node"""
+
+    def __init__(self, address: str, size: int = 4, timeout: float = 5.0):
+        """
+        Args:
+            address (str): node API address (example: http://pi1:8000)
+            size (int, optional): idle connections kept open
+            timeout (float, optional): default socket timeout (seconds)
+        """
+        url = urllib.parse.urlsplit(address)
+        self.address = address
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(size)  # most recently used first
+
+    def _connect(self, timeout: float) -> http.client.HTTPConnection:
+        return http.client.HTTPConnection(self.host, self.port,
+                                          timeout=timeout)
+
+    def request(self, method: str, path: str, body: bytes = None,
+                headers: dict = None, timeout: float = None) -> tuple:
+        """Makes a request on an idle connection (or a new one)
+
+        Returns:
+            tuple: status, headers (dict, lowercase names), body (bytes)
+
+        Raises:
+            OSError: connection failed or timed out
+            http.client.HTTPException: invalid response
+        """
+        timeout = self.timeout if timeout is None else timeout
+        headers = headers or {}
+        try:
+            connection, reused = self._idle.get_nowait(), True
+        except queue.Empty:
+            connection, reused = self._connect(timeout), False
+
+        try:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError,
+                    ConnectionResetError):
+                if not reused:
+                    raise
+                # the node closed the idle connection, retry once
+                connection.close()
+                connection = self._connect(timeout)
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            data = response.read()
+        except BaseException:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                self._idle.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+        response_headers = {k.lower(): v for k, v in response.getheaders()}
+        return response.status, response_headers, data
+
+    def close(self):
+        """Closes the idle connections"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class Fleet:
+    """Concurrent calls to a set of nodes"""
+
+    def __init__(self, nodes: list, pool_size: int = 4,
+                 timeout: float = 5.0, status_ttl: float = 5.0,
+                 workers: int = 64):
+        """
+        Args:
+            nodes (list): node API addresses
+            pool_size (int, optional): idle connections kept per node
+            timeout (float, optional): default per-node timeout (seconds)
+            status_ttl (float, optional): seconds a node's status is cached
+            workers (int, optional): calls in progress at once
+        """
+        self.pools = {node: ConnectionPool(node, pool_size, timeout)
+                      for node in nodes}
+        self.timeout = timeout
+        self.status_ttl = status_ttl
+        self._executor = ThreadPoolExecutor(workers,
+                                            thread_name_prefix="fleet")
+        self._status = {}  # node: (time.monotonic() received, result)
+        self._status_lock = threading.Lock()
+
+    @property
+    def nodes(self) -> list:
+        return list(self.pools)
+
+    def _call(self, node: str, method: str, path: str, body: bytes,
+              headers: dict, timeout: float) -> dict:
+        start = time.perf_counter()
+        try:
+            status, response_headers, data = self.pools[node].request(
+                method, path, body, headers, timeout)
+        except (OSError, http.client.HTTPException) as exc:
+            return {
+                "success": False,
+                "error": f"{type(exc).__name__}: {exc}",
+                "elapsed_ms": (time.perf_counter() - start) * 1000
+            }
+
+        result = {
+            "success": 200 <= status < 300,
+            "status": status,
+            "content_type": response_headers.get("content-type", ""),
+            "data": data,
+            "elapsed_ms": (time.perf_counter() - start) * 1000
+        }
+        if result["content_type"].startswith("application/json"):
+            try:
+                result["data"] = json.loads(data) if data else None
+            except ValueError as exc:  # (e.g. a truncated response)
+                result["success"] = False
+                result["error"] = f"invalid JSON response: {exc}"
+                return result
+            # API errors are reported as {"success": false, ...} with 200
+            if isinstance(result["data"], dict) \
+                    and result["data"].get("success") is False:
+                result["success"] = False
+        return result
+
+    def call(self, method: str, path: str, body=None, nodes: list = None,
+             timeout: float = None) -> dict:
+        """Makes the same request to several nodes at once
+
+        Args:
+            method (str): GET or POST
+            path (str): path and query (example: /screenshot?out_fmt=jpg)
+            body (optional): JSON body
+            nodes (list, optional): nodes to call (default: all)
+            timeout (float, optional): per-node timeout (seconds)
+
+        Returns:
+            dict: result by node: success, status, content_type, data (JSON
+                or bytes), elapsed_ms, or success and error
+        """
+        nodes = self.nodes if nodes is None else nodes
+        timeout = self.timeout if timeout is None else timeout
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        futures = {}
+        results = {}
+        for node in nodes:
+            if node not in self.pools:
+                results[node] = {"success": False, "error": "unknown node"}
+                continue
+            futures[node] = self._executor.submit(
+                self._call, node, method, path, body, headers, timeout)
+
+        # (a margin for the request after the socket timeout)
+        done, _ = wait(futures.values(), timeout + 1.0)
+        for node, future in futures.items():
+            if future in done:
+                results[node] = future.result()
+            else:
+                results[node] = {
+                    "success": False,
+                    "error": f"timed out after {timeout} s"
+                }
+        return results
+
+    def status(self, nodes: list = None, max_age: float = None) -> dict:
+        """Gets the nodes' /status, from the cache if it is recent enough
+
+        Args:
+            nodes (list, optional): nodes (default: all)
+            max_age (float, optional): seconds (default: status_ttl)
+        """
+        nodes = self.nodes if nodes is None else nodes
+        max_age = self.status_ttl if max_age is None else max_age
+        now = time.monotonic()
+        results = {}
+        with self._status_lock:
+            for node in nodes:
+                cached = self._status.get(node)
+                if cached is not None and now - cached[0] <= max_age:
+                    results[node] = dict(cached[1], cached=True)
+        stale = [node for node in nodes if node not in results]
+        if stale:
+            fresh = self.call("POST", "/status", nodes=stale)
+            received = time.monotonic()
+            with self._status_lock:
+                for node, result in fresh.items():
+                    if result["success"]:
+                        self._status[node] = (received, result)
+            results.update(fresh)
+        return {node: results[node] for node in nodes}
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        for pool in self.pools.values():
+            pool.close()
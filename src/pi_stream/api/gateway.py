@@ -0,0 +1,193 @@
+"""FastAPI gateway fanning out calls to many pi-stream nodes
+
+Runs separately from the nodes (one gateway for a fleet):
+
+    GATEWAY_NODES='["http://pi1:8000", "http://pi2:8000"]' \
+        python3 src/api/gateway.py
+"""
+
+import base64
+import io
+import json
+import urllib.parse
+import zipfile
+
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from loguru import logger
+from pydantic import BaseSettings
+import uvicorn
+
+from fleet import Fleet
+from models import FastScreenshotFormat, RecordingFormat, VideoFormat
+
+
+class Settings(BaseSettings):
+    """Environment Variables (GATEWAY_ prefix)"""
+    host: str = "0.0.0.0"
+    port: int = 8100
+    nodes: list = []  # node API addresses (example: ["http://pi1:8000"])
+    pool_size: int = 4  # idle connections kept per node
+    timeout: float = 10.0  # default per-node timeout (seconds)
+    status_ttl: float = 5.0  # seconds a node's status is cached
+    workers: int = 64  # node calls in progress at once
+    verbose: bool = False
+
+    class Config:
+        env_prefix = "gateway_"
+
+
+settings = Settings()
+fleet = Fleet(settings.nodes, settings.pool_size, settings.timeout,
+              settings.status_ttl, settings.workers)
+app = FastAPI()
+
+
+def select(nodes: str = None) -> list:
+    """Gets the nodes named in a comma separated list (default: all)"""
+    return nodes.split(",") if nodes else None
+
+
+def encode(results: dict) -> dict:
+    """Makes results JSON serializable (binary data as base64)"""
+    for result in results.values():
+        if isinstance(result.get("data"), bytes):
+            result["data"] = base64.b64encode(result["data"]).decode()
+    return results
+
+
+async def fan_out(method: str, path: str, body=None, nodes: str = None,
+                  timeout: float = None) -> dict:
+    return await run_in_threadpool(fleet.call, method, path, body,
+                                   select(nodes), timeout)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    fleet.close()
+
+
+@app.get("/nodes")
+@app.post("/nodes")
+async def list_nodes():
+    """Gets the node addresses"""
+    return {"success": True, "nodes": fleet.nodes}
+
+
+@app.post("/fleet/status")
+async def fleet_status(nodes: str = None, max_age: float = None):
+    """Gets the status of every node (cached for GATEWAY_STATUS_TTL s)\n
+    params:\n
+        nodes (str, optional): comma separated nodes (default: all)\n
+        max_age (float, optional): seconds a cached status may be old"""
+    results = await run_in_threadpool(fleet.status, select(nodes), max_age)
+    return encode(results)
+
+
+@app.get("/fleet/screenshot")
+async def fleet_screenshot(request: Request, nodes: str = None,
+                           timeout: float = None, fast: bool = False):
+    """Takes a screenshot on every node at once, returned as a zip of
+    screenshots named after the nodes, plus results.json\n
+    params:\n
+        nodes (str, optional): comma separated nodes (default: all)\n
+        timeout (float, optional): per-node seconds\n
+        fast (bool, optional): use /fast_screenshot (fast screenshot mode
+        must be on)\n
+        other parameters are passed on (see /screenshot)"""
+    query = {k: v for k, v in request.query_params.items()
+             if k not in ["nodes", "timeout", "fast"]}
+    path = "/fast_screenshot" if fast else "/screenshot"
+    if query:
+        path += "?" + urllib.parse.urlencode(query)
+    results = await fan_out("GET", path, None, nodes, timeout)
+
+    content = io.BytesIO()
+    summary = {}
+    with zipfile.ZipFile(content, "w", zipfile.ZIP_STORED) as archive:
+        for i, (node, result) in enumerate(results.items()):
+            data = result.pop("data", None)
+            if result["success"] and isinstance(data, bytes):
+                extension = result["content_type"].split("/")[-1]
+                extension = {"jpeg": "jpg", "octet-stream": "raw"}.get(
+                    extension, extension)
+                name = f"{i:03d}_{node.split('//')[-1].replace(':', '_')}"
+                result["file"] = f"{name}.{extension}"
+                archive.writestr(result["file"], data)
+            elif data is not None:
+                result["data"] = data
+            summary[node] = result
+        archive.writestr("results.json", json.dumps(summary))
+    content.seek(0)
+
+    response = StreamingResponse(content, media_type="application/zip")
+    response.headers["Content-Disposition"] = \
+        "attachment; filename=screenshots.zip"
+    return response
+
+
+@app.post("/fleet/fast_screenshot/start")
+async def fleet_fast_screenshot_start(sfmt: FastScreenshotFormat,
+                                      nodes: str = None):
+    """Enters fast screenshot mode on every node (see
+    /fast_screenshot/start)"""
+    return encode(await fan_out("POST", "/fast_screenshot/start",
+                                sfmt.dict(), nodes))
+
+
+@app.post("/fleet/set_format")
+async def fleet_set_format(fmt: VideoFormat, nodes: str = None):
+    """Sets the video format on every node (see /set_format)"""
+    return encode(await fan_out("POST", "/set_format", fmt.dict(), nodes))
+
+
+@app.post("/fleet/recording/start")
+async def fleet_recording_start(fmt: RecordingFormat, nodes: str = None):
+    """Starts a recording on every node (see /recording/start)"""
+    return encode(await fan_out("POST", "/recording/start", fmt.dict(),
+                                nodes))
+
+
+@app.post("/fleet/recording/list")
+async def fleet_recording_list(nodes: str = None):
+    """Gets the recordings of every node, merged into one list (each
+    recording with its node), newest first"""
+    results = await fan_out("POST", "/recording/list", None, nodes)
+    recordings = []
+    for node, result in results.items():
+        if result["success"] and not isinstance(result["data"], dict):
+            result["success"] = False
+            result["error"] = "unexpected response"
+        if result["success"]:
+            for recording in result["data"].get("data", []):
+                recordings.append(dict(recording, node=node))
+            result["data"] = None  # (merged)
+    recordings.sort(key=lambda r: r.get("timestamp") or "", reverse=True)
+    return {
+        "success": all(r["success"] for r in results.values()),
+        "data": recordings,
+        "nodes": encode(results)
+    }
+
+
+@app.post("/fleet/call/{path:path}")
+async def fleet_call(path: str, request: Request, nodes: str = None,
+                     timeout: float = None):
+    """Makes the same POST request (JSON body) to every node\n
+    (example: /fleet/call/janus/start)\n
+    params:\n
+        nodes (str, optional): comma separated nodes (default: all)\n
+        timeout (float, optional): per-node seconds"""
+    body = await request.body()
+    return encode(await fan_out("POST", f"/{path}",
+                                json.loads(body) if body else None,
+                                nodes, timeout))
+
+
+if __name__ == "__main__":
+    logger.success(f"Gateway for {len(settings.nodes)} nodes")
+    uvicorn.run(app,
+                host=settings.host,
+                port=settings.port,
+                log_level="debug" if settings.verbose else "info")
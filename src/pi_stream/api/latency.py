@@ -0,0 +1,115 @@
+"""Latency histograms for screenshot responses"""
+
+import bisect
+import threading
+import time
+
+# bucket upper bounds (ms), roughly logarithmic
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+class LatencyHistogram:
+    """Counts of latencies per bucket (constant memory, thread safe)"""
+
+    def __init__(self):
+        self._counts = [0] * (len(BUCKETS) + 1)  # last: above BUCKETS[-1]
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, ms: float):
+        """Adds a measurement (milliseconds)"""
+        with self._lock:
+            self._counts[bisect.bisect_left(BUCKETS, ms)] += 1
+            self.count += 1
+            self.total += ms
+            self.max = max(self.max, ms)
+
+    def quantile(self, q: float) -> float:
+        """Gets the upper bound of the bucket containing quantile q (ms)"""
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self._counts):
+            seen += count
+            if count and seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return 0.0
+
+    def summary(self) -> dict:
+        """Gets count, mean, max, p50/p95/p99 (bucket bounds) and the
+        bucket counts"""
+        with self._lock:
+            return {
+                "count": self.count,
+                "mean": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+                "p50": self.quantile(0.5),
+                "p95": self.quantile(0.95),
+                "p99": self.quantile(0.99),
+                "buckets": {f"le_{bound}": count for bound, count
+                            in zip(BUCKETS + ["inf"], self._counts)}
+            }
+
+
+def stage_timings(result: dict, received: float) -> dict:
+    """Gets how long each stage of serving a frame took.
+
+    The hardware service runs on the same machine, so its time.monotonic
+    timestamps can be compared with this process's.
+
+    Args:
+        result (dict): hardware result with captured, encode_ms and served
+        received (float): time.monotonic() when the RPC returned
+
+    Returns:
+        dict: milliseconds from capture to the hardware returning the frame
+            (capture_age), encoding (encode), the RPC returning (rpc) and
+            capture to now (age)
+    """
+    now = time.monotonic()
+    return {
+        "capture_age": (result["served"] - result["captured"]) * 1000,
+        "encode": result["encode_ms"],
+        "rpc": (received - result["served"]) * 1000,
+        "age": (now - result["captured"]) * 1000
+    }
+
+
+def timing_headers(timings: dict) -> dict:
+    """Gets the response headers for stage timings (see stage_timings)"""
+    captured = time.time() - timings["age"] / 1000
+    return {
+        "X-Capture-Time": f"{captured:.3f}",
+        "X-Capture-Age-Ms": f"{timings['capture_age']:.1f}",
+        "X-Encode-Ms": f"{timings['encode']:.1f}",
+        "X-RPC-Ms": f"{timings['rpc']:.1f}",
+        "X-Age-Ms": f"{timings['age']:.1f}"
+    }
+
+
+class LatencyStats:
+    """Histograms per route and stage"""
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, route: str, timings: dict):
+        """Adds the stage timings of a response"""
+        for stage, ms in timings.items():
+            key = (route, stage)
+            with self._lock:
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = LatencyHistogram()
+            histogram.record(ms)
+
+    def summary(self) -> dict:
+        """Gets the summaries by route, then stage"""
+        with self._lock:
+            histograms = dict(self._histograms)
+        summary = {}
+        for (route, stage), histogram in sorted(histograms.items()):
+            summary.setdefault(route, {})[stage] = histogram.summary()
+        return summary
@@ -0,0 +1,45 @@
+"""API request bodies (shared by the API and the fleet gateway)"""
+
+from pydantic import BaseModel
+
+
+class VideoFormat(BaseModel):
+    """v4l2-ctl video format"""
+    width: int
+    height: int
+    pixelformat: str
+    fps: int
+
+
+class RecordingFormat(BaseModel):
+    width: int
+    height: int
+    pixelformat: str
+    fps: int
+    length: int
+
+
+class TimelapseFormat(BaseModel):
+    """timelapse capture"""
+    interval: float = 5.0  # seconds between frames
+    width: int = 1920
+    height: int = 1080
+    inp_fmt: str = "jpg"  # "jpg" (MJPEG) OR "png" (YUYV)
+    length: float = 0  # seconds (0: until /timelapse/stop)
+    fps: float = 10.0  # playback frame rate
+    name: str = ""
+
+
+class BatchCall(BaseModel):
+    """single call in a batch"""
+    method: str  # hardware RPC name (example: get_format)
+    params: list = []
+
+
+class FastScreenshotFormat(BaseModel):
+    """fast screenshot format"""
+    inp_fmt: str = "png"  # "jpg" OR "png"
+    out_fmt: str = "png"  # "jpg", "png", "raw" OR "native"
+    width: int = 1920
+    height: int = 1080
+    compression: str = ""  # raw/native frames: "" OR "lz4"
@@ -0,0 +1,180 @@
+"""Request tracing (API side)
+
+Each HTTP request is a trace: a root span from the request until the
+response is sent, with a span per XML-RPC call. The trace id is sent to
+the hardware service in a W3C traceparent header, so the spans it records
+(queue wait, controller operation, janus, device, encoding, USB reset)
+join the same trace (see hardware/tracing.py).
+
+Traces are kept when the response took at least TRACE_SLOW_MS, for a
+TRACE_SAMPLE_RATE fraction of the others, and when the client asked for
+it (traceparent sampled flag). Kept traces are handed to the hardware
+service with the API's spans, which holds them (GET /traces) and exports
+them (OTLP). The others cost a few dicts.
+"""
+
+import contextvars
+import os
+import random
+import re
+import time
+import xmlrpc.client
+
+# trace of the request being handled
+current_trace = contextvars.ContextVar("current_trace", default=None)
+# span of the XML-RPC call being made (parent of the hardware's spans)
+current_call = contextvars.ContextVar("current_call", default=None)
+
+TRACEPARENT = re.compile(r"00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+METHOD_NAME = re.compile(rb"<methodName>([^<]*)</methodName>")
+
+
+def new_id(size: int) -> str:
+    """Gets a random trace (16 bytes) or span (8 bytes) id, as hex"""
+    return os.urandom(size).hex()
+
+
+class RequestTrace:
+    """Spans of one request"""
+
+    def __init__(self, name: str, traceparent: str = None):
+        """
+        Args:
+            name (str): root span name (example: GET /screenshot)
+            traceparent (str, optional): the client's W3C traceparent
+                header, continued if valid
+        """
+        match = TRACEPARENT.fullmatch((traceparent or "").strip())
+        self.trace_id = new_id(16)
+        self.sampled = False
+        parent_id = None
+        if match is not None:
+            self.trace_id, parent_id, flags = match.groups()
+            self.sampled = bool(int(flags, 16) & 1)
+        self.spans = []
+        self.root = self.start(name, parent_id)
+
+    def start(self, name: str, parent_id: str = None, **attributes) -> dict:
+        """Starts a span (see finish)"""
+        span = {
+            "name": name,
+            "trace_id": self.trace_id,
+            "span_id": new_id(8),
+            "parent_id": parent_id,
+            "service": "api",
+            "start": time.time(),
+            "duration_ms": None,
+            "attributes": attributes,
+            "error": None,
+            "_start": time.perf_counter()
+        }
+        self.spans.append(span)
+        return span
+
+    @staticmethod
+    def finish(span: dict, error: str = None):
+        if span["duration_ms"] is None:
+            span["duration_ms"] = (time.perf_counter() - span["_start"]) * 1000
+        span["error"] = span["error"] or error
+
+    @property
+    def duration_ms(self) -> float:
+        """of the root span (None until the response was sent)"""
+        return self.root["duration_ms"]
+
+    def finished_spans(self) -> list:
+        """Gets the spans as sent to the hardware service"""
+        return [{k: v for k, v in span.items() if k != "_start"}
+                for span in self.spans if span["duration_ms"] is not None]
+
+
+class TracingTransport(xmlrpc.client.Transport):
+    """Records XML-RPC calls made while handling a traced request as
+    spans, and sends the trace to the hardware service"""
+
+    def request(self, host, handler, request_body, verbose=False):
+        trace = current_trace.get()
+        if trace is None:
+            return super().request(host, handler, request_body, verbose)
+
+        method = METHOD_NAME.search(request_body)
+        name = method.group(1).decode() if method else "?"
+        span = trace.start(f"xmlrpc {name}", trace.root["span_id"],
+                           bytes=len(request_body))
+        token = current_call.set(span)
+        try:
+            return super().request(host, handler, request_body, verbose)
+        except Exception as exc:
+            trace.finish(span, f"{type(exc).__name__}: {exc}")
+            raise
+        finally:
+            trace.finish(span)
+            current_call.reset(token)
+
+    def send_headers(self, connection, headers):
+        trace = current_trace.get()
+        span = current_call.get()
+        if trace is not None and span is not None:
+            flags = "01" if trace.sampled else "00"
+            headers = list(headers) + [
+                ("traceparent",
+                 f"00-{trace.trace_id}-{span['span_id']}-{flags}")]
+        super().send_headers(connection, headers)
+
+
+class TraceMiddleware:
+    """ASGI middleware tracing each HTTP request (X-Trace-Id response
+    header), then handing slow or sampled traces to keep"""
+
+    def __init__(self, app, keep, slow_ms: float = 1000.0,
+                 sample_rate: float = 0.0, exclude: tuple = ()):
+        """
+        Args:
+            app: ASGI application
+            keep (callable): awaited with a kept RequestTrace, after the
+                response and background tasks
+            slow_ms (float, optional): responses at least this slow are kept
+            sample_rate (float, optional): fraction of other requests kept
+            exclude (tuple, optional): path prefixes not traced
+        """
+        self.app = app
+        self.keep = keep
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.exclude = exclude
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.exclude):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        traceparent = headers.get(b"traceparent", b"").decode("latin-1")
+        trace = RequestTrace(f"{scope['method']} {scope['path']}",
+                             traceparent)
+        status = None
+
+        async def traced_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = dict(message, headers=list(message["headers"]) + [
+                    (b"x-trace-id", trace.trace_id.encode())])
+            elif message["type"] == "http.response.body" \
+                    and not message.get("more_body", False):
+                trace.finish(trace.root)  # (background tasks may follow)
+            await send(message)
+
+        token = current_trace.set(trace)
+        try:
+            await self.app(scope, receive, send=traced_send)
+        except Exception as exc:
+            trace.finish(trace.root, f"{type(exc).__name__}: {exc}")
+            raise
+        finally:
+            current_trace.reset(token)
+            trace.finish(trace.root)
+            trace.root["attributes"]["status"] = status or 500
+            if trace.sampled or trace.duration_ms >= self.slow_ms \
+                    or random.random() < self.sample_rate:
+                await self.keep(trace)
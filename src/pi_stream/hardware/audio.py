@@ -0,0 +1,372 @@
+"""Audio (gstreamer) pipeline profiles, latency and level measurement, and
+a ring buffer of the encoded audio"""
+
+import collections
+import re
+import socket
+import threading
+import time
+from typing import NamedTuple
+
+
+class AudioProfile(NamedTuple):
+    """gstreamer audio pipeline parameters"""
+    buffer_time: int  # alsasrc buffer size (microseconds, 0: default)
+    latency_time: int  # alsasrc period (microseconds, 0: default)
+    frame_size: float  # opusenc frame size (ms: 2.5, 5, 10, 20, 40, 60)
+    bitrate: int  # opusenc bitrate (bits/s)
+    audio_type: str  # opusenc audio-type: generic, voice, restricted-lowdelay
+
+
+AUDIO_PROFILES = {
+    # the original pipeline (gstreamer defaults, 48 kbits/s)
+    "default": AudioProfile(0, 0, 20, 48000, "generic"),
+    # small ALSA buffer/periods and 10 ms CELT-only Opus frames
+    "low-latency": AudioProfile(20000, 5000, 10, 64000,
+                                "restricted-lowdelay"),
+    "high-quality": AudioProfile(200000, 10000, 20, 128000, "generic"),
+    # large frames (less packet overhead), tuned for speech
+    "low-bandwidth": AudioProfile(200000, 20000, 60, 16000, "voice"),
+}
+
+# environment enabling gstreamer's latency tracer (one log line per buffer
+# with its time from the source to the sink, see LatencyMonitor)
+LATENCY_TRACER_ENV = {
+    "GST_TRACERS": "latency",
+    "GST_DEBUG": "GST_TRACER:7",
+    "GST_DEBUG_NO_COLOR": "1"
+}
+
+
+def audio_pipeline(device: str, profile: AudioProfile,
+                   port: int = 5002, ring_port: int = 0) -> str:
+    """Builds the gst-launch-1.0 arguments for a profile
+
+    Args:
+        device (str): ALSA device name
+        profile (AudioProfile): pipeline parameters
+        port (int, optional): RTP port (janus streaming plugin)
+        ring_port (int, optional): RTP port of the AudioRing (0: none)
+
+    Returns:
+        str: arguments. progressreport prints every 5 s (for the watchdog),
+            level every 250 ms (-m prints its messages, see LevelMonitor)
+    """
+    source = f"alsasrc device=\"{device}\""
+    if profile.buffer_time:
+        source += f" buffer-time={profile.buffer_time}"
+    if profile.latency_time:
+        source += f" latency-time={profile.latency_time}"
+
+    # the same RTP packets go to janus and to the ring
+    clients = f"127.0.0.1:{port}"
+    if ring_port:
+        clients += f",127.0.0.1:{ring_port}"
+
+    frame_size = f"{profile.frame_size:g}"
+    return f"""-m
+    {source} !
+        progressreport update-freq=5 !
+        level interval=250000000 !
+        opusenc bitrate={profile.bitrate} frame-size={frame_size}
+                audio-type={profile.audio_type} !
+            rtpopuspay ! multiudpsink clients={clients}
+    """
+
+
+class LatencyMonitor:
+    """Parses latency tracer output (source to sink time of each buffer)"""
+
+    # e.g. "... GST_TRACER :0:: latency, src-element=(string)alsasrc0, ...
+    #       time=(guint64)21428571, ts=(guint64)1021312312;"
+    # (not element-latency, which times single elements)
+    LATENCY = re.compile(r"(?<![-\w])latency, .*?\btime=\(guint64\)(\d+)")
+
+    def __init__(self, samples: int = 500):
+        """
+        Args:
+            samples (int): number of recent measurements kept
+        """
+        self._samples = collections.deque(maxlen=samples)
+        self._partial = ""
+        self.count = 0
+
+    def feed(self, data):
+        """Parses a chunk of output (str or bytes, may end mid-line)"""
+        if isinstance(data, bytes):
+            data = data.decode("utf-8", "replace")
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            match = self.LATENCY.search(line)
+            if match:
+                self._samples.append(int(match.group(1)) / 1e6)  # ms
+                self.count += 1
+
+    def stats(self) -> dict:
+        """Gets latency statistics (ms) of the recent measurements"""
+        if not self._samples:
+            return {"count": self.count}
+        samples = sorted(self._samples)
+        return {
+            "count": self.count,
+            "last": self._samples[-1],
+            "min": samples[0],
+            "mean": sum(samples) / len(samples),
+            "p95": samples[int(len(samples) * 0.95)],
+            "max": samples[-1]
+        }
+
+    def reset(self):
+        """Clears the measurements (e.g. after changing the pipeline)"""
+        self._samples.clear()
+        self._partial = ""
+        self.count = 0
+
+
+class LevelMonitor:
+    """Parses level element messages (gst-launch-1.0 -m) into RMS/peak
+    levels and a silence flag"""
+
+    # e.g. 'Got message #42 from element "level0" (element): level, ...
+    #       rms=(double){ -21.5, -22.0 }, peak=(double){ -8.1, -9.0 }, ...'
+    LEVEL = re.compile(r"\blevel, .*?\brms=\(double\)\{([^}]*)\}"
+                       r".*?\bpeak=\(double\)\{([^}]*)\}")
+
+    def __init__(self, silence: float = -60.0):
+        """
+        Args:
+            silence (float): peak level (dBFS) below which audio is silent
+        """
+        self.silence = silence
+        self._partial = ""
+        self.rms = None
+        self.peak = None
+        self.updated = None  # time of the last measurement
+        self.silent_since = None
+
+    def feed(self, data):
+        """Parses a chunk of output (str or bytes, may end mid-line)"""
+        if isinstance(data, bytes):
+            data = data.decode("utf-8", "replace")
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            match = self.LEVEL.search(line)
+            if match:
+                self.rms, self.peak = ([float(v) for v in group.split(",")]
+                                       for group in match.groups())
+                self.updated = time.time()
+                if max(self.peak) >= self.silence:
+                    self.silent_since = None
+                elif self.silent_since is None:
+                    self.silent_since = self.updated
+
+    def stats(self) -> dict:
+        """Gets the latest levels (dBFS per channel)
+
+        Returns:
+            dict: rms, peak, silent, silent_for (seconds), age (seconds
+                since the measurement, None if there is none)
+        """
+        now = time.time()
+        return {
+            "rms": self.rms,
+            "peak": self.peak,
+            "silent": self.silent_since is not None,
+            "silent_for": (now - self.silent_since
+                           if self.silent_since is not None else 0.0),
+            "age": now - self.updated if self.updated is not None else None
+        }
+
+
+# Ring buffer of encoded audio
+# the pipeline also sends its RTP packets to a local port, received into
+# an AudioRing from which clips are written as Ogg/Opus (RFC 7845) without
+# decoding or re-encoding
+
+def opus_samples(packet: bytes) -> int:
+    """Gets the number of 48 kHz samples in an Opus packet (RFC 6716 3.1)"""
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:  # SILK: 10, 20, 40, 60 ms
+        frame = (480, 960, 1920, 2880)[config % 4]
+    elif config < 16:  # hybrid: 10, 20 ms
+        frame = (480, 960)[config % 2]
+    else:  # CELT: 2.5, 5, 10, 20 ms
+        frame = (120, 240, 480, 960)[config % 4]
+
+    code = toc & 0x3
+    if code == 0:
+        frames = 1
+    elif code < 3:
+        frames = 2
+    else:
+        frames = packet[1] & 0x3f if len(packet) > 1 else 0
+    return frame * frames
+
+
+def rtp_payload(datagram: bytes) -> tuple:
+    """Gets the timestamp and payload of an RTP packet (RFC 3550 5.1)
+
+    Returns:
+        tuple: timestamp, payload (None if not RTP version 2)
+    """
+    if len(datagram) < 12 or datagram[0] >> 6 != 2:
+        return None
+    offset = 12 + 4 * (datagram[0] & 0x0f)  # CSRCs
+    if datagram[0] & 0x10 and len(datagram) >= offset + 4:  # extension
+        offset += 4 + 4 * int.from_bytes(datagram[offset + 2:offset + 4],
+                                         "big")
+    end = len(datagram)
+    if datagram[0] & 0x20:  # padding
+        end -= datagram[-1]
+    if offset >= end:
+        return None
+    return int.from_bytes(datagram[4:8], "big"), datagram[offset:end]
+
+
+def _crc_table() -> list:
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x04c11db7 if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xffffffff)
+    return table
+
+
+_OGG_CRC = _crc_table()
+
+
+def ogg_crc(data: bytes) -> int:
+    """Ogg page checksum (CRC-32, polynomial 0x04c11db7, not reflected)"""
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xffffffff) ^ _OGG_CRC[(crc >> 24) ^ byte]
+    return crc
+
+
+def _ogg_page(packets: list, granule: int, serial: int, sequence: int,
+              header_type: int = 0) -> bytes:
+    """Builds an Ogg page holding whole packets"""
+    lacing = bytearray()
+    for packet in packets:
+        lacing += b"\xff" * (len(packet) // 255) + bytes([len(packet) % 255])
+    header = (b"OggS" + bytes([0, header_type])
+              + granule.to_bytes(8, "little", signed=True)
+              + serial.to_bytes(4, "little")
+              + sequence.to_bytes(4, "little")
+              + b"\0\0\0\0" + bytes([len(lacing)]) + bytes(lacing))
+    page = bytearray(header + b"".join(packets))
+    page[22:26] = ogg_crc(page).to_bytes(4, "little")
+    return bytes(page)
+
+
+def ogg_opus(packets: list, serial: int = 0x70697374) -> bytes:
+    """Writes Opus packets as an Ogg/Opus file
+
+    Args:
+        packets (list): Opus packets (bytes)
+        serial (int, optional): Ogg stream serial number
+
+    Returns:
+        bytes: Ogg/Opus file
+    """
+    channels = 2 if packets and packets[0][0] & 0x4 else 1
+    # pre-skip: the clip starts mid-stream, RFC 7845 recommends discarding
+    # 80 ms while the decoder converges
+    head = (b"OpusHead" + bytes([1, channels])
+            + (3840).to_bytes(2, "little") + (48000).to_bytes(4, "little")
+            + b"\0\0\0")
+    vendor = b"pi-stream"
+    tags = (b"OpusTags" + len(vendor).to_bytes(4, "little") + vendor
+            + b"\0\0\0\0")
+
+    pages = [_ogg_page([head], 0, serial, 0, 0x02),
+             _ogg_page([tags], 0, serial, 1)]
+    granule = 0
+    page = []
+    lacing = 0
+    for i, packet in enumerate(packets):
+        page.append(packet)
+        lacing += len(packet) // 255 + 1
+        granule += opus_samples(packet)
+        # pages of up to ~1 s (or the 255 lacing values limit)
+        last = i == len(packets) - 1
+        if last or len(page) == 50 or lacing + 6 > 255:
+            pages.append(_ogg_page(page, granule, serial, len(pages),
+                                   0x04 if last else 0))
+            page = []
+            lacing = 0
+    return b"".join(pages)
+
+
+class AudioRing:
+    """The last seconds of encoded audio (Opus packets), bounded by
+    duration rather than packet count"""
+
+    def __init__(self, seconds: float = 30.0):
+        self.seconds = seconds
+        self._packets = collections.deque()  # (samples, packet)
+        self._samples = 0
+        self._lock = threading.Lock()
+        self.received = 0
+
+    def add(self, datagram: bytes):
+        """Adds an RTP packet (as sent by rtpopuspay)"""
+        rtp = rtp_payload(datagram)
+        if rtp is None:
+            return
+        packet = rtp[1]
+        samples = opus_samples(packet)
+        with self._lock:
+            self._packets.append((samples, packet))
+            self._samples += samples
+            while self._samples - self._packets[0][0] >= \
+                    self.seconds * 48000:
+                self._samples -= self._packets.popleft()[0]
+            self.received += 1
+
+    def clip(self, seconds: float) -> tuple:
+        """Gets the most recent audio
+
+        Args:
+            seconds (float): clip length (at most the ring's length)
+
+        Returns:
+            tuple: Ogg/Opus file (bytes), duration (seconds)
+        """
+        with self._lock:
+            packets = []
+            samples = 0
+            for packet_samples, packet in reversed(self._packets):
+                if samples >= seconds * 48000:
+                    break
+                packets.append(packet)
+                samples += packet_samples
+        packets.reverse()
+        return ogg_opus(packets), samples / 48000
+
+
+class RtpReceiver(threading.Thread):
+    """Receives the pipeline's RTP packets into an AudioRing"""
+
+    def __init__(self, ring: AudioRing, port: int,
+                 host: str = "127.0.0.1"):
+        super(RtpReceiver, self).__init__(name="audio-ring", daemon=True)
+        self.ring = ring
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+
+    def run(self):
+        while True:
+            try:
+                datagram = self.socket.recv(2048)
+            except OSError:  # closed
+                return
+            self.ring.add(datagram)
+
+    def close(self):
+        """Stops receiving"""
+        self.socket.close()
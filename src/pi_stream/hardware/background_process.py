@@ -1,9 +1,16 @@
 """Controller for a background process such as janus or gstreamer"""
 
+import asyncio
 from enum import Enum
+import json
+import os
+import shutil
 import signal
+import threading
+import time
+import urllib.request
+
 from loguru import logger
-import sh
 
 
 class ProcessErrorCode(str, Enum):
@@ -15,9 +22,11 @@ class ProcessErrorCode(str, Enum):
     IN_RESTART_PROCESS = 'IN_RESTART_PROCESS'
 
     # stop attempted for a process that stopped on its own
-    # (uncommon due to _done callback updating state)
     STOPPED_SELF = 'STOPPED_SELF'
 
+    # process could not be spawned
+    START_ERROR = 'START_ERROR'
+
 
 class ProcessState(str, Enum):
     """Service State Labels"""
@@ -28,6 +37,222 @@ class ProcessState(str, Enum):
     RESTARTING = 'RESTARTING'
 
 
+class CommandNotFound(FileNotFoundError):
+    """Raised when a command is not on the PATH"""
+
+
+class RestartPolicy:
+    """Exponential-backoff policy for restarting a process that exited on
+    its own (or was killed for failing its health check)"""
+
+    def __init__(self,
+                 initial_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 factor: float = 2.0,
+                 max_restarts: int = None,
+                 reset_after: float = 60.0):
+        """
+        Args:
+            initial_delay (float): seconds before the first restart
+            max_delay (float): upper bound on the delay between restarts
+            factor (float): delay multiplier for each consecutive restart
+            max_restarts (int): consecutive restarts before giving up
+                (None for no limit)
+            reset_after (float): seconds a process must stay up for the
+                backoff to reset
+        """
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.max_restarts = max_restarts
+        self.reset_after = reset_after
+
+    def delay(self, attempt: int) -> float:
+        """Delay before restart number 'attempt' (starting at 0)"""
+        return min(self.initial_delay * self.factor ** attempt, self.max_delay)
+
+    def allows(self, attempt: int) -> bool:
+        """Whether restart number 'attempt' (starting at 0) is allowed"""
+        return self.max_restarts is None or attempt < self.max_restarts
+
+
+def janus_admin_ping(url: str = "http://127.0.0.1:7088/admin",
+                     secret: str = "janusoverlord",
+                     timeout: float = 2.0):
+    """Health check sending a 'ping' to the Janus admin/monitor API
+
+    Args:
+        url (str): admin API url (see janus.transport.http.jcfg)
+        secret (str): admin_secret (see janus.jcfg)
+        timeout (float): request timeout (seconds)
+    """
+    body = json.dumps({
+        "janus": "ping",
+        "transaction": "health",
+        "admin_secret": secret
+    }).encode("utf-8")
+
+    def ping() -> bool:
+        request = urllib.request.Request(url, data=body, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as resp:
+                return json.loads(resp.read()).get("janus") == "pong"
+        except (OSError, ValueError):
+            return False
+
+    async def check(process) -> bool:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, ping)
+
+    return check
+
+
+def output_watchdog(timeout: float = 15.0):
+    """Health check failing when a process has not written any output for
+    'timeout' seconds (e.g. gstreamer with a progressreport element)"""
+
+    async def check(process) -> bool:
+        return time.monotonic() - process.last_output < timeout
+
+    return check
+
+
+class LogRing:
+    """Fixed-size ring buffer of raw process output.
+
+    Output is stored as bytes exactly as read from the process; it is only
+    decoded and split into lines when it is read back with tail(), so
+    writing costs a single copy per chunk no matter how chatty the
+    process is.
+    """
+
+    def __init__(self, size: int = 64 * 1024):
+        """
+        Args:
+            size (int): capacity in bytes
+        """
+        self._buffer = bytearray(size)
+        self._size = size
+        self._pos = 0  # next write position
+        self._written = 0  # total bytes ever written
+        self._lock = threading.Lock()
+
+    def write(self, data: bytes):
+        """Appends output, overwriting the oldest output when full"""
+        with self._lock:
+            self._written += len(data)
+            if len(data) >= self._size:
+                self._buffer[:] = data[-self._size:]
+                self._pos = 0
+                return
+
+            first = min(len(data), self._size - self._pos)
+            self._buffer[self._pos:self._pos + first] = data[:first]
+            rest = len(data) - first
+            if rest:
+                self._buffer[:rest] = data[first:]
+            self._pos = (self._pos + len(data)) % self._size
+
+    def read(self) -> bytes:
+        """Gets the buffered output, oldest first"""
+        with self._lock:
+            if self._written < self._size:
+                return bytes(self._buffer[:self._pos])
+            return bytes(self._buffer[self._pos:] + self._buffer[:self._pos])
+
+    def tail(self, lines: int = 100) -> list:
+        """Gets the last lines of buffered output
+
+        Args:
+            lines (int): maximum number of lines
+
+        Returns:
+            list: lines (str), oldest first
+        """
+        data = self.read()
+        result = data.decode("utf-8", errors="replace").splitlines()
+        # the oldest line was (probably) partly overwritten
+        if self._written > self._size and result:
+            result = result[1:]
+        if lines <= 0:
+            return []
+        return result[-lines:]
+
+    @property
+    def written(self) -> int:
+        """total bytes written (including overwritten output)"""
+        return self._written
+
+    def clear(self):
+        """Discards all buffered output"""
+        with self._lock:
+            self._pos = 0
+            self._written = 0
+
+
+class LogForwarder:
+    """Forwards process output to the main log at a limited rate, so a
+    chatty process cannot flood the log (or the CPU)"""
+
+    def __init__(self, name: str, rate: float = 20.0, burst: int = 50):
+        """
+        Args:
+            name (str): prefix for forwarded lines
+            rate (float): lines per second
+            burst (int): lines that can be forwarded at once
+        """
+        self._name = name
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._partial = b""
+        self._dropped = 0
+
+    def write(self, data: bytes):
+        """Forwards the complete lines in a chunk of output"""
+        now = time.monotonic()
+        self._tokens = min(self._burst,
+                           self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        if len(self._partial) > 4096:  # never buffer unbounded output
+            lines.append(self._partial)
+            self._partial = b""
+
+        for line in lines:
+            if self._tokens < 1:
+                self._dropped += 1
+                continue
+            if self._dropped:
+                logger.debug(f"{self._name}: ({self._dropped} lines "
+                             f"not logged, see tail())")
+                self._dropped = 0
+            self._tokens -= 1
+            logger.debug(f"{self._name}: "
+                         f"{line.decode('utf-8', errors='replace')}")
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """Gets the event loop shared by all background processes, starting it
+    in a daemon thread on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever,
+                                      name="process-supervisor",
+                                      daemon=True)
+            thread.start()
+        return _loop
+
+
 class BackgroundProcess:
     """Controller for a background process such as janus or gstreamer"""
 
@@ -40,26 +265,113 @@ class BackgroundProcess:
         # case where stops on its own
         (ProcessState.STARTED, ProcessState.STOPPED),
 
+        # case where spawning fails
+        (ProcessState.STARTING, ProcessState.STOPPED),
+
         (ProcessState.STARTED, ProcessState.RESTARTING),  # restart part 1
         (ProcessState.RESTARTING, ProcessState.STARTED)   # restart part 2
     ]
 
+    # maximum bytes of output read at once
+    READ_SIZE = 16 * 1024
+
+    # signals sent by stop(), each followed by up to stop_timeout seconds
+    STOP_SIGNALS = [signal.SIGINT, signal.SIGTERM, signal.SIGKILL]
+
     def __init__(self,
                  command_name: str,
                  arguments: str = "",
-                 verbose: bool = False):
+                 verbose: bool = False,
+                 restart_policy: RestartPolicy = None,
+                 health_check=None,
+                 health_interval: float = 5.0,
+                 health_failures: int = 3,
+                 start_grace: float = 10.0,
+                 stop_timeout: float = 5.0,
+                 log_size: int = 64 * 1024,
+                 log_rate: float = 20.0,
+                 env: dict = None,
+                 cpus: set = None):
+        """
+        Args:
+            command_name (str): command on the PATH
+            arguments (str): default arguments
+            verbose (bool): forward process output to the main log
+            restart_policy (RestartPolicy): auto-restart policy
+                (None to never restart automatically)
+            health_check (coroutine function): liveness check called with
+                this object, returning False when unhealthy
+            health_interval (float): seconds between health checks
+            health_failures (int): consecutive failed checks before the
+                process is killed (and restarted if there is a policy)
+            start_grace (float): seconds after start before checks begin
+            stop_timeout (float): seconds to wait after each stop signal
+            log_size (int): bytes of output kept in memory (see tail())
+            log_rate (float): maximum lines per second forwarded to the
+                main log in verbose mode
+            env (dict): variables added to the process's environment
+            cpus (set): cores the process may run on (None: any)
+        """
+        path = shutil.which(command_name)
+        if path is None:
+            raise CommandNotFound(command_name)
+
         self._name = command_name
-        self._command = sh.Command(command_name)
+        self._path = path
         self._args = arguments.split()
         self._process = None
         self._state = ProcessState.STOPPED
         self._verbose = verbose
+        # called with (name, old state, new state) on state changes
+        self.listeners = []
+
+        self.restart_policy = restart_policy
+        self.health_check = health_check
+        self.health_interval = health_interval
+        self.health_failures = health_failures
+        self.start_grace = start_grace
+        self.stop_timeout = stop_timeout
+        self.env = env
+        self.cpus = cpus
+
+        self._loop = _event_loop()
+        self._supervisor = None  # task watching the current process
+        self._run_args = self._args  # arguments of the current run
+        self._on_output = None
+        self._log = LogRing(log_size)
+        self._forwarder = None
+        if verbose:
+            self._forwarder = LogForwarder(command_name, rate=log_rate)
+        self._stop_requested = False
+        self._stopped_self = False
+        self._exited = threading.Event()
+        self._exited.set()
+
+        # statistics
+        self.last_output = time.monotonic()
+        self._started_at = None
+        self._restarts = 0  # total automatic restarts
+        self._attempt = 0  # consecutive automatic restarts
+        self._last_exit_code = None
+        self._last_restart = None
+        self._next_restart = None
+        self._healthy = None
+        self._failed_checks = 0
 
     @property
     def state(self):
         """service state"""
         return self._state
 
+    @property
+    def arguments(self) -> str:
+        """default arguments (used by the next start without an override)"""
+        return " ".join(self._args)
+
+    @arguments.setter
+    def arguments(self, arguments: str):
+        self._args = arguments.split()
+
     @state.setter
     def state(self, new_state):
         transition = (self._state, new_state)
@@ -67,29 +379,27 @@ class BackgroundProcess:
             logger.info(f"{self._name}: {self._state} to {new_state}")
         else:
             logger.warning(f"\n{self._name}: {self._state} to {new_state}")
-        self._state = new_state
-
-    def start(self, arguments: str = None, restart: bool = False):
+        old_state, self._state = self._state, new_state
+        for listener in self.listeners:
+            listener(self._name, old_state, new_state)
+
+    def _run(self, coroutine, timeout: float = None):
+        """Runs a coroutine on the supervisor loop and waits for its result"""
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        return future.result(timeout)
+
+    def start(self,
+              arguments: str = None,
+              restart: bool = False,
+              on_output=None):
         """
         Starts process
 
         Args:
+            arguments (str): argument override for this run
             restart (bool): true if part of a restart for a process
+            on_output (callable): called with each chunk of output (bytes)
         """
-
-        def output(data):
-            """Callback for stdout from process"""
-            if self._verbose:
-                logger.debug(data)
-
-        def done(cmd, success, exit_code):
-            """Callback whenever a process exits"""
-            logger.info(f"{self._name} is_alive:{self._process.is_alive()}")
-            if success:
-                logger.success(f"Stopped {self._name} (exit code {exit_code})")
-                if self.state != ProcessState.RESTARTING:
-                    self.state = ProcessState.STOPPED
-
         acceptable_states = [ProcessState.STOPPED, ProcessState.RESTARTING]
 
         if self.state not in acceptable_states:
@@ -116,34 +426,219 @@ class BackgroundProcess:
 
         # check if argument override
         if arguments is not None:
-            # TODO: Done callback
-            self._process = self._command(*(arguments.split()),
-                                          _out=output,
-                                          _bg=True, _bg_exc=True,
-                                          _done=done)
+            self._run_args = arguments.split()
         else:
-            self._process = self._command(*(self._args),
-                                          _out=output,
-                                          _bg=True, _bg_exc=True,
-                                          _done=done)
+            self._run_args = self._args
+        self._on_output = on_output
+        self._attempt = 0
+        self._stopped_self = False
+
+        try:
+            self._run(self._spawn())
+        except OSError as exc:
+            logger.error(f"{self._name}: {exc}")
+            self.state = ProcessState.STOPPED
+            return {
+                "success": False,
+                "process_code": ProcessErrorCode.START_ERROR.value,
+                "process_state": self.state.value,
+                "error": str(exc)
+            }
 
-        logger.info(f"{self._name} PID:{self._process.pid}")
         logger.success(f"Started {self._name}")
-        self.state = ProcessState.STARTED
         return {
             "success": True,
             "process_code": ProcessErrorCode.SUCCESS.value,
             "process_state": self.state.value
         }
 
+    async def _spawn(self):
+        """Creates the subprocess and the tasks supervising it"""
+        self._stop_requested = False
+        self._exited.clear()
+        try:
+            self._process = await asyncio.create_subprocess_exec(
+                self._path, *self._run_args,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                env=dict(os.environ, **self.env) if self.env else None)
+        except OSError:
+            self._exited.set()
+            raise
+        self._started_at = time.monotonic()
+        self.last_output = self._started_at
+        self._healthy = None
+        self._failed_checks = 0
+        logger.info(f"{self._name} PID:{self._process.pid}")
+        if self.cpus:
+            try:
+                os.sched_setaffinity(self._process.pid, self.cpus)
+            except OSError as exc:
+                logger.warning(f"{self._name}: could not pin to {self.cpus}: "
+                               f"{exc}")
+
+        # set before the supervisor can observe an exit
+        self.state = ProcessState.STARTED
+        self._supervisor = asyncio.ensure_future(
+            self._supervise(self._process))
+
+    async def _supervise(self, process):
+        """Reads output, runs health checks and handles the exit of a
+        single run of the process"""
+        health = None
+        if self.health_check is not None:
+            health = asyncio.ensure_future(self._check_health(process))
+
+        await self._read_output(process)
+        exit_code = await process.wait()
+
+        if health is not None:
+            health.cancel()
+
+        self._last_exit_code = exit_code
+        uptime = time.monotonic() - self._started_at
+
+        if self._stop_requested:
+            logger.success(f"Stopped {self._name} (exit code {exit_code})")
+            if self.state == ProcessState.STOPPING:
+                self.state = ProcessState.STOPPED
+            self._exited.set()
+            return
+
+        # exited on its own
+        logger.warning(f"{self._name} exited on its own "
+                       f"(exit code {exit_code}, up {uptime:.1f} s)")
+        self._stopped_self = True
+        if self.state == ProcessState.STARTED:
+            self.state = ProcessState.STOPPED
+        self._exited.set()
+
+        policy = self.restart_policy
+        if policy is None:
+            return
+        if uptime >= policy.reset_after:
+            self._attempt = 0
+        if not policy.allows(self._attempt):
+            logger.error(f"{self._name}: giving up after "
+                         f"{self._attempt} restarts")
+            return
+
+        delay = policy.delay(self._attempt)
+        self._attempt += 1
+        self._next_restart = time.time() + delay
+        logger.info(f"Restarting {self._name} in {delay:.1f} s "
+                    f"(attempt {self._attempt})")
+        await asyncio.sleep(delay)
+        self._next_restart = None
+
+        # a manual start/stop may have happened while waiting
+        if self.state != ProcessState.STOPPED or not self._stopped_self:
+            return
+
+        self.state = ProcessState.STARTING
+        self._stopped_self = False
+        try:
+            await self._spawn()
+        except OSError as exc:
+            logger.error(f"{self._name}: {exc}")
+            self.state = ProcessState.STOPPED
+            return
+        self._restarts += 1
+        self._last_restart = time.time()
+        logger.success(f"Restarted {self._name}")
+
+    async def _read_output(self, process):
+        """Reads stdout/stderr into the log ring until the process closes it
+        (in chunks, lines are only split when the output is read back)"""
+        while True:
+            data = await process.stdout.read(self.READ_SIZE)
+            if not data:
+                break
+            self.last_output = time.monotonic()
+            self._log.write(data)
+            if self._forwarder is not None:
+                self._forwarder.write(data)
+            if self._on_output is not None:
+                self._on_output(data)
+
+    async def _check_health(self, process):
+        """Periodically runs the health check, killing the process after too
+        many consecutive failures"""
+        await asyncio.sleep(self.start_grace)
+        while process.returncode is None:
+            try:
+                healthy = await self.health_check(self)
+            except Exception as exc:
+                logger.debug(f"{self._name} health check error: {exc}")
+                healthy = False
+
+            self._healthy = healthy
+            if healthy:
+                self._failed_checks = 0
+            else:
+                self._failed_checks += 1
+                logger.warning(f"{self._name} failed health check "
+                               f"({self._failed_checks}/"
+                               f"{self.health_failures})")
+                if self._failed_checks >= self.health_failures:
+                    logger.error(f"{self._name} is unresponsive, killing")
+                    await self._terminate(process)
+                    return
+
+            await asyncio.sleep(self.health_interval)
+
+    async def _terminate(self, process) -> str:
+        """Sends SIGINT, then SIGTERM, then SIGKILL, waiting up to
+        stop_timeout after each one
+
+        Returns:
+            str: name of the signal that stopped the process
+        """
+        for sig in self.STOP_SIGNALS:
+            if process.returncode is not None:
+                break
+            try:
+                process.send_signal(sig)
+            except ProcessLookupError:
+                break
+            logger.info(f"{sig.name} sent to {self._name} "
+                        f"(waiting for cleanup)")
+            try:
+                await asyncio.wait_for(process.wait(), self.stop_timeout)
+                return sig.name
+            except asyncio.TimeoutError:
+                logger.warning(f"{self._name} did not stop after {sig.name}")
+        return None
+
+    async def _stop(self):
+        """Stops the current run and waits for the supervisor to finish"""
+        self._stop_requested = True
+        sig = await self._terminate(self._process)
+        await asyncio.wait_for(asyncio.shield(self._supervisor),
+                               self.stop_timeout)
+        return sig
+
     def stop(self, restart=False):
         """
-        Stops process started with the start() function
+        Stops process started with the start() function.
+        Escalates from SIGINT to SIGTERM to SIGKILL, so this is bounded by
+        3 * stop_timeout seconds.
 
         Args:
             restart (bool): true if part of a restart for a process
         """
 
+        # report processes that exited on their own (once)
+        if self.state == ProcessState.STOPPED and self._stopped_self:
+            self._stopped_self = False
+            logger.warning(f"{self._name}: already stopped on its own")
+            return {
+                "success": False,
+                "process_code": ProcessErrorCode.STOPPED_SELF.value,
+                "process_state": self.state.value,
+            }
+
         if self.state != ProcessState.STARTED:
             logger.warning(f"{self._name}: {self.state} (can't stop)")
             return {
@@ -159,45 +654,64 @@ class BackgroundProcess:
         else:
             self.state = ProcessState.STOPPING
 
+        sig = None
         try:
-            self._process.signal(signal.SIGINT)
-            logger.info(f"SIGINT sent to {self._name} (waiting for cleanup)")
-            self._process.wait()
-        except sh.SignalException as exc:
-            # sometimes triggers because of the SIGINT
-            logger.debug(exc)
-        except sh.ErrorReturnCode as exc:
-            # sometimes triggers because of the SIGINT
-            logger.debug(exc.stderr.decode("utf-8"))
-        except ProcessLookupError as exc:
-            self.state = ProcessState.STOPPED
-            logger.debug(exc)
-            return {
-                "success": False,
-                "process_code": ProcessErrorCode.STOPPED_SELF.value,
-                "process_state": self.state.value,
-            }
+            sig = self._run(self._stop())
+        except asyncio.TimeoutError:
+            logger.error(f"{self._name}: supervisor did not finish")
+            if self.state == ProcessState.STOPPING:
+                self.state = ProcessState.STOPPED
 
         return {
             "success": True,
             "process_code": ProcessErrorCode.SUCCESS.value,
-            "process_state": self.state.value
+            "process_state": self.state.value,
+            "signal": sig
         }
 
     def status(self) -> dict:
         """Gets status of process"""
+        restart = {
+            "restarts": self._restarts,
+            "consecutive_restarts": self._attempt,
+            "last_restart": self._last_restart,
+            "next_restart": self._next_restart,
+            "last_exit_code": self._last_exit_code,
+        }
         if self._process is None:
             return {
                 "name": self._name,
                 "process_state": self.state.value,
+                "restart": restart
             }
+
+        is_alive = self._process.returncode is None
+        uptime = None
+        if is_alive:
+            uptime = round(time.monotonic() - self._started_at, 3)
         return {
             "name": self._name,
             "process_state": self.state.value,
             "pid": self._process.pid,
-            "is_alive": self._process.is_alive()
+            "is_alive": is_alive,
+            "uptime": uptime,
+            "healthy": self._healthy,
+            "restart": restart
+        }
+
+    def tail(self, lines: int = 100) -> dict:
+        """Gets the last lines of output (stdout and stderr)
+
+        Args:
+            lines (int): maximum number of lines
+        """
+        return {
+            "name": self._name,
+            "process_state": self.state.value,
+            "bytes_written": self._log.written,
+            "lines": self._log.tail(lines)
         }
 
-    def wait(self):
-        """calls wait() on the process (for testing)"""
-        self._process.wait()
+    def wait(self, timeout: float = None):
+        """waits for the process to exit (for testing)"""
+        self._exited.wait(timeout)
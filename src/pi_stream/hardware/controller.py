@@ -1,24 +1,34 @@
 """Hardware Controller"""
 
 # builtin
+import collections
 import datetime
 from enum import Enum
 import os
+import re
+import threading
 import time
+import uuid
 
 # pip
-import cv2
 from loguru import logger
-import numpy as np
-import sh
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
-from usb.core import find as findusb
 
 # custom
-from fast_screenshot_reader import FastScreenshotReader
+from audio import AUDIO_PROFILES, AudioRing, LatencyMonitor, LevelMonitor
+from audio import audio_pipeline
+from background_process import ProcessState
 from util import force_stop, force_exists, video_length
-from recording import Recording
+from util import alsa_ready, find_usb_sysfs, v4l2_ready
+from recording_monitor import RecordingMonitor
+from tracing import tracer
+
+# cv2, numpy, sh, sqlalchemy (recording) and usb take seconds to import on
+# a Pi, so they are imported by the methods that use them instead of at
+# startup
+
+# seconds a warm screenshot waits for a frame before the device is reopened
+# (see screenshot)
+WARM_FRAME_TIMEOUT = 2.0
 
 
 class ControllerErrorCode(str, Enum):
@@ -30,6 +40,12 @@ class ControllerErrorCode(str, Enum):
     INVALID_PROCESS = 'INVALID_PROCESS'
     INVALID_FORMAT = 'INVALID_FORMAT'
     INVALID_FILENAME = 'INVALID_FILENAME'
+    INVALID_COUNT = 'INVALID_COUNT'
+    INVALID_FRAME = 'INVALID_FRAME'
+    INVALID_TEMPLATE = 'INVALID_TEMPLATE'
+    INVALID_INTERVAL = 'INVALID_INTERVAL'
+
+    DEADLINE_EXCEEDED = 'DEADLINE_EXCEEDED'  # see scheduler.py
 
     COMMAND_ERROR = 'COMMAND_ERROR'  # sh library error
     DEVICE_ERROR = 'DEVICE_ERROR'  # v4l2/alsa device error
@@ -42,6 +58,7 @@ class ControllerState(str, Enum):
     SCREENSHOT = 'SCREENSHOT'
     FAST_SCREENSHOT = 'FAST_SCREENSHOT'
     RECORDING = 'RECORDING'
+    TIMELAPSE = 'TIMELAPSE'
     RESET_USB = 'RESET_USB'
 
 
@@ -56,9 +73,36 @@ class Controller:
         (ControllerState.IDLE, ControllerState.FAST_SCREENSHOT),
         (ControllerState.FAST_SCREENSHOT, ControllerState.IDLE),
         (ControllerState.IDLE, ControllerState.RECORDING),
-        (ControllerState.RECORDING, ControllerState.IDLE)
+        (ControllerState.RECORDING, ControllerState.IDLE),
+        (ControllerState.IDLE, ControllerState.TIMELAPSE),
+        (ControllerState.TIMELAPSE, ControllerState.IDLE)
     ]
 
+    # methods that do not change the state and may run while an operation
+    # is in progress (the others are queued, see scheduler.py)
+    CONCURRENT_METHODS = {
+        "get_snapshot", "status_janus", "status_gstreamer",
+        "force_exists_janus", "force_exists_gstreamer",
+        "get_audio_profile", "audio_clip", "get_audio_level", "tail_logs",
+        "get_format", "get_capabilities",
+        "fast_screenshot", "fast_screenshot_burst",
+        "fast_screenshot_wait_change",
+        "template_upload", "template_delete", "template_list",
+        "template_match",
+        "recording_status", "recordings_list", "usb_status",
+        "timelapse_status"
+    }
+
+    # queue priorities of operations (default: scheduler.NORMAL = 1)
+    PRIORITIES = {
+        "force_stop_janus": 0,
+        "force_stop_gstreamer": 0,
+        "recording_stop": 0,
+        "timelapse_stop": 0,
+        "fast_screenshot_mode_stop": 0,
+        "reset_usb": 2
+    }
+
     def __init__(self, janus, gstreamer, ffmpeg, settings):
         self.janus = janus
         self.gstreamer = gstreamer
@@ -66,18 +110,63 @@ class Controller:
         self.settings = settings
 
         self._state = ControllerState.IDLE
+        # queue of this device's operations (see scheduler.py), set by the
+        # hardware service (None: internal operations run directly)
+        self.scheduler = None
 
         self.fast_ss_thread = None
-
-        # recording database
-        db_path = f"{settings.recording_files_dir}/db.db"
-        engine = create_engine(f"sqlite:///{db_path}")
-        if not os.path.exists(db_path):
-            Base = declarative_base()
-            Base.metadata.create_all(bind=engine, tables=[Recording.__table__])
-        Session = sessionmaker(bind=engine)
-        self.session = Session()
+        # capture kept open after a screenshot (see screenshot, _cool_down)
+        self._warm = None
+        self._warm_lock = threading.RLock()
+        self._capabilities = None  # cached v4l2 formats (get_capabilities)
+        self._usb_reset_thread = None
+        self._usb_reset = None  # result of the last USB reset
+        self._format = None  # last format read by get_format
+
+        # state snapshot (see snapshot()), listeners are called on changes
+        self.listeners = []
+        self._instance = uuid.uuid4().hex[:8]
+        self._version = 0
+        self._transitions = collections.deque(maxlen=32)
+        for process in [janus, gstreamer, ffmpeg]:
+            process.listeners.append(self._transition)
+
+        # recording database (opened on first use, see catalog)
+        self._catalog = None
+
+        # uploaded template images (see template_upload)
+        self._templates = None
+
+        # audio pipeline profile (see set_audio_profile)
+        self.audio_profile = settings.audio_profile
+        self.audio_latency = LatencyMonitor()
+        self.audio_level = LevelMonitor(settings.audio_silence_level)
+        # filled by an RtpReceiver (see xmlrpc_server.py)
+        self.audio_ring = AudioRing(settings.audio_ring_seconds)
+        self._audio_latencies = {}  # latency stats of previous profiles
         self.current_recording = None
+        self.recording_monitor = None
+
+        # timelapse capture thread and its recordings (one per part)
+        self.timelapse = None
+        self.timelapse_recordings = []
+
+    @property
+    def catalog(self):
+        """recording database (created/migrated on first use)"""
+        if self._catalog is None:
+            from recording import Catalog
+            db_path = f"{self.settings.recording_files_dir}/db.db"
+            self._catalog = Catalog(db_path)
+        return self._catalog
+
+    @property
+    def templates(self):
+        """template matching images (created on first use)"""
+        if self._templates is None:
+            from templates import TemplateStore
+            self._templates = TemplateStore()
+        return self._templates
 
     @property
     def state(self):
@@ -91,10 +180,80 @@ class Controller:
             logger.info(f"Controller: {self._state} to {new_state}")
         else:
             logger.warning(f"\nController: {self._state} to {new_state}")
-        self._state = new_state
+        old_state, self._state = self._state, new_state
+        self._transition("controller", old_state, new_state)
+
+    def _transition(self, source: str, old_state, new_state):
+        """Records a controller or process state transition"""
+        self._transitions.append({
+            "version": self._version + 1,  # version after _changed()
+            "timestamp": time.time(),
+            "source": source,
+            "from": old_state.value,
+            "to": new_state.value
+        })
+        self._changed()
+
+    def _changed(self):
+        """Bumps the snapshot version and notifies listeners"""
+        self._version += 1
+        for listener in self.listeners:
+            listener()
+
+    def snapshot(self) -> dict:
+        """Gets a versioned snapshot of the controller state, process
+        states, current format and recording progress.
+        (instance, version) changes whenever any of these change."""
+        # (read once: called from other threads while operations run)
+        state = self.state
+        current, monitor = self.current_recording, self.recording_monitor
+        timelapse = self.timelapse
+        timelapse_recordings = self.timelapse_recordings
+        recording = None
+        if state == ControllerState.RECORDING and current is not None \
+                and monitor is not None:
+            recording = {
+                "path": current.path,
+                "name": current.name,
+                "length": current.length,
+                "stats": monitor.stats()
+            }
+        elif state == ControllerState.TIMELAPSE and timelapse is not None \
+                and timelapse_recordings:
+            recording = {
+                "path": timelapse.path,
+                "name": timelapse_recordings[0].name,
+                "interval": timelapse.interval,
+                "stats": timelapse.stats()
+            }
+
+        return {
+            "instance": self._instance,
+            "version": self._version,
+            "timestamp": time.time(),
+            "controller_state": state.value,
+            "janus": self.janus.status(),
+            "gstreamer": self.gstreamer.status(),
+            "ffmpeg": self.ffmpeg.status(),
+            "format": self._format,
+            "recording": recording,
+            "usb_reset": self._usb_reset,
+            "screenshot_warm": self._warm is not None,
+            "audio_profile": self.audio_profile,
+            "transitions": list(self._transitions)
+        }
+
+    def get_snapshot(self) -> dict:
+        """Gets the state snapshot (see snapshot())"""
+        result = self.snapshot()
+        result["success"] = True
+        return result
 
     # Janus
     def start_janus(self, restart=False) -> dict:
+        self._cool_down()
+        self._await_usb_reset()  # device must be back from a reset
+
         if self.state != ControllerState.IDLE:
             return {
                 "success": False,
@@ -102,7 +261,8 @@ class Controller:
                 "controller_state": self.state.value
             }
 
-        result = self.janus.start(restart=restart)
+        with tracer.span("janus.start"):
+            result = self.janus.start(restart=restart)
         if (result["success"]):
             self.state = ControllerState.STREAM
         result["controller_state"] = self.state.value
@@ -117,8 +277,13 @@ class Controller:
                 "controller_state": self.state.value
             }
 
-        result = self.janus.stop(restart=restart)
-        if (result["success"]):
+        with tracer.span("janus.stop"):
+            result = self.janus.stop(restart=restart)
+
+        # janus exited on its own (and was not auto-restarted)
+        stopped_self = self.janus.state == ProcessState.STOPPED
+
+        if (result["success"] or stopped_self):
             self.state = ControllerState.IDLE
         result["controller_state"] = self.state.value
         result["controller_code"] = ControllerErrorCode.SUCCESS.value
@@ -129,7 +294,8 @@ class Controller:
         return result
 
     def force_stop_janus(self) -> dict:
-        result = force_stop("janus")
+        # (only this device's janus, not those of other devices)
+        result = force_stop("janus", arguments=self.janus.arguments)
         if result["success"]:
             self.state = ControllerState.IDLE
         return result
@@ -139,28 +305,159 @@ class Controller:
 
     # Gstreamer
     def start_gstreamer(self, restart=False) -> dict:
-        return self.gstreamer.start(restart=restart)
+        with tracer.span("gstreamer.start"):
+            return self.gstreamer.start(restart=restart,
+                                        on_output=self._on_audio_output)
+
+    def _on_audio_output(self, data: bytes):
+        """Parses gstreamer output for latency and level measurements"""
+        self.audio_latency.feed(data)
+        self.audio_level.feed(data)
 
     def stop_gstreamer(self, restart=False) -> dict:
-        return self.gstreamer.stop(restart=restart)
+        with tracer.span("gstreamer.stop"):
+            return self.gstreamer.stop(restart=restart)
 
     def force_exists_gstreamer(self) -> dict:
         return force_exists("gst-launch-1.0")
 
     def force_stop_gstreamer(self) -> dict:
-        return force_stop("gst-launch-1.0")
+        return force_stop("gst-launch-1.0",
+                          arguments=self.gstreamer.arguments)
 
     def status_gstreamer(self) -> dict:
         return self.gstreamer.status()
 
+    def set_audio_profile(self, profile: str) -> dict:
+        """Changes the audio pipeline profile, restarting gstreamer if it
+        is running
+
+        Args:
+            profile (str): default, low-latency, high-quality or
+                low-bandwidth"""
+        if profile not in AUDIO_PROFILES:
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.INVALID_FORMAT.value
+            }
+
+        # keep (and log) the latency measured with the previous profile
+        latency = self.audio_latency.stats()
+        if latency["count"]:
+            self._audio_latencies[self.audio_profile] = latency
+            logger.info(f"audio: {self.audio_profile} latency "
+                        f"mean {latency['mean']:.1f} ms, "
+                        f"p95 {latency['p95']:.1f} ms "
+                        f"({latency['count']} buffers)")
+
+        ring_port = 0
+        if self.settings.audio_ring_seconds:
+            ring_port = self.settings.audio_ring_port
+        self.gstreamer.arguments = audio_pipeline(self.settings.alsa,
+                                                  AUDIO_PROFILES[profile],
+                                                  self.settings.audio_port,
+                                                  ring_port)
+        self.audio_profile = profile
+        self.audio_latency.reset()
+        self._changed()
+
+        result = {"success": True}
+        if self.gstreamer.state == ProcessState.STARTED:
+            result = self.stop_gstreamer(restart=True)
+            if result["success"]:
+                result = self.start_gstreamer(restart=True)
+
+        result["controller_state"] = self.state.value
+        result["controller_code"] = ControllerErrorCode.SUCCESS.value
+        result["profile"] = profile
+        result["previous_latency"] = latency
+        return result
+
+    def get_audio_profile(self) -> dict:
+        """Gets the audio profile, the available profiles and the pipeline
+        latency (ms) measured with each profile (requires
+        AUDIO_LATENCY_TRACE)"""
+        latencies = dict(self._audio_latencies)
+        latencies[self.audio_profile] = self.audio_latency.stats()
+        return {
+            "success": True,
+            "controller_state": self.state.value,
+            "controller_code": ControllerErrorCode.SUCCESS.value,
+            "profile": self.audio_profile,
+            "profiles": {name: profile._asdict()
+                         for name, profile in AUDIO_PROFILES.items()},
+            "latency": latencies
+        }
+
+    def audio_clip(self, seconds: float = 10.0) -> dict:
+        """Gets the most recent audio (as sent to Janus) as Ogg/Opus
+
+        Args:
+            seconds (float): clip length (at most AUDIO_RING_SECONDS)"""
+        data, duration = self.audio_ring.clip(seconds)
+        if duration == 0:
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.DEVICE_ERROR.value,
+                "error": "no audio received (is gstreamer running?)"
+            }
+        return {
+            "success": True,
+            "controller_state": self.state.value,
+            "controller_code": ControllerErrorCode.SUCCESS.value,
+            "data": data,
+            "duration": duration
+        }
+
+    def get_audio_level(self) -> dict:
+        """Gets the current audio RMS and peak levels (dBFS per channel)
+        and whether the source is silent"""
+        result = self.audio_level.stats()
+        result["success"] = result["age"] is not None
+        result["controller_state"] = self.state.value
+        result["controller_code"] = (ControllerErrorCode.SUCCESS.value
+                                     if result["success"] else
+                                     ControllerErrorCode.DEVICE_ERROR.value)
+        return result
+
+    # Logs
+    def tail_logs(self, name: str, lines: int = 100) -> dict:
+        """Gets the last lines of output of a background process
+
+        Args:
+            name (str): janus, gstreamer or ffmpeg
+            lines (int): maximum number of lines
+        """
+        processes = {
+            "janus": self.janus,
+            "gstreamer": self.gstreamer,
+            "ffmpeg": self.ffmpeg
+        }
+        if name not in processes:
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.INVALID_PROCESS.value
+            }
+
+        result = processes[name].tail(lines)
+        result["success"] = True
+        result["controller_state"] = self.state.value
+        result["controller_code"] = ControllerErrorCode.SUCCESS.value
+        return result
+
     # Format Video
     def get_format(self):
         """Gets the V4L2 video format. Runs 'v4l2-ctl -V' and 'v4l2-ctl -P'
+        on this controller's device
 
         Returns:
             dict: V4L2 format
         """
-        v4l2_ctl = sh.Command("v4l2-ctl")
+        import sh
+        v4l2_ctl = sh.Command("v4l2-ctl").bake("-d", self.settings.v4l2)
         try:
             # resolution status
             cmd = v4l2_ctl("-V")
@@ -185,6 +482,10 @@ class Controller:
             if len(keyval) == 2:
                 status_dict[keyval[0].strip()] = keyval[1].strip()
 
+        if status_dict != self._format:
+            self._format = status_dict
+            self._changed()
+
         return {
             "success": True,
             "controller_state": self.state.value,
@@ -192,12 +493,64 @@ class Controller:
             "status": status_dict
         }
 
+    def get_capabilities(self, refresh: bool = False) -> dict:
+        """Gets the formats supported by the capture device
+        (parsed from 'v4l2-ctl --list-formats-ext' once, then cached)
+
+        Args:
+            refresh (bool): query the device again
+
+        Returns:
+            dict: {pixelformat: {"WIDTHxHEIGHT": [fps, ...]}}
+        """
+        if self._capabilities is not None and not refresh:
+            return {
+                "success": True,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.SUCCESS.value,
+                "capabilities": self._capabilities
+            }
+
+        import sh
+        v4l2_ctl = sh.Command("v4l2-ctl")
+        try:
+            cmd = v4l2_ctl("-d", self.settings.v4l2, "--list-formats-ext")
+        except sh.ErrorReturnCode as exc:
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.COMMAND_ERROR.value,
+                "error": exc.stderr.decode("utf-8")
+            }
+
+        capabilities = {}
+        sizes = None
+        size = None
+        for line in cmd.stdout.decode("utf-8").split("\n"):
+            fmt = re.search(r"\[\d+\]: '(\w+)'", line)
+            if fmt:
+                sizes = capabilities.setdefault(fmt.group(1), {})
+                continue
+            res = re.search(r"Size: \w+ (\d+x\d+)", line)
+            if res and sizes is not None:
+                size = sizes.setdefault(res.group(1), [])
+                continue
+            fps = re.search(r"\(([\d.]+) fps\)", line)
+            if fps and size is not None:
+                size.append(float(fps.group(1)))
+
+        self._capabilities = capabilities
+        return self.get_capabilities()
+
     def set_format(self,
                    width: int,
                    height: int,
                    pixelformat: str,
                    fps: int) -> dict:
-        """Stops janus and sets the V4L2 video format
+        """Sets the V4L2 video format, restarting janus if it was running.
+        Steps that are not needed (unchanged resolution or framerate, USB
+        reset when not switching to 1080p) are skipped, and the time taken
+        by each step is reported.
 
         Args:
             width (int): video resolution width (example: 1920)
@@ -206,82 +559,225 @@ class Controller:
             fps (int): framerate (example: 30)
 
         Returns:
-            dict: V4L2 format
+            dict: V4L2 format and timings (seconds)
         """
+        self._cool_down()
+        self._await_usb_reset()  # device must be back from a reset
+
         acceptable_states = [ControllerState.IDLE, ControllerState.STREAM]
-        # if self.fast_ss_thread is not None:
         if self.state not in acceptable_states:
             return {
                 "success": False,
                 "controller_state": self.state.value,
-                "controller_code": ControllerErrorCode.INVALID_STATE
+                "controller_code": ControllerErrorCode.INVALID_STATE.value
             }
 
-        if self.state == ControllerState.STREAM:
-            stop_result = self.stop_janus()
+        timings = {}
+        total_start = time.perf_counter()
+
+        def timed(step: str, start: float):
+            timings[step] = round(time.perf_counter() - start, 4)
+
+        # validate against cached device capabilities before touching janus
+        start = time.perf_counter()
+        capabilities = self.get_capabilities()
+        timed("validate", start)
+        if capabilities["success"]:
+            sizes = capabilities["capabilities"].get(pixelformat, {})
+            rates = sizes.get(f"{width}x{height}")
+            if rates is None or (rates and float(fps) not in rates):
+                return {
+                    "success": False,
+                    "controller_state": self.state.value,
+                    "controller_code":
+                        ControllerErrorCode.INVALID_FORMAT.value,
+                    "capabilities": capabilities["capabilities"]
+                }
+
+        start = time.perf_counter()
+        current_result = self.get_format()
+        timed("get_format", start)
+        if not current_result["success"]:
+            return current_result
+        current = current_result["status"]
+        resolution = f"{width}/{height}"
+        resolution_changed = (
+            current.get("Width/Height") != resolution
+            or f"'{pixelformat}'" not in current.get("Pixel Format", ""))
+        fps_changed = not current.get("Frames per second", "") \
+            .startswith(f"{float(fps):.3f}")
+
+        if not resolution_changed and not fps_changed:
+            timings["total"] = round(time.perf_counter() - total_start, 4)
+            current_result["timings"] = timings
+            return current_result
+
+        # stop janus (as part of a restart) if necessary
+        restart_janus = self.state == ControllerState.STREAM
+        if restart_janus:
+            start = time.perf_counter()
+            stop_result = self.stop_janus(restart=True)
+            timed("stop_janus", start)
             if not stop_result["success"]:
                 stop_result["controller_state"] = self.state.value
                 return stop_result
 
-        v4l2_ctl = sh.Command("v4l2-ctl")
+        result = self._apply_format(width, height, pixelformat, fps,
+                                    resolution_changed, fps_changed, timings)
+
+        # restart janus even if the format could not be changed
+        if restart_janus:
+            start = time.perf_counter()
+            start_result = self.start_janus(restart=True)
+            timed("start_janus", start)
+            if not start_result["success"]:
+                start_result["timings"] = timings
+                return start_result
+
+        timings["total"] = round(time.perf_counter() - total_start, 4)
+        logger.info(f"Format switch timings: {timings}")
+        result["timings"] = timings
+        result["controller_state"] = self.state.value
+        return result
+
+    def _apply_format(self,
+                      width: int,
+                      height: int,
+                      pixelformat: str,
+                      fps: int,
+                      resolution_changed: bool,
+                      fps_changed: bool,
+                      timings: dict) -> dict:
+        """Runs the v4l2-ctl commands (and USB reset) for set_format"""
+        import sh
+        v4l2_ctl = sh.Command("v4l2-ctl").bake("-d", self.settings.v4l2)
+
         # Change resolution
-        try:
-            v4l2_ctl("-v",
-                     f"width={width},height={height},pixelformat={pixelformat}"
-                     )
-        except sh.ErrorReturnCode as exc:
-            return {
-                "success": False,
-                "controller_state": self.state.value,
-                "controller_code": ControllerErrorCode.COMMAND_ERROR.value,
-                "error": exc.stderr.decode("utf-8")
-            }
-        logger.success("Changed Resolution")
+        if resolution_changed:
+            start = time.perf_counter()
+            try:
+                v4l2_ctl("-v",
+                         f"width={width},height={height},"
+                         f"pixelformat={pixelformat}")
+            except sh.ErrorReturnCode as exc:
+                return {
+                    "success": False,
+                    "controller_state": self.state.value,
+                    "controller_code": ControllerErrorCode.COMMAND_ERROR.value,
+                    "error": exc.stderr.decode("utf-8")
+                }
+            timings["resolution"] = round(time.perf_counter() - start, 4)
+            logger.success("Changed Resolution")
 
-        status = self.get_format()  # get status
-        # prevent crash when switching to 1080p
-        if status["status"]["Width/Height"] == "1920/1080":
-            reset_result = self.reset_usb()
-            if not reset_result["success"]:
-                return reset_result
+            # prevent crash when switching to 1080p
+            if (width, height) == (1920, 1080):
+                start = time.perf_counter()
+                reset_result = self.reset_usb(wait=True)
+                timings["reset_usb"] = round(time.perf_counter() - start, 4)
+                if not reset_result["success"]:
+                    return reset_result
 
         # Change framerate
-        try:
-            v4l2_ctl("-p", str(fps))
-        except sh.ErrorReturnCode as exc:
-            return {
-                "success": False,
-                "controller_state": self.state.value,
-                "controller_code": ControllerErrorCode.COMMAND_ERROR.value,
-                "error": exc.stderr.decode("utf-8")
-            }
-        logger.success("Changed Framerate")
+        if fps_changed:
+            start = time.perf_counter()
+            try:
+                v4l2_ctl("-p", str(fps))
+            except sh.ErrorReturnCode as exc:
+                return {
+                    "success": False,
+                    "controller_state": self.state.value,
+                    "controller_code": ControllerErrorCode.COMMAND_ERROR.value,
+                    "error": exc.stderr.decode("utf-8")
+                }
+            timings["framerate"] = round(time.perf_counter() - start, 4)
+            logger.success("Changed Framerate")
 
+        start = time.perf_counter()
         status = self.get_format()  # get status
-
-        # self.start_janus(restart=True)  # restart webrtc
-
+        timings["get_format"] += round(time.perf_counter() - start, 4)
         return status
 
     # Screenshot
+    def _output_format_error(self, out_fmt: str, compression: str,
+                             process: str) -> str:
+        """Checks a screenshot output format (see raw.py)
+
+        Returns:
+            str: why it cannot be used (None if it can)
+        """
+        from raw import COMPRESSIONS, compression_available
+
+        if out_fmt not in ["jpg", "png", "raw", "native"]:
+            return f"unknown output format {out_fmt}"
+        if out_fmt == "native" and (process != "cv2" or
+                                    self.settings.capture_backend != "v4l2"):
+            return "native frames need the v4l2 capture backend (cv2)"
+        if compression not in COMPRESSIONS:
+            return f"unknown compression {compression}"
+        if not compression_available(compression):
+            return f"{compression} is not installed"
+        return None
+
     def screenshot(self,
                    process: str,
                    inp_fmt: str,
                    out_fmt: str,
                    width: int,
-                   height: int) -> dict:
+                   height: int,
+                   compression: str = "") -> dict:
         """Take a screenshot. WebRTC service must be STOPPED.
            See docs/screenshot.md for full explanation
+
+           After a cv2 screenshot the capture is kept open (warm) for
+           screenshot_warm_ttl seconds: the next screenshots in the same
+           formats and resolution are read from it. It is released (USB
+           reset, janus restarted if it was streaming) once idle for that
+           long, or as soon as another operation needs the device.
         Args:
             process (str): cv2 or ffmpeg
             inp_fmt (str): jpg or png
-            out_fmt (str): jpg or png
+            out_fmt (str): jpg, png, raw (BGR pixels) or native (as
+                captured, cv2 process with the v4l2 capture backend)
             width (int): resolution width
             height (int): resolution height
+            compression (str, optional): of raw/native frames: "" or lz4
 
         Returns:
             dict: data
         """
+        key = (inp_fmt, out_fmt, width, height, compression)
+        resume_janus = False  # (janus was stopped by a previous screenshot)
+        if self._warm is not None:
+            if process == "cv2" and self._warm["key"] == key:
+                result = self._warm_screenshot()
+                if result is not None:
+                    return result
+                logger.warning("Warm capture failed, reopening the device")
+            resume_janus = self._cool_down()
+
+        result = self._capture_screenshot(process, inp_fmt, out_fmt, width,
+                                          height, compression, resume_janus)
+        if resume_janus and not result.get("warm"):
+            # janus was stopped by a previous screenshot, and this one is
+            # not kept warm
+            if result["success"]:
+                result["restart_janus"] = True  # (the API resets USB first)
+            else:
+                self.start_janus()
+                result["controller_state"] = self.state.value
+        return result
+
+    def _capture_screenshot(self, process: str, inp_fmt: str, out_fmt: str,
+                            width: int, height: int, compression: str,
+                            resume_janus: bool) -> dict:
+        """Takes a screenshot by opening the device (see screenshot)"""
+        import cv2
+        import numpy as np
+        from fast_screenshot_reader import capture_time, video_capture
+
+        key = (inp_fmt, out_fmt, width, height, compression)
+        self._await_usb_reset()  # device must be back from a reset
+
         # check valid state
         acceptable_states = [ControllerState.IDLE, ControllerState.STREAM]
         if self.state not in acceptable_states:
@@ -302,23 +798,30 @@ class Controller:
 
         # Check for valid format
         valid_formats = ["jpg", "png"]
-        if inp_fmt not in valid_formats or out_fmt not in valid_formats:
+        error = self._output_format_error(out_fmt, compression, process)
+        if inp_fmt not in valid_formats or error:
             return {
                 "success": False,
                 "controller_state": self.state.value,
-                "controller_code": ControllerErrorCode.INVALID_FORMAT.value
+                "controller_code": ControllerErrorCode.INVALID_FORMAT.value,
+                "error": error
             }
 
         # stop janus if necessary
-        if self.state == ControllerState.STREAM:
+        streaming = self.state == ControllerState.STREAM
+        if streaming:
             stop_result = self.stop_janus()
             if not stop_result["success"]:
                 stop_result["controller_state"] = self.state.value
                 return stop_result
 
         self.state = ControllerState.SCREENSHOT
+        keep_warm = process == "cv2" and self.settings.screenshot_warm_ttl > 0
 
-        filename = f"{self.settings.ss_dir}/ss.{out_fmt}"
+        raw = out_fmt in ["raw", "native"]
+        native = None  # (format, shape, bytes) as captured
+        # (ffmpeg writes raw screenshots as uncompressed bitmaps)
+        filename = f"{self.settings.ss_dir}/ss.{'bmp' if raw else out_fmt}"
 
         # CV2
         if process == "cv2":
@@ -349,13 +852,19 @@ class Controller:
             start_time = time.time()  # timestamp
 
             # cv2 config
-            cam = cv2.VideoCapture()
-            cam.open(self.settings.v4l2)
-            cam.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*inp_fmt))
-            cam.set(cv2.CAP_PROP_FRAME_WIDTH, width)
-            cam.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+            with tracer.span("device.open",
+                             backend=self.settings.capture_backend):
+                cam = video_capture(self.settings.capture_backend)
+                cam.open(self.settings.v4l2)
+                cam.set(cv2.CAP_PROP_FOURCC,
+                        cv2.VideoWriter_fourcc(*inp_fmt))
+                cam.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+                cam.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+            if out_fmt == "native":
+                cam.keep_native = True
 
             if cam.isOpened():
+                warmup_start = time.time()
                 iframe = cam.read()[1]  # read first frame
                 ref = get_bar_pixels(iframe)  # get first test pixels
 
@@ -373,11 +882,19 @@ class Controller:
                     logger.debug(error)
 
                     if error > TOLERANCE:
-                        cv2.imwrite(filename, frame)
+                        captured = capture_time(cam)
+                        if raw:
+                            native = getattr(cam, "native", None)
+                        else:
+                            cv2.imwrite(filename, frame)
                         still_looking = False
                         break
 
-                cam.release()
+                tracer.record("warmup", warmup_start,
+                              (time.time() - warmup_start) * 1000,
+                              frames=count)
+                if not keep_warm:
+                    cam.release()
                 dt = time.time() - start_time
                 logger.debug(f"Screenshot found in {count} frames, {dt} s")
             else:
@@ -393,11 +910,13 @@ class Controller:
         else:
             DELAY = 3
 
+            import sh
             ffmpeg = sh.Command("ffmpeg")
 
             # parse parameters
             inp_fmt = "mjpeg" if inp_fmt == "jpg" else "yuyv422"
 
+            ffmpeg_start = time.time()
             try:
                 result = ffmpeg(
                     "-hide_banner", "-y",
@@ -418,33 +937,176 @@ class Controller:
                     "controller_code": ControllerErrorCode.COMMAND_ERROR.value,
                     "error": exc.stderr.decode("utf-8")
                 }
+            captured = time.monotonic()  # (approximately, last frame)
+            tracer.record("ffmpeg.capture", ffmpeg_start,
+                          (time.time() - ffmpeg_start) * 1000)
 
         logger.success(f"{process}: {inp_fmt} -> {out_fmt} {width}x{height}")
 
-        img = cv2.imread(filename)
-
-        self.state = ControllerState.IDLE
+        start = time.monotonic()
+        if raw:
+            from raw import pack
+            if native is not None:
+                fmt, shape, native_data = native
+                data = pack(native_data, fmt, shape, compression)
+            else:
+                img = frame if process == "cv2" else cv2.imread(filename)
+                data = pack(img, "BGR", compression=compression)
+        else:
+            img = cv2.imread(filename)
+            data = cv2.imencode(f".{out_fmt}", img)[1].tobytes()
+        served = time.monotonic()
+        tracer.record("encode", time.time() - (served - start),
+                      (served - start) * 1000, format=out_fmt)
+
+        if keep_warm:
+            self._keep_warm(cam, key, streaming or resume_janus)
+        else:
+            self.state = ControllerState.IDLE
         return {
             "success": True,
             "controller_state": self.state.value,
             "controller_code": ControllerErrorCode.SUCCESS.value,
-            "data": cv2.imencode(f".{out_fmt}", img)[1].tobytes()
+            "data": data,
+            "format": out_fmt,
+            "captured": captured,
+            "encode_ms": (served - start) * 1000,
+            "served": served,
+            "warm": keep_warm,  # capture still open (no USB reset needed)
+            "reused": False
         }
 
+    def _keep_warm(self, cam, key: tuple, streaming: bool):
+        """Keeps reading a screenshot's capture device in a fast screenshot
+        thread, for the next screenshots (see screenshot)
+
+        Args:
+            cam (cv2.VideoCapture): opened and configured device
+            key (tuple): inp_fmt, out_fmt, width, height, compression
+            streaming (bool): janus was streaming before the screenshot
+        """
+        from fast_screenshot_reader import FastScreenshotReader
+
+        inp_fmt, out_fmt, width, height, compression = key
+        if out_fmt == "native":
+            cam.keep_native = False  # (kept only when a frame is requested)
+        ttl = self.settings.screenshot_warm_ttl
+        with self._warm_lock:
+            self.fast_ss_thread = FastScreenshotReader(
+                inp_fmt, out_fmt, width, height, self.settings.v4l2,
+                compression=compression, cpu=self.settings.cpu, cam=cam)
+            self.fast_ss_thread.start()
+            self.state = ControllerState.FAST_SCREENSHOT
+            self._warm = {
+                "key": key,
+                "expires": time.monotonic() + ttl,
+                "restart_janus": streaming
+            }
+            self._expire_warm_in(ttl)
+        logger.debug(f"Capture kept warm for {ttl} s")
+
+    def _expire_warm_in(self, delay: float):
+        timer = threading.Timer(delay, self._warm_expired)
+        timer.name = "screenshot-warm"
+        timer.daemon = True
+        timer.start()
+
+    def _warm_expired(self):
+        # (queued with the device's other operations, not run on the timer
+        # thread)
+        if self.scheduler is None:
+            self._release_warm()
+        else:
+            self.scheduler.submit("release_warm", self._release_warm,
+                                  priority=2)  # (scheduler.LOW)
+
+    def _release_warm(self):
+        """Releases the warm capture once idle for its TTL"""
+        with self._warm_lock:
+            if self._warm is None:
+                return
+            remaining = self._warm["expires"] - time.monotonic()
+            if remaining > 0:  # used since
+                self._expire_warm_in(remaining)
+                return
+            logger.info("Warm capture idle, releasing it")
+            self._cool_down(restore=True)
+
+    def _warm_screenshot(self) -> dict:
+        """Serves a screenshot from the warm capture (see screenshot)
+
+        Returns:
+            dict: result, None if the capture has no frame (in time)
+        """
+        with self._warm_lock:
+            reader = self.fast_ss_thread
+            if self._warm is None or reader is None \
+                    or not reader.is_alive():
+                return None
+            self._warm["expires"] = \
+                time.monotonic() + self.settings.screenshot_warm_ttl
+        # (not holding the lock: bounded like a cold capture's read)
+        with tracer.span("warm.frame"):
+            result = reader.get_frame(timeout=WARM_FRAME_TIMEOUT)
+        if not result["success"]:
+            return None
+        del result["sequence"]
+        result.update({
+            "controller_state": self.state.value,
+            "controller_code": ControllerErrorCode.SUCCESS.value,
+            "warm": True,
+            "reused": True
+        })
+        return result
+
+    def _cool_down(self, reset: bool = True, restore: bool = False) -> bool:
+        """Releases the capture kept warm after a screenshot, if any
+
+        Args:
+            reset (bool, optional): reset USB (as after any screenshot)
+            restore (bool, optional): restart janus if it was streaming
+                before the screenshot
+
+        Returns:
+            bool: janus was streaming before the screenshot (and was not
+                restarted)
+        """
+        with self._warm_lock:
+            warm, self._warm = self._warm, None
+            if warm is None:
+                return False
+            with tracer.span("cool_down"):
+                self.fast_ss_thread.stop()
+                # (state first: concurrent methods check it, then the thread)
+                self.state = ControllerState.IDLE
+                self.fast_ss_thread = None
+                if reset:
+                    self.reset_usb(wait=True)
+                if restore and warm["restart_janus"]:
+                    self.start_janus()
+                    return False
+            return warm["restart_janus"]
+
     def fast_screenshot_mode_start(self,
                                    inp_fmt: str,
                                    out_fmt: str,
                                    width: int,
-                                   height: int):
+                                   height: int,
+                                   compression: str = ""):
         """Stops Janus. Enters state where screenshots can be retrieved
         quicker than with the normal screenshot call.
         (Janus cannot be used while in this state)
 
         body:
             inp_fmt (str, optional): input format jpg or png (default: png)
-            out_fmt (str, optional): output format jpg or png (default: png)
+            out_fmt (str, optional): output format jpg, png, raw or native
+                (default: png)
             width (int, optional): resolution width (default: 1920)
-            height (int, optional): resolution height (default: 1080)"""
+            height (int, optional): resolution height (default: 1080)
+            compression (str, optional): of raw/native frames: "" or lz4"""
+
+        self._cool_down()
+        self._await_usb_reset()  # device must be back from a reset
 
         # check valid state
         acceptable_states = [ControllerState.IDLE, ControllerState.STREAM]
@@ -457,11 +1119,13 @@ class Controller:
 
         # Check for valid format
         valid_formats = ["jpg", "png"]
-        if inp_fmt not in valid_formats or out_fmt not in valid_formats:
+        error = self._output_format_error(out_fmt, compression, "cv2")
+        if inp_fmt not in valid_formats or error:
             return {
                 "success": False,
                 "controller_state": self.state.value,
-                "controller_code": ControllerErrorCode.INVALID_FORMAT.value
+                "controller_code": ControllerErrorCode.INVALID_FORMAT.value,
+                "error": error
             }
 
         # stop janus if necessary
@@ -473,8 +1137,10 @@ class Controller:
 
         self.state = ControllerState.FAST_SCREENSHOT
 
-        self.fast_ss_thread = FastScreenshotReader(inp_fmt, out_fmt,
-                                                   width, height)
+        from fast_screenshot_reader import FastScreenshotReader
+        self.fast_ss_thread = FastScreenshotReader(
+            inp_fmt, out_fmt, width, height, self.settings.v4l2,
+            self.settings.capture_backend, compression, self.settings.cpu)
         self.fast_ss_thread.start()
 
         return {
@@ -485,6 +1151,14 @@ class Controller:
 
     def fast_screenshot_mode_stop(self):
         """Exits fast screenshot mode"""
+        if self._warm is not None:
+            # (the API resets USB after exiting fast screenshot mode)
+            self._cool_down(reset=False)
+            return {
+                "success": True,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.SUCCESS.value
+            }
 
         # check valid state
         acceptable_states = [ControllerState.FAST_SCREENSHOT]
@@ -498,8 +1172,8 @@ class Controller:
 
         result = self.fast_ss_thread.stop()
         if result["success"]:
-            self.fast_ss_thread = None
             self.state = ControllerState.IDLE
+            self.fast_ss_thread = None
             result["controller_code"] = ControllerErrorCode.SUCCESS.value
         else:
             result["controller_code"] = ControllerErrorCode.THREAD_ERROR.value
@@ -511,16 +1185,186 @@ class Controller:
         """Takes a screenshot while in fast screenshot mode.
         Should be quicker than the normal screenshot method"""
 
-        # check valid state
+        # check valid state (the thread is read once, the mode may end
+        # while this runs)
+        reader = self.fast_ss_thread
         acceptable_states = [ControllerState.FAST_SCREENSHOT]
-        if self.state not in acceptable_states:
+        if self.state not in acceptable_states or reader is None:
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.INVALID_STATE.value
+            }
+
+        result = reader.get_frame()
+        if not result["success"]:
+            result["controller_state"] = self.state.value
+            result["controller_code"] = ControllerErrorCode.THREAD_ERROR.value
+        return result
+
+    def fast_screenshot_burst(self, count: int, interval: float = 0.0):
+        """Captures a sequence of frames while in fast screenshot mode,
+        without missing frames between them
+
+        Args:
+            count (int): number of frames (1 to burst_max_frames)
+            interval (float, optional): minimum seconds between frames
+                (default: 0, every frame)"""
+
+        # check valid state (the thread is read once, the mode may end
+        # while this runs)
+        reader = self.fast_ss_thread
+        acceptable_states = [ControllerState.FAST_SCREENSHOT]
+        if self.state not in acceptable_states or reader is None:
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.INVALID_STATE.value
+            }
+
+        # frames are buffered raw (~6 MB each at 1080p)
+        if not 1 <= count <= self.settings.burst_max_frames or interval < 0:
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.INVALID_COUNT.value
+            }
+
+        # capture for as long as the frames should take, plus a margin
+        timeout = 5.0 + count * max(interval, 0.1)
+        result = reader.get_burst(count, interval, timeout)
+        result["controller_state"] = self.state.value
+        if result["success"]:
+            result["controller_code"] = ControllerErrorCode.SUCCESS.value
+        else:
+            result["controller_code"] = ControllerErrorCode.THREAD_ERROR.value
+        return result
+
+    def fast_screenshot_wait_change(self,
+                                    sequence: int = None,
+                                    threshold: float = 0.01,
+                                    roi: list = None,
+                                    timeout: float = 10.0):
+        """Waits (while in fast screenshot mode) until the captured frame
+        differs from a reference frame, returning the changed frame and the
+        bounding box of the change
+
+        Args:
+            sequence (int, optional): reference frame number (default: the
+                frame at call time)
+            threshold (float, optional): fraction of pixels that must change
+                (default: 0.01)
+            roi (list, optional): x, y, width, height to watch
+            timeout (float, optional): seconds to wait (default: 10)"""
+
+        # check valid state (the thread is read once, the mode may end
+        # while this runs)
+        reader = self.fast_ss_thread
+        acceptable_states = [ControllerState.FAST_SCREENSHOT]
+        if self.state not in acceptable_states or reader is None:
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.INVALID_STATE.value
+            }
+
+        result = reader.wait_for_change(sequence, threshold, roi, timeout)
+        result["controller_state"] = self.state.value
+        if result["success"]:
+            result["controller_code"] = ControllerErrorCode.SUCCESS.value
+        else:
+            result["controller_code"] = ControllerErrorCode.INVALID_FRAME.value
+        return result
+
+    # Template matching
+    def template_upload(self, name: str, data: bytes):
+        """Adds (or replaces) a template image to match against frames in
+        fast screenshot mode
+
+        Args:
+            name (str): template name
+            data (bytes): png or jpg image"""
+        try:
+            template = self.templates.add(name, data)
+        except ValueError as exc:
+            logger.error(exc)
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.INVALID_FORMAT.value
+            }
+        return {
+            "success": True,
+            "controller_state": self.state.value,
+            "controller_code": ControllerErrorCode.SUCCESS.value,
+            "template": template.info()
+        }
+
+    def template_delete(self, name: str):
+        """Removes a template"""
+        success = self.templates.remove(name)
+        code = ControllerErrorCode.SUCCESS if success \
+            else ControllerErrorCode.INVALID_TEMPLATE
+        return {
+            "success": success,
+            "controller_state": self.state.value,
+            "controller_code": code.value
+        }
+
+    def template_list(self):
+        """Gets the uploaded templates"""
+        return {
+            "success": True,
+            "controller_state": self.state.value,
+            "controller_code": ControllerErrorCode.SUCCESS.value,
+            "templates": self.templates.list()
+        }
+
+    def template_match(self,
+                       name: str,
+                       threshold: float = 0.8,
+                       region: list = None,
+                       level: int = 1,
+                       timeout: float = 0.0):
+        """Finds a template in the captured frame (fast screenshot mode),
+        optionally waiting until it matches
+
+        Args:
+            name (str): template name
+            threshold (float, optional): minimum score (-1 to 1) to count
+                as matched (default: 0.8)
+            region (list, optional): x, y, width, height to search
+            level (int, optional): resolution to match at, 0 full, 1 half,
+                2 quarter (default: 1)
+            timeout (float, optional): seconds to wait for a match
+                (default: 0, match the current frame once)"""
+        from templates import LEVELS, wait_for_match
+
+        # check valid state (the thread is read once, the mode may end
+        # while this runs)
+        reader = self.fast_ss_thread
+        acceptable_states = [ControllerState.FAST_SCREENSHOT]
+        if self.state not in acceptable_states or reader is None:
             return {
                 "success": False,
                 "controller_state": self.state.value,
                 "controller_code": ControllerErrorCode.INVALID_STATE.value
             }
 
-        return self.fast_ss_thread.get_frame()
+        template = self.templates.get(name)
+        if template is None or not 0 <= level < LEVELS:
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.INVALID_TEMPLATE.value
+            }
+
+        result = wait_for_match(reader.next_frame, template,
+                                threshold, region, level, timeout)
+        result["success"] = True
+        result["controller_state"] = self.state.value
+        result["controller_code"] = ControllerErrorCode.SUCCESS.value
+        return result
 
     def recording_start(self,
                         width: int,
@@ -537,6 +1381,9 @@ class Controller:
             fps (int): framerate (example: 30)
             length (int): length (seconds)
         """
+        self._cool_down()
+        self._await_usb_reset()  # device must be back from a reset
+
         # check valid state
         acceptable_states = [ControllerState.IDLE]
         if self.state not in acceptable_states:
@@ -595,22 +1442,33 @@ class Controller:
                                 "-c:v", "h264_v4l2m2m",
                                 "-pix_fmt", "yuv420p",
                                 "-t", str(length),
+                                "-progress", "pipe:1", "-nostats",
                                 filename
                                 ])
 
-        result = self.ffmpeg.start(arguments=args_string)
+        monitor = RecordingMonitor()
+
+        def on_output(data):
+            """Parses ffmpeg progress, publishing it with the snapshot"""
+            monitor.feed(data)
+            self._changed()
+
+        with tracer.span("ffmpeg.start"):
+            result = self.ffmpeg.start(arguments=args_string,
+                                       on_output=on_output)
         if (result["success"]):
+            self.recording_monitor = monitor
             self.state = ControllerState.RECORDING
             result["filename"] = filename
 
             # add to database
             if name == "":
                 name = None
+            from recording import Recording
             self.current_recording = Recording(path=filename,
                                                length=length,
                                                name=name)
-            self.session.add(self.current_recording)
-            self.session.commit()
+            self.catalog.save(self.current_recording)
 
         result["controller_state"] = self.state.value
         result["controller_code"] = ControllerErrorCode.SUCCESS.value
@@ -626,25 +1484,221 @@ class Controller:
                 "controller_state": self.state.value
             }
 
-        result = None
-        try:
+        with tracer.span("ffmpeg.stop"):
             result = self.ffmpeg.stop()
-        except sh.ErrorReturnCode as exc:
-            logger.debug(exc.exit_code)
 
-        if (result["success"]):
+        # recording already reached its length and ffmpeg exited on its own
+        finished = self.ffmpeg.state == ProcessState.STOPPED
+
+        if (result["success"] or finished):
             self.state = ControllerState.IDLE
 
-            # update database length and size
+            # update database length, size and progress statistics
             path = self.current_recording.path
             self.current_recording.length = video_length(path)
             self.current_recording.size = os.path.getsize(path)
-            self.session.commit()
+            stats = self.recording_monitor.stats()
+            self.current_recording.fps = stats.get("fps")
+            self.current_recording.speed = stats.get("speed")
+            self.current_recording.bitrate = stats.get("bitrate_kbps")
+            self.current_recording.dup_frames = stats.get("dup_frames")
+            self.current_recording.drop_frames = stats.get("drop_frames")
+            self.catalog.save(self.current_recording)
+
+            result["success"] = True
+            result["stats"] = stats
 
         result["controller_state"] = self.state.value
         result["controller_code"] = ControllerErrorCode.SUCCESS.value
         return result
 
+    def recording_status(self):
+        """Gets live statistics (fps, speed, dup/drop counts, bitrate,
+        output size) of the current recording"""
+        if self.state != ControllerState.RECORDING:
+            return {
+                "success": False,
+                "controller_code": ControllerErrorCode.INVALID_STATE.value,
+                "controller_state": self.state.value
+            }
+
+        return {
+            "success": True,
+            "controller_code": ControllerErrorCode.SUCCESS.value,
+            "controller_state": self.state.value,
+            "path": self.current_recording.path,
+            "name": self.current_recording.name,
+            "length": self.current_recording.length,
+            "stats": self.recording_monitor.stats()
+        }
+
+    def timelapse_start(self,
+                        interval: float,
+                        width: int,
+                        height: int,
+                        inp_fmt: str = "jpg",
+                        length: float = 0,
+                        fps: float = 10.0,
+                        name: str = ""):
+        """Stops janus and captures a frame every interval seconds into an
+        MJPEG AVI file (see timelapse.py), registered as a recording
+
+        Args:
+            interval (float): seconds between frames
+            width (int): resolution width
+            height (int): resolution height
+            inp_fmt (str, optional): jpg (MJPEG, written as captured with
+                the v4l2 capture backend) or png (YUYV, encoded)
+            length (float, optional): seconds to capture for (0: until
+                timelapse_stop)
+            fps (float, optional): playback frame rate
+            name (str, optional): recording name
+        """
+        # (janus was stopped by a previous screenshot)
+        resume_janus = self._cool_down()
+        self._await_usb_reset()  # device must be back from a reset
+
+        # check valid state
+        acceptable_states = [ControllerState.IDLE, ControllerState.STREAM]
+        if self.state not in acceptable_states:
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.INVALID_STATE.value
+            }
+
+        if interval <= 0 or fps <= 0 or length < 0:
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.INVALID_INTERVAL.value
+            }
+
+        valid_formats = ["jpg", "png"]
+        if inp_fmt not in valid_formats:
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.INVALID_FORMAT.value
+            }
+
+        # stop janus if necessary
+        streaming = self.state == ControllerState.STREAM
+        if streaming:
+            stop_result = self.stop_janus()
+            if not stop_result["success"]:
+                stop_result["controller_state"] = self.state.value
+                return stop_result
+
+        import cv2
+        from fast_screenshot_reader import video_capture
+        from recording import Recording
+        from timelapse import Timelapse
+
+        with tracer.span("device.open",
+                         backend=self.settings.capture_backend):
+            cam = video_capture(self.settings.capture_backend)
+            cam.open(self.settings.v4l2)
+            cam.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(
+                *("MJPG" if inp_fmt == "jpg" else "YUYV")))
+            cam.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            cam.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+            # (fewer frames sent over USB between captures)
+            cam.set(cv2.CAP_PROP_FPS, self.settings.timelapse_capture_fps)
+        if not cam.isOpened():
+            logger.error("Video not opened")
+            cam.release()
+            if streaming or resume_janus:
+                self.start_janus()
+            return {
+                "success": False,
+                "controller_state": self.state.value,
+                "controller_code": ControllerErrorCode.DEVICE_ERROR.value
+            }
+
+        timestamp = datetime.datetime.now().isoformat()
+        d = self.settings.recording_files_dir
+        filename = f"{d}/Timelapse_{timestamp}.avi"
+        name = name or None
+
+        def on_part(path: str):
+            """Registers each further file (see timelapse.MAX_FILE_SIZE)"""
+            part = len(self.timelapse_recordings) + 1
+            recording = Recording(path=path, interval=interval, fps=fps,
+                                  name=f"{name} ({part})" if name else None)
+            self.timelapse_recordings.append(recording)
+            self.catalog.save(recording)
+
+        self.timelapse_recordings = [Recording(path=filename,
+                                               interval=interval, fps=fps,
+                                               name=name)]
+        self.catalog.save(self.timelapse_recordings[0])
+        self.timelapse = Timelapse(cam, filename, interval, length, fps,
+                                   self.settings.timelapse_quality,
+                                   self.settings.cpu, on_part)
+        self.timelapse.start()
+        self.state = ControllerState.TIMELAPSE
+
+        return {
+            "success": True,
+            "controller_state": self.state.value,
+            "controller_code": ControllerErrorCode.SUCCESS.value,
+            "filename": filename,
+            "passthrough": self.timelapse.passthrough
+        }
+
+    def timelapse_stop(self):
+        """Ends the timelapse (or, if it reached its length, updates its
+        recordings)"""
+        if self.state != ControllerState.TIMELAPSE:
+            return {
+                "success": False,
+                "controller_code": ControllerErrorCode.INVALID_STATE.value,
+                "controller_state": self.state.value
+            }
+
+        timelapse = self.timelapse
+        timelapse.stop()
+        stats = timelapse.stats()
+
+        # update database length (playback seconds) and size of each part
+        for recording, frames in zip(self.timelapse_recordings,
+                                     timelapse.part_frames):
+            recording.length = frames / timelapse.fps
+            if os.path.exists(recording.path):
+                recording.size = os.path.getsize(recording.path)
+            self.catalog.save(recording)
+
+        # (state first: timelapse_status checks it, then the timelapse)
+        self.state = ControllerState.IDLE
+        self.timelapse = None
+        return {
+            "success": stats["error"] is None,
+            "controller_state": self.state.value,
+            "controller_code": ControllerErrorCode.SUCCESS.value,
+            "stats": stats
+        }
+
+    def timelapse_status(self):
+        """Gets the progress of the timelapse: frames captured and skipped,
+        elapsed and CPU seconds (cpu_fraction: of one core), bytes written,
+        files"""
+        timelapse = self.timelapse  # (read once, may end while this runs)
+        if self.state != ControllerState.TIMELAPSE or timelapse is None:
+            return {
+                "success": False,
+                "controller_code": ControllerErrorCode.INVALID_STATE.value,
+                "controller_state": self.state.value
+            }
+
+        return {
+            "success": True,
+            "controller_code": ControllerErrorCode.SUCCESS.value,
+            "controller_state": self.state.value,
+            "interval": timelapse.interval,
+            "stats": timelapse.stats()
+        }
+
     def recording_delete(self, filename: str):
         """Deletes a recording
 
@@ -668,9 +1722,7 @@ class Controller:
         full_path = f"{self.settings.recording_files_dir}/{basename}{ext}"
 
         # try to delete from database
-        condition = Recording.path == full_path
-        result = self.session.query(Recording).filter(condition).delete()
-        if result == 0:
+        if self.catalog.delete(full_path) == 0:
             logger.warning(f"{full_path} not in database")
 
         # try to delete file
@@ -692,26 +1744,15 @@ class Controller:
         # files
         files = os.listdir(self.settings.recording_files_dir)
 
-        # database
-
-        # update sizes for those that do not have one
-        condition = Recording.size.is_(None)
-        for r in self.session.query(Recording).filter(condition):
-            r.size = os.path.getsize(r.path)
-        self.session.commit()
-
-        data = []
-        count = 0
-        for r in self.session.query(Recording):
-            data.append({
-                "id": r.id,
-                "path": r.path,
-                "length": r.length,
-                "size": r.size,
-                "timestamp": r.timestamp,
-                "name": r.name
-            })
-            count += 1
+        # database (read-only, does not wait for recordings being written)
+        data = self.catalog.recordings()
+
+        # update sizes for those that do not have one (queued, not waited)
+        for r in data:
+            if r["size"] is None and os.path.exists(r["path"]):
+                r["size"] = os.path.getsize(r["path"])
+                self.catalog.update(r["id"], {"size": r["size"]})
+        count = len(data)
 
         return {
             "success": True,
@@ -721,8 +1762,22 @@ class Controller:
         }
 
     # USB
-    def reset_usb(self):
-        """reset usb (ids come from 'lsusb' command)"""
+    def reset_usb(self, wait: bool = False):
+        """Resets the USB capture device (ids come from 'lsusb' command).
+        Returns as soon as the reset has been issued; the controller stays
+        in RESET_USB until the V4L2 and ALSA devices are back and answer a
+        format query (see usb_status)
+
+        Args:
+            wait (bool): wait until the device is ready before returning
+        """
+        self._cool_down(reset=False)  # (reset below)
+
+        # a reset is already in progress
+        if self.state == ControllerState.RESET_USB:
+            if wait:
+                self._await_usb_reset()
+            return self.usb_status()
 
         # check valid state
         acceptable_states = [ControllerState.IDLE]
@@ -733,33 +1788,111 @@ class Controller:
             }
         self.state = ControllerState.RESET_USB
 
-        DELAY = 2
-
         # conversions
         id_1 = int(self.settings.id_vendor, 16)
         id_2 = int(self.settings.id_product, 16)
 
         logger.info("Resetting USB...")
-        usb_device = findusb(idVendor=id_1, idProduct=id_2)
+        reset_start = time.monotonic()
+        reset_wall = time.time()
 
-        if not usb_device:
-            err = f"""Could not find USB device with id_vendor
-            {hex(id_1)} and id_product {hex(id_2)}.
-            Run 'lsusb' command to list USB devices."""
-            logger.error(err)
-            self.state = ControllerState.IDLE
-            return {
-                "success": False,
-                "controller_state": self.state.value,
-                "error": err
-            }
+        # preferred: de-authorize and re-authorize the device in sysfs
+        method = None
+        sysfs_path = find_usb_sysfs(id_1, id_2)
+        if sysfs_path is not None:
+            try:
+                for value in ["0", "1"]:
+                    with open(f"{sysfs_path}/authorized", "w") as f:
+                        f.write(value)
+                method = "sysfs"
+            except OSError as exc:
+                logger.debug(f"sysfs reset failed: {exc}")
+
+        # fallback: USBDEVFS_RESET through pyusb
+        if method is None:
+            from usb.core import find as findusb
+            usb_device = findusb(idVendor=id_1, idProduct=id_2)
+            if not usb_device:
+                err = f"""Could not find USB device with id_vendor
+                {hex(id_1)} and id_product {hex(id_2)}.
+                Run 'lsusb' command to list USB devices."""
+                logger.error(err)
+                self.state = ControllerState.IDLE
+                return {
+                    "success": False,
+                    "controller_state": self.state.value,
+                    "error": err
+                }
+            usb_device.reset()
+            method = "usbdevfs"
+
+        tracer.record("usb.reset", reset_wall,
+                      (time.monotonic() - reset_start) * 1000, method=method)
+        self._usb_reset = {
+            "method": method,
+            "ready": False,
+            "recovery_time": None
+        }
+        self._usb_reset_thread = threading.Thread(
+            target=self._recover_usb, args=(reset_start,),
+            name="usb-reset", daemon=True)
+        self._usb_reset_thread.start()
+
+        if wait:
+            self._await_usb_reset()
+
+        result = self.usb_status()
+        result["success"] = True
+        return result
 
+    def _recover_usb(self, reset_start: float):
+        """Polls until the capture device is usable again after a reset,
+        then returns the controller to IDLE"""
+        TIMEOUT = 10.0  # seconds
+        INTERVAL = 0.02  # seconds between polls
+        MIN_DOWN = 0.1  # seconds the old device may still be visible for
+
+        v4l2 = self.settings.v4l2
+        alsa = self.settings.alsa
+        deadline = reset_start + TIMEOUT
+        seen_down = False
+        ready = False
+        while time.monotonic() < deadline:
+            video_ready = v4l2_ready(v4l2)
+            audio_ready = alsa_ready(alsa)
+            if not video_ready or not audio_ready:
+                seen_down = True
+            elapsed = time.monotonic() - reset_start
+            if video_ready and audio_ready and \
+                    (seen_down or elapsed > MIN_DOWN):
+                ready = True
+                break
+            time.sleep(INTERVAL)
+
+        recovery_time = round(time.monotonic() - reset_start, 3)
+        self._usb_reset["ready"] = ready
+        self._usb_reset["recovery_time"] = recovery_time
+        if ready:
+            logger.success(f"USB has been reset ({recovery_time} s)")
         else:
-            usb_device.reset()
-            time.sleep(DELAY)  # prevent crash (may remove)
-            logger.success("USB has been reset")
-            self.state = ControllerState.IDLE
-            return {
-                "success": True,
-                "controller_state": self.state.value
-            }
+            logger.error(f"USB device not ready after {recovery_time} s "
+                         f"(v4l2 {v4l2}, alsa {alsa})")
+        self.state = ControllerState.IDLE
+
+    def _await_usb_reset(self, timeout: float = 15.0):
+        """Waits for a USB reset in progress to finish"""
+        thread = self._usb_reset_thread
+        if thread is not None and thread.is_alive():
+            with tracer.span("usb.await"):
+                thread.join(timeout)
+
+    def usb_status(self) -> dict:
+        """Gets the progress/result of the last USB reset
+        (method, ready, recovery_time in seconds)"""
+        in_progress = self.state == ControllerState.RESET_USB
+        return {
+            "success": True,
+            "controller_state": self.state.value,
+            "in_progress": in_progress,
+            "last_reset": self._usb_reset
+        }
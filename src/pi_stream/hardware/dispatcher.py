@@ -0,0 +1,149 @@
+"""Several capture devices served by one hardware service
+
+Each device has its own Controller (state machine, processes, capture
+thread, recordings). XML-RPC methods are addressed to a device by prefixing
+its id ("hdmi2.screenshot"); methods without a prefix go to the first
+(main) device, so single-device clients are unaffected.
+"""
+
+from xmlrpc.server import list_public_methods
+
+
+def device_settings(settings) -> list:
+    """Gets the settings of every device: the main device (the settings
+    themselves), then one per entry of settings.devices, which override
+    fields of the main device's settings. Unless overridden, other devices
+    record to a sub-directory named after their id.
+
+    Args:
+        settings (Settings): hardware settings
+
+    Returns:
+        list: Settings, one per device
+
+    Raises:
+        ValueError: a device has no id, or the same id as another
+    """
+    all_settings = [settings]
+    for overrides in settings.devices:
+        device_id = overrides.get("device_id")
+        if not device_id:
+            raise ValueError(f"device without device_id: {overrides}")
+        update = {
+            "recording_files_dir":
+                f"{settings.recording_files_dir}/{device_id}",
+            "devices": []
+        }
+        update.update(overrides)
+        all_settings.append(settings.copy(update=update))
+
+    ids = [s.device_id for s in all_settings]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"device ids must be unique: {ids}")
+    return all_settings
+
+
+class DeviceDispatcher:
+    """XML-RPC instance routing "<device_id>.<method>" to the device's
+    controller, through the device's scheduler except for the controller's
+    CONCURRENT_METHODS"""
+
+    NORMAL = 1  # scheduler priority of methods not in PRIORITIES
+
+    def __init__(self, controllers: dict, schedulers: dict = None,
+                 tracer=None):
+        """
+        Args:
+            controllers (dict): Controller by device id, the first is the
+                main device
+            schedulers (dict, optional): Scheduler by device id (None:
+                methods are called directly)
+            tracer (tracing.Tracer, optional): serves the traces and
+                trace_keep methods
+        """
+        self.controllers = controllers
+        self.schedulers = schedulers or {}
+        self.tracer = tracer
+        self.main = next(iter(controllers))
+
+    def list_devices(self) -> dict:
+        """Gets the devices: id, v4l2, alsa, state"""
+        return {
+            "success": True,
+            "main": self.main,
+            "devices": [{
+                "device_id": device_id,
+                "v4l2": controller.settings.v4l2,
+                "alsa": controller.settings.alsa,
+                "state": controller.state.value
+            } for device_id, controller in self.controllers.items()]
+        }
+
+    def _listMethods(self) -> list:
+        # from the class, so properties (the lazily opened catalog and
+        # templates) are not evaluated
+        methods = list_public_methods(type(self.controllers[self.main]))
+        return sorted(set(methods) | {"list_devices", "schedule",
+                                      "scheduler_stats", "traces",
+                                      "trace_keep"})
+
+    def _call(self, device_id: str, name: str, params,
+              priority: int = None, deadline: float = None):
+        """Calls a controller method, queued by the device's scheduler"""
+        controller = self.controllers[device_id]
+        function = getattr(controller, name, None)
+        if name.startswith("_") or not callable(function):
+            raise Exception(f'method "{name}" is not supported')
+
+        scheduler = self.schedulers.get(device_id)
+        concurrent = getattr(controller, "CONCURRENT_METHODS", ())
+        if scheduler is None or name in concurrent:
+            return function(*params)
+
+        if priority is None:
+            priority = getattr(controller, "PRIORITIES", {}).get(
+                name, self.NORMAL)
+        try:
+            return scheduler.call(name, function, tuple(params), priority,
+                                  deadline)
+        except TimeoutError as exc:  # (scheduler.DeadlineExceeded)
+            return {
+                "success": False,
+                "controller_state": controller.state.value,
+                "controller_code": "DEADLINE_EXCEEDED",
+                "error": str(exc)
+            }
+
+    def _trace_method(self, name: str, params):
+        if self.tracer is None:
+            return {"success": False, "error": "tracing is not enabled"}
+        if name == "traces":
+            # (limit, min_ms)
+            return {"success": True, "traces": self.tracer.traces(*params)}
+        # (trace_id, spans): keep a trace, with the caller's spans
+        return {"success": True, "spans": self.tracer.keep(*params)}
+
+    def _dispatch(self, method: str, params: tuple):
+        device_id, _, name = method.rpartition(".")
+        if name == "list_devices":  # (of every device)
+            return self.list_devices()
+        if name in ["traces", "trace_keep"]:  # (of the service)
+            return self._trace_method(name, params)
+
+        device_id = device_id or self.main
+        if device_id not in self.controllers:
+            raise Exception(f'unknown device "{device_id}"')
+
+        if name == "schedule":
+            # (method, params, priority, deadline): queue with a priority
+            # (0 high, 1 normal, 2 low) and/or deadline (seconds from now)
+            method, params, priority, deadline = (list(params) +
+                                                  [[], None, None])[:4]
+            return self._call(device_id, method, params, priority, deadline)
+        if name == "scheduler_stats":
+            scheduler = self.schedulers.get(device_id)
+            return {
+                "success": scheduler is not None,
+                **(scheduler.stats() if scheduler else {})
+            }
+        return self._call(device_id, name, params)
@@ -1,10 +1,135 @@
 """Fast Screenshot Mode Thread Controller"""
 
+import collections
+import os
 import queue
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import cv2
+import numpy as np
 from loguru import logger
 
+# change detection runs on grayscale copies downscaled by this factor
+# (240x135 at 1080p), kept for the last HISTORY frames served
+SCALE = 8
+HISTORY = 64
+DIFF_LEVEL = 24  # grey levels a pixel must change by (ignores noise)
+
+
+class Burst:
+    """Frames requested from the frame-loop, copied into buffers allocated
+    up front so capturing does not allocate (or encode) between frames"""
+
+    def __init__(self, count: int, interval: float):
+        self.count = count
+        self.interval = interval
+        self.frames = None  # (count, height, width, 3), allocated on 1st frame
+        self.timestamps = np.zeros(count)
+        self.captured = 0
+        self.next_time = 0.0
+        self.done = threading.Event()
+
+    def add(self, frame: np.ndarray, timestamp: float):
+        """Copies a frame if one is due (called by the frame-loop)"""
+        if timestamp < self.next_time:
+            return
+        if self.frames is None:
+            self.frames = np.empty((self.count,) + frame.shape, frame.dtype)
+        np.copyto(self.frames[self.captured], frame)
+        self.timestamps[self.captured] = timestamp
+        self.captured += 1
+        self.next_time = timestamp + self.interval
+        if self.captured == self.count:
+            self.done.set()
+
+
+def capture_time(cam) -> float:
+    """Gets when the last frame read was captured (time.monotonic clock):
+    the driver's V4L2 buffer timestamp, which is CLOCK_MONOTONIC for UVC
+    devices, or now if the backend has none
+
+    Args:
+        cam (cv2.VideoCapture): device the frame was read from
+    """
+    now = time.monotonic()
+    timestamp = cam.get(cv2.CAP_PROP_POS_MSEC) / 1000
+    # some backends report the position in the stream instead
+    if 0 < now - timestamp < 10:
+        return timestamp
+    return now
+
+
+def video_capture(backend: str = "cv2"):
+    """Creates an (unopened) capture device
+
+    Args:
+        backend (str, optional): cv2 (cv2.VideoCapture) or v4l2 (native mmap
+            capture, see v4l2.V4l2Capture)
+    """
+    if backend == "v4l2":
+        from v4l2 import V4l2Capture
+        return V4l2Capture()
+    return cv2.VideoCapture()
+
+
+def downsample(frame: np.ndarray) -> np.ndarray:
+    """Gets the small grayscale copy used for change detection"""
+    height, width = frame.shape[:2]
+    small = cv2.resize(frame, (width // SCALE, height // SCALE),
+                       interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+
+class ChangeWatch:
+    """Waits for a frame differing from a reference frame"""
+
+    def __init__(self, reference: np.ndarray, threshold: float, roi=None):
+        """
+        Args:
+            reference (np.ndarray): downsampled reference frame
+            threshold (float): fraction of (ROI) pixels that must change
+            roi (list, optional): x, y, width, height (full resolution)
+        """
+        self.reference = reference.astype(np.int16)
+        self.threshold = threshold
+        self.roi = (slice(None), slice(None))
+        self.offset = (0, 0)
+        if roi:
+            x, y, w, h = (v // SCALE for v in roi)
+            self.roi = (slice(y, y + max(h, 1)), slice(x, x + max(w, 1)))
+            self.offset = (x, y)
+
+        self.frame = None
+        self.small = None
+        self.sequence = None
+        self.fraction = 0.0
+        self.box = None
+        self.done = threading.Event()
+
+    def check(self, small: np.ndarray, frame: np.ndarray, sequence: int):
+        """Compares a frame to the reference (called by the frame-loop)"""
+        diff = np.abs(small[self.roi] - self.reference[self.roi])
+        changed = diff > DIFF_LEVEL
+        fraction = changed.mean() if changed.size else 0.0
+        if fraction <= self.threshold:
+            return
+
+        # bounding box of the changed pixels, at full resolution
+        rows = np.flatnonzero(changed.any(axis=1))
+        cols = np.flatnonzero(changed.any(axis=0))
+        x = (self.offset[0] + cols[0]) * SCALE
+        y = (self.offset[1] + rows[0]) * SCALE
+        self.box = [int(x), int(y),
+                    int((cols[-1] - cols[0] + 1) * SCALE),
+                    int((rows[-1] - rows[0] + 1) * SCALE)]
+        self.fraction = float(fraction)
+        self.frame = frame.copy()
+        self.small = small
+        self.sequence = sequence
+        self.done.set()
+
 
 class FastScreenshotReader(threading.Thread):
 
@@ -12,62 +137,295 @@ class FastScreenshotReader(threading.Thread):
     def __init__(self,
                  inp_fmt: str, out_fmt: str,
                  width: int, height: int,
-                 device: str = "/dev/video0"):
+                 device: str = "/dev/video0",
+                 backend: str = "cv2",
+                 compression: str = "",
+                 cpu: int = -1,
+                 cam=None):
         super(FastScreenshotReader, self).__init__()
 
         self.inp_fmt = "MJPG" if inp_fmt == "jpg" else "YUYV"
-        self.out_fmt = out_fmt
+        self.out_fmt = out_fmt  # jpg, png, raw or native (see raw.py)
+        self.compression = compression  # of raw/native frames
+        self.cpu = cpu  # core the capture loop runs on (-1: any)
         self.width = width
         self.height = height
         self.device = device
 
-        self.cam = cv2.VideoCapture()
+        # an already opened and configured device may be handed over
+        self.opened = cam is not None
+        self.cam = cam if cam is not None else video_capture(backend)
         self.q = queue.Queue()
         self.read_frame = False
+        self.burst = None
+
+        # frame numbers, and downsampled copies of the frames served (the
+        # references of change detection)
+        self.sequence = 0
+        self.latest = None  # (sequence, frame)
+        self.history = collections.deque(maxlen=HISTORY)
+        self.history_ready = threading.Condition()
+        self.watches = []
 
         self.lock = threading.Lock()
+        self._stopping = threading.Event()
 
     def run(self):
         logger.debug("Running Thread")
+        if self.cpu >= 0:
+            try:
+                os.sched_setaffinity(0, {self.cpu})  # (this thread)
+            except OSError as exc:
+                logger.warning(f"could not pin to core {self.cpu}: {exc}")
 
-        self.cam.open(self.device)
+        if not self.opened:
+            self.cam.open(self.device)
 
-        fourcc = cv2.VideoWriter_fourcc(*self.inp_fmt)
-        self.cam.set(cv2.CAP_PROP_FOURCC, fourcc)
+            fourcc = cv2.VideoWriter_fourcc(*self.inp_fmt)
+            self.cam.set(cv2.CAP_PROP_FOURCC, fourcc)
 
-        self.cam.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
-        self.cam.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+            self.cam.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+            self.cam.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
 
-        while True:
-            # try:
+        try:
+            self._frame_loop()
+        finally:
+            # (released by this thread: frames may be in use until read
+            # returns)
+            self.cam.release()
+
+        logger.debug("Stopped Thread")
+
+    def _frame_loop(self):
+        while not self._stopping.is_set():
             frame = self.cam.read()[1]
+            captured = capture_time(self.cam)
             if frame is None:
                 break
 
+            self.sequence += 1
+            with self.history_ready:
+                self.latest = (self.sequence, frame)
+                self.history_ready.notify_all()
+            watches = list(self.watches)
+            if watches:  # (downsampled only while waiting for a change)
+                small = downsample(frame)
+                for watch in watches:
+                    watch.check(small, frame, self.sequence)
+
+            burst = self.burst
+            if burst is not None:
+                burst.add(frame, captured)
+                if burst.done.is_set():
+                    self.burst = None
+
             if self.read_frame:
-                self.q.put(frame)
-                logger.success("Pushed Frame")
+                # capture format bytes, kept by the capture while requested
+                native = getattr(self.cam, "native", None)
+                if self.out_fmt != "native" or native is not None:
+                    self._keep_reference(self.sequence, downsample(frame))
+                    self.q.put((self.sequence, captured, frame, native))
+                    logger.success("Pushed Frame")
 
-                self.read_frame = False
+                    self.read_frame = False
 
-        logger.debug("Stopped Thread")
+    def _keep_reference(self, sequence: int, small: np.ndarray):
+        """Keeps a served frame's downsampled copy (see wait_for_change)"""
+        with self.history_ready:
+            self.history.append((sequence, small))
 
-    def stop(self):
-        """Causes frame-loop to end, therefore ending the thread"""
+    def stop(self, timeout: float = 5.0):
+        """Causes frame-loop to end, therefore ending the thread (which
+        releases the device)"""
         logger.debug("Stopping Thread")
-        self.cam.release()
+        self._stopping.set()
+        if self.ident is None:  # (never started)
+            self.cam.release()
+        else:
+            self.join(timeout)
+        if self.is_alive():
+            logger.error(f"Thread did not stop within {timeout} s")
+            return {
+                "success": False,
+                "error": "capture thread did not stop"
+            }
         return {
             "success": True
         }
 
-    def get_frame(self):
-        """Saves the most recent frame read by the frame-loop"""
+    def encode(self, frame: np.ndarray, native: tuple = None) -> bytes:
+        """Encodes a frame in the output format
+
+        Args:
+            frame (np.ndarray): BGR frame
+            native (tuple, optional): format, shape, bytes as captured (used
+                by the native output format, BGR frames are sent otherwise)
+        """
+        if self.out_fmt in ["raw", "native"]:
+            from raw import pack
+            if native is not None and self.out_fmt == "native":
+                fmt, shape, data = native
+                return pack(data, fmt, shape, self.compression)
+            return pack(frame, "BGR", compression=self.compression)
+        return cv2.imencode(f".{self.out_fmt}", frame)[1].tobytes()
+
+    def _next_queued(self, timeout: float):
+        """Waits for the frame-loop to push a frame (None if it timed out
+        or ended)"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.is_alive():
+                return None
+            try:
+                return self.q.get(timeout=min(remaining, 0.1))
+            except queue.Empty:
+                pass
+
+    def get_frame(self, timeout: float = 5.0):
+        """Saves the most recent frame read by the frame-loop
+
+        Args:
+            timeout (float, optional): seconds to wait for a frame
+        """
 
         with self.lock:
+            keep_native = self.out_fmt == "native"  # (v4l2 backend only)
+            if keep_native:
+                self.cam.keep_native = True
+            while not self.q.empty():  # (pushed after a request timed out)
+                self.q.get_nowait()
             self.read_frame = True
-            frame = self.q.get()  # blocks until frame is available
+            # blocks until frame is available
+            pushed = self._next_queued(timeout)
+            if keep_native:
+                self.cam.keep_native = False
+            if pushed is None:
+                self.read_frame = False
+                logger.error("No frame from the capture thread")
+                return {
+                    "success": False,
+                    "error": "no frame captured"
+                }
+            sequence, captured, frame, native = pushed
+            start = time.monotonic()
+            data = self.encode(frame, native)
+            served = time.monotonic()
             return {
                 "success": True,
-                "data": cv2.imencode(f".{self.out_fmt}", frame)[1].tobytes(),
-                "format": self.out_fmt
+                "sequence": sequence,
+                "data": data,
+                "format": self.out_fmt,
+                "captured": captured,
+                "encode_ms": (served - start) * 1000,
+                "served": served
             }
+
+    def get_burst(self, count: int, interval: float = 0.0,
+                  timeout: float = 30.0):
+        """Captures consecutive frames (or one every interval seconds), then
+        encodes them in parallel, after capture so encoding does not delay
+        frames
+
+        Args:
+            count (int): number of frames
+            interval (float, optional): minimum seconds between frames
+                (0: every frame)
+            timeout (float, optional): seconds to wait for the frames
+
+        Returns:
+            dict: success, data (list of encoded frames), timestamps (unix
+                time each frame was captured, see capture_time), format
+        """
+        with self.lock:
+            burst = Burst(count, interval)
+            self.burst = burst
+            if not burst.done.wait(timeout):
+                self.burst = None
+                logger.error(f"Burst timed out ({burst.captured}/{count})")
+                return {
+                    "success": False,
+                    "captured": burst.captured
+                }
+
+        # cv2 releases the GIL while encoding
+        with ThreadPoolExecutor(os.cpu_count()) as pool:
+            data = list(pool.map(self.encode, burst.frames))
+
+        # (time.monotonic clock to unix time)
+        timestamps = burst.timestamps + (time.time() - time.monotonic())
+        return {
+            "success": True,
+            "data": data,
+            "timestamps": timestamps.tolist(),
+            "format": self.out_fmt
+        }
+
+    def next_frame(self, after: int = 0, timeout: float = 10.0):
+        """Gets the latest frame once it is newer than frame number after
+
+        Returns:
+            tuple: sequence, frame (None if timed out)
+        """
+        with self.history_ready:
+            if not self.history_ready.wait_for(
+                    lambda: self.sequence > after, timeout):
+                return None
+            return self.latest
+
+    def wait_for_change(self, sequence: int = None, threshold: float = 0.01,
+                        roi: list = None, timeout: float = 10.0):
+        """Blocks until a frame differs from a reference frame
+
+        Args:
+            sequence (int, optional): reference frame number (from
+                get_frame, or a previous change), within the last HISTORY
+                frames served (default: the next frame read)
+            threshold (float, optional): fraction of pixels (in the ROI)
+                that must change
+            roi (list, optional): x, y, width, height to watch
+            timeout (float, optional): seconds to wait
+
+        Returns:
+            dict: success, changed, sequence, box (x, y, width, height of
+                the change), fraction, data (changed frame), format
+        """
+        with self.history_ready:
+            if sequence is None:
+                # the next frame, so the reference is read after this call
+                latest = self.sequence
+                self.history_ready.wait_for(
+                    lambda: self.sequence > latest, timeout)
+                sequence, frame = self.latest or (0, None)
+                reference = downsample(frame) if frame is not None else None
+            else:
+                reference = dict(self.history).get(sequence)
+        if reference is None:
+            return {
+                "success": False,
+                "error": f"frame {sequence} not available"
+            }
+
+        watch = ChangeWatch(reference, threshold, roi)
+        self.watches.append(watch)
+        try:
+            changed = watch.done.wait(timeout)
+        finally:
+            self.watches.remove(watch)
+
+        if not changed:
+            return {
+                "success": True,
+                "changed": False,
+                "sequence": sequence
+            }
+        self._keep_reference(watch.sequence, watch.small)
+        return {
+            "success": True,
+            "changed": True,
+            "sequence": watch.sequence,
+            "box": watch.box,
+            "fraction": watch.fraction,
+            "data": self.encode(watch.frame),
+            "format": self.out_fmt
+        }
@@ -0,0 +1,90 @@
+"""Raw frame export: pixels without image encoding
+
+A raw frame is a small header followed by the frame's bytes:
+
+    b"PSRAW" | header length (uint32, little endian) | JSON header | data
+
+The header holds the shape, dtype, format (BGR for decoded frames, or the
+capture format: YUYV, MJPG) and compression ("" or lz4, which needs the
+optional lz4 package). Skipping PNG/JPEG encoding saves most of the time a
+screenshot takes on the Pi, for consumers that process pixels anyway.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b"PSRAW"
+COMPRESSIONS = ["", "lz4"]
+
+
+def compression_available(compression: str) -> bool:
+    """Checks if a compression is known and its package installed"""
+    if compression == "lz4":
+        try:
+            import lz4.frame  # noqa: F401
+        except ImportError:
+            return False
+        return True
+    return compression == ""
+
+
+def pack(data, fmt: str, shape: tuple = None, compression: str = "") -> bytes:
+    """Creates a raw frame
+
+    Args:
+        data (np.ndarray | bytes): pixels (arrays are sent as they are laid
+            out in memory, C order)
+        fmt (str): pixel format (BGR, YUYV, MJPG)
+        shape (tuple, optional): shape (default: the array's, or the length
+            of bytes)
+        compression (str, optional): "" or lz4
+
+    Returns:
+        bytes: header and data
+    """
+    if isinstance(data, np.ndarray):
+        array = np.ascontiguousarray(data)
+        shape = array.shape if shape is None else shape
+        dtype = array.dtype.str
+        data = array.data
+    else:
+        shape = (len(data),) if shape is None else shape
+        dtype = "|u1"
+
+    if compression == "lz4":
+        import lz4.frame
+        data = lz4.frame.compress(data)
+
+    header = json.dumps({
+        "shape": list(shape),
+        "dtype": dtype,
+        "format": fmt,
+        "compression": compression
+    }).encode("utf-8")
+    return b"".join([MAGIC, struct.pack("<I", len(header)), header,
+                     bytes(data)])
+
+
+def unpack(raw: bytes) -> tuple:
+    """Reads a raw frame
+
+    Returns:
+        tuple: header (dict), array (np.ndarray, shaped)
+
+    Raises:
+        ValueError: not a raw frame
+    """
+    if raw[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a raw frame")
+    offset = len(MAGIC)
+    length = struct.unpack_from("<I", raw, offset)[0]
+    offset += 4
+    header = json.loads(raw[offset:offset + length])
+    data = raw[offset + length:]
+    if header["compression"] == "lz4":
+        import lz4.frame
+        data = lz4.frame.decompress(data)
+    array = np.frombuffer(data, np.dtype(header["dtype"]))
+    return header, array.reshape(header["shape"])
@@ -1,7 +1,13 @@
-"""sqlalchemy mapping for recordings"""
+"""sqlalchemy mapping and catalog (database) for recordings"""
 
+import queue
+import threading
+from concurrent.futures import Future
+
+from loguru import logger
 from sqlalchemy import Column, Integer, String, Sequence, DateTime, Float
-from sqlalchemy.orm import declarative_base
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy.sql import func
 
 Base = declarative_base()
@@ -17,3 +23,233 @@ class Recording(Base):
     size = Column(Integer)
     timestamp = Column(DateTime(timezone=False), server_default=func.now())
     name = Column(String)
+
+    # ffmpeg progress statistics (see recording_monitor.py)
+    fps = Column(Float)
+    speed = Column(Float)
+    bitrate = Column(Float)  # kbits/s
+    dup_frames = Column(Integer)
+    drop_frames = Column(Integer)
+
+    interval = Column(Float)  # seconds between frames (timelapses)
+
+    def to_dict(self) -> dict:
+        """Gets the columns as a dict"""
+        return {column.name: getattr(self, column.name)
+                for column in self.__table__.columns}
+
+
+# Migrations
+# each migration brings the schema from version i to i + 1, the version is
+# stored in the database (PRAGMA user_version). Append, never edit.
+def _create_table(conn):
+    """v1: recordings table"""
+    Base.metadata.create_all(bind=conn, tables=[Recording.__table__])
+
+
+def _add_progress_columns(conn):
+    """v2: ffmpeg progress statistics (databases created before v1 was
+    tracked may already have some of them)"""
+    existing = {c["name"] for c in inspect(conn).get_columns("recordings")}
+    for column in Recording.__table__.columns:
+        if column.name not in existing:
+            column_type = column.type.compile(conn.dialect)
+            conn.execute(text(f"ALTER TABLE recordings "
+                              f"ADD COLUMN {column.name} {column_type}"))
+
+
+def _add_interval_column(conn):
+    """v3: timelapse interval (adds the missing columns, as v2)"""
+    _add_progress_columns(conn)
+
+
+MIGRATIONS = [_create_table, _add_progress_columns, _add_interval_column]
+
+
+def migrate(engine) -> int:
+    """Applies the migrations a database has not had yet
+
+    Args:
+        engine (sqlalchemy.engine.Engine): recording database engine
+
+    Returns:
+        int: schema version
+    """
+    with engine.begin() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            logger.info(f"catalog: migrating to v{number} "
+                        f"({migration.__name__})")
+            migration(conn)
+            # PRAGMA does not take parameters, number is an int
+            conn.exec_driver_sql(f"PRAGMA user_version = {number}")
+    return len(MIGRATIONS)
+
+
+def _configure_connection(dbapi_connection, connection_record):
+    """WAL journaling (readers do not block the writer and vice versa) and
+    transactions handled by sqlalchemy instead of pysqlite"""
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")  # safe with WAL
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
+def _begin(conn):
+    """Emits BEGIN (pysqlite does not, see _configure_connection)"""
+    conn.exec_driver_sql("BEGIN")
+
+
+class Catalog:
+    """Recording database, safe to use from any thread.
+
+    Writes are queued to a single writer thread that commits them in batches
+    (one fsync per batch on the SD card). Reads use read-only connections,
+    which with WAL journaling never wait for the writer.
+    """
+
+    def __init__(self, path: str, batch_size: int = 64):
+        """
+        Args:
+            path (str): database file (created if missing)
+            batch_size (int): maximum writes per commit
+        """
+        self.path = path
+        self._batch_size = batch_size
+
+        self._engine = create_engine(f"sqlite:///{path}",
+                                     connect_args={"check_same_thread": False})
+        event.listen(self._engine, "connect", _configure_connection)
+        event.listen(self._engine, "begin", _begin)
+        self.version = migrate(self._engine)
+        self._write_session = sessionmaker(bind=self._engine,
+                                           expire_on_commit=False)
+
+        self._reader = create_engine(
+            f"sqlite:///file:{path}?mode=ro&uri=true",
+            connect_args={"check_same_thread": False})
+        self._read_session = sessionmaker(bind=self._reader)
+
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop,
+                                        name="catalog-writer",
+                                        daemon=True)
+        self._writer.start()
+
+    # Writes
+    def write(self, operation) -> Future:
+        """Queues a write
+
+        Args:
+            operation (callable): called with a session, inside a savepoint
+                (a failing operation does not affect the rest of its batch)
+
+        Returns:
+            Future: operation's return value (or exception) once committed
+        """
+        future = Future()
+        self._queue.put((operation, future))
+        return future
+
+    def save(self, recording: Recording) -> int:
+        """Inserts or updates a recording (waits for the commit)
+
+        Args:
+            recording (Recording): recording (not attached to any session)
+
+        Returns:
+            int: recording id (also set on the recording)
+        """
+        def operation(session):
+            merged = session.merge(recording)
+            session.flush()
+            return merged.id
+
+        recording.id = self.write(operation).result()
+        return recording.id
+
+    def update(self, recording_id: int, values: dict) -> Future:
+        """Queues an update of some columns of a recording (does not wait)
+
+        Args:
+            recording_id (int): recording id
+            values (dict): column values
+
+        Returns:
+            Future: number of recordings updated
+        """
+        def operation(session):
+            return session.query(Recording) \
+                .filter(Recording.id == recording_id).update(values)
+
+        return self.write(operation)
+
+    def delete(self, path: str) -> int:
+        """Deletes recordings by path (waits for the commit)
+
+        Returns:
+            int: number deleted
+        """
+        def operation(session):
+            return session.query(Recording) \
+                .filter(Recording.path == path).delete()
+
+        return self.write(operation).result()
+
+    def close(self):
+        """Commits queued writes and stops the writer"""
+        self._queue.put(None)
+        self._writer.join()
+        self._engine.dispose()
+        self._reader.dispose()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            batch = [item for item in batch if item is not None]
+            if batch:
+                self._commit(batch)
+            if stop:
+                return
+
+    def _commit(self, batch: list):
+        """Runs a batch of writes in one transaction"""
+        results = []
+        try:
+            with self._write_session() as session, session.begin():
+                for operation, future in batch:
+                    try:
+                        with session.begin_nested():
+                            results.append((future, operation(session), None))
+                    except Exception as exc:
+                        results.append((future, None, exc))
+        except Exception as exc:
+            logger.error(f"catalog: commit failed ({exc})")
+            for _, future in batch:
+                future.set_exception(exc)
+            return
+
+        for future, result, exc in results:
+            if exc is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exc)
+
+    # Reads
+    def recordings(self) -> list:
+        """Gets all recordings (read-only connection)
+
+        Returns:
+            list: recordings (dicts)
+        """
+        with self._read_session() as session:
+            return [r.to_dict() for r in session.query(Recording)]
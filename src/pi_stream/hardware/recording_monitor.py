@@ -0,0 +1,161 @@
+"""Live recording statistics parsed from ffmpeg '-progress' output"""
+
+import time
+
+from loguru import logger
+
+
+class RecordingMonitor:
+    """Parses the key=value blocks ffmpeg writes with '-progress pipe:1'
+    into live recording statistics.
+
+    ffmpeg writes one block per progress period, each terminated by a
+    'progress=continue' (or 'progress=end') line. Values are only published
+    to stats() once a block is complete, so readers never see a half-updated
+    snapshot.
+    """
+
+    # keys read from each progress block
+    KEYS = ["frame", "fps", "bitrate", "total_size", "out_time_us",
+            "dup_frames", "drop_frames", "speed", "progress"]
+
+    def __init__(self,
+                 min_speed: float = 1.0,
+                 warmup: float = 5.0):
+        """
+        Args:
+            min_speed (float): speed below which the recording is considered
+                to be falling behind real-time
+            warmup (float): seconds of recording to ignore before alerting
+                (ffmpeg speed is noisy while the devices start up)
+        """
+        self.min_speed = min_speed
+        self.warmup = warmup
+
+        self._partial = ""  # incomplete line carried between feed() calls
+        self._block = {}  # progress block being parsed
+        self._stats = {}  # last complete progress block
+        self._start_time = time.monotonic()
+        self._finished = False
+
+        # alert bookkeeping
+        self._slow = False
+        self._slow_count = 0
+        self._last_drop = 0
+
+    def feed(self, data):
+        """Callback for ffmpeg stdout. Accepts any chunk of output (a single
+        line or several), handling lines that are split across calls.
+
+        Args:
+            data (str or bytes): ffmpeg output
+        """
+        if isinstance(data, bytes):
+            data = data.decode("utf-8", errors="replace")
+
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()  # last element is an incomplete line
+        for line in lines:
+            self._parse_line(line.strip())
+
+    def _parse_line(self, line: str):
+        """Adds a single key=value line to the current progress block"""
+        keyval = line.split("=", 1)
+        if len(keyval) != 2:
+            return
+        key, value = keyval[0].strip(), keyval[1].strip()
+        if key not in self.KEYS:
+            return
+
+        self._block[key] = value
+        if key == "progress":
+            self._publish(self._block)
+            self._block = {}
+
+    def _publish(self, block: dict):
+        """Converts a complete progress block into stats and checks alerts"""
+        stats = {
+            "frame": _to_int(block.get("frame")),
+            "fps": _to_float(block.get("fps")),
+            "bitrate_kbps": _to_float(block.get("bitrate", "")
+                                      .replace("kbits/s", "")),
+            "total_size": _to_int(block.get("total_size")),
+            "dup_frames": _to_int(block.get("dup_frames")),
+            "drop_frames": _to_int(block.get("drop_frames")),
+            "speed": _to_float(block.get("speed", "").rstrip("x")),
+        }
+
+        out_time_us = _to_int(block.get("out_time_us"))
+        elapsed = time.monotonic() - self._start_time
+        stats["out_time"] = None
+        stats["lag"] = None
+        if out_time_us is not None:
+            stats["out_time"] = out_time_us / 1e6
+            # how far the output timeline has fallen behind the wall clock
+            stats["lag"] = round(elapsed - stats["out_time"], 3)
+        stats["elapsed"] = round(elapsed, 3)
+
+        self._stats = stats
+        if block.get("progress") == "end":
+            self._finished = True
+        self._check_alerts(stats, elapsed)
+
+    def _check_alerts(self, stats: dict, elapsed: float):
+        """Logs a warning when the recording falls behind real-time or
+        starts dropping frames (once per occurrence, not once per block)"""
+        if elapsed < self.warmup:
+            return
+
+        speed = stats["speed"]
+        slow = speed is not None and speed < self.min_speed
+        if slow and not self._slow:
+            self._slow_count += 1
+            logger.warning(f"ffmpeg: recording behind real-time "
+                           f"(speed {speed}x, lag {stats['lag']} s)")
+        elif self._slow and not slow:
+            logger.info(f"ffmpeg: recording back to real-time ({speed}x)")
+        self._slow = slow
+
+        drop = stats["drop_frames"] or 0
+        if drop > self._last_drop:
+            logger.warning(f"ffmpeg: dropped {drop - self._last_drop} frames "
+                           f"({drop} total)")
+            self._last_drop = drop
+
+    @property
+    def finished(self) -> bool:
+        """whether ffmpeg reported the end of the recording"""
+        return self._finished
+
+    def alerts(self) -> list:
+        """Gets the currently active alerts"""
+        alerts = []
+        if self._slow:
+            alerts.append("BEHIND_REALTIME")
+        if self._last_drop > 0:
+            alerts.append("DROPPED_FRAMES")
+        return alerts
+
+    def stats(self) -> dict:
+        """Gets the most recent complete progress statistics"""
+        result = dict(self._stats)
+        result["finished"] = self._finished
+        result["slow_periods"] = self._slow_count
+        result["alerts"] = self.alerts()
+        return result
+
+
+def _to_int(value):
+    """Parses an int from ffmpeg output ('N/A' becomes None)"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value):
+    """Parses a float from ffmpeg output ('N/A' becomes None)"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
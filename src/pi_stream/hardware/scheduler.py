@@ -0,0 +1,244 @@
+"""Queue for controller operations
+
+Operations run one at a time (the controller is a state machine), by
+priority, then in order of arrival. An operation identical to one that is
+queued or running (same name and arguments) is not queued again: its
+caller shares the result (single-flight), so five clients asking for the
+same screenshot at once get one capture instead of four INVALID_STATE
+errors. An operation with a deadline is rejected when it cannot start and
+finish in time, judging by how long previous runs of it took.
+"""
+
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+from loguru import logger
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+EWMA_WEIGHT = 0.3  # of the latest run in the duration estimate
+
+
+class DeadlineExceeded(TimeoutError):
+    """The operation could not have finished before its deadline"""
+
+
+class Operation:
+    """A queued call"""
+
+    def __init__(self, name: str, function, args: tuple, priority: int,
+                 deadline: float):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.key = (name, repr(args))
+        self.priority = priority
+        self.deadline = deadline  # time.monotonic() (None: no deadline)
+        self.future = Future()
+        # (run in the caller's context, continuing its trace)
+        self.context = contextvars.copy_context()
+        self.enqueued = time.monotonic()
+        self.started = None
+        self.callers = 1
+
+
+class OperationStats:
+    """Counts and times of one kind of operation"""
+
+    def __init__(self):
+        self.count = 0  # runs
+        self.coalesced = 0  # calls that shared another call's run
+        self.rejected = 0  # deadline could not be met
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.estimate = None  # EWMA of run time (seconds)
+
+    def ran(self, wait: float, duration: float):
+        self.count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        if self.estimate is None:
+            self.estimate = duration
+        else:
+            self.estimate += EWMA_WEIGHT * (duration - self.estimate)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "mean_wait_ms": self.total_wait / self.count * 1000
+            if self.count else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+            "estimate_ms": (self.estimate or 0.0) * 1000
+        }
+
+
+class Scheduler:
+    """Runs operations one at a time on a worker thread"""
+
+    def __init__(self, name: str = "scheduler", tracer=None):
+        """
+        Args:
+            name (str, optional): worker thread name
+            tracer (tracing.Tracer, optional): records each operation and
+                its wait in the queue as spans
+        """
+        self.tracer = tracer
+        self._queue = []  # heap of (priority, arrival, Operation)
+        self._arrival = itertools.count()
+        self._pending = {}  # key: queued or running Operation
+        self._running = None
+        self._stats = {}
+        self._condition = threading.Condition()
+        self._worker = threading.Thread(target=self._run, name=name,
+                                        daemon=True)
+        self._worker.start()
+
+    def _estimate(self, name: str) -> float:
+        stats = self._stats.get(name)
+        if stats is None or stats.estimate is None:
+            return 0.0  # (never ran)
+        return stats.estimate
+
+    def _expected_start(self, priority: int) -> float:
+        """Seconds until an operation queued now would start"""
+        wait = 0.0
+        if self._running is not None:
+            elapsed = time.monotonic() - self._running.started
+            wait += max(self._estimate(self._running.name) - elapsed, 0.0)
+        for queued_priority, _, operation in self._queue:
+            if queued_priority <= priority:
+                wait += self._estimate(operation.name)
+        return wait
+
+    def submit(self, name: str, function, args: tuple = (),
+               priority: int = NORMAL, deadline: float = None) -> Future:
+        """Queues an operation (or joins an identical one)
+
+        Args:
+            name (str): operation name (for coalescing and statistics)
+            function (callable): called with args
+            args (tuple, optional): arguments
+            priority (int, optional): HIGH, NORMAL or LOW
+            deadline (float, optional): seconds from now it must be done by
+
+        Returns:
+            Future: result of the operation (DeadlineExceeded if rejected)
+        """
+        now = time.monotonic()
+        with self._condition:
+            stats = self._stats.setdefault(name, OperationStats())
+            operation = self._pending.get((name, repr(args)))
+            if operation is not None:
+                operation.callers += 1
+                stats.coalesced += 1
+                return operation.future
+
+            if deadline is not None:
+                expected = self._expected_start(priority) \
+                    + self._estimate(name)
+                if expected > deadline:
+                    stats.rejected += 1
+                    future = Future()
+                    future.set_exception(DeadlineExceeded(
+                        f"{name} expected to take {expected:.2f} s, "
+                        f"deadline {deadline:.2f} s"))
+                    return future
+                deadline += now
+
+            operation = Operation(name, function, args, priority, deadline)
+            self._pending[operation.key] = operation
+            heapq.heappush(self._queue,
+                           (priority, next(self._arrival), operation))
+            self._condition.notify()
+            return operation.future
+
+    def call(self, name: str, function, args: tuple = (),
+             priority: int = NORMAL, deadline: float = None):
+        """Queues an operation and waits for its result (see submit)
+
+        Raises:
+            DeadlineExceeded: rejected
+        """
+        return self.submit(name, function, args, priority, deadline).result()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                _, _, operation = heapq.heappop(self._queue)
+                operation.started = time.monotonic()
+                self._running = operation
+                stats = self._stats[operation.name]
+
+            wait = operation.started - operation.enqueued
+            if operation.deadline is not None \
+                    and operation.started > operation.deadline:
+                with self._condition:
+                    stats.rejected += 1
+                    self._pending.pop(operation.key, None)
+                    self._running = None
+                operation.future.set_exception(DeadlineExceeded(
+                    f"{operation.name} waited {wait:.2f} s, past its "
+                    f"deadline"))
+                continue
+
+            try:
+                result = operation.context.run(self._execute, operation,
+                                               wait)
+            except Exception as exc:
+                logger.exception(f"{operation.name} failed")
+                result, error = None, exc
+            else:
+                error = None
+            duration = time.monotonic() - operation.started
+
+            with self._condition:
+                stats.ran(wait, duration)
+                # later identical calls run again
+                self._pending.pop(operation.key, None)
+                self._running = None
+            if operation.callers > 1:
+                logger.debug(f"{operation.name}: {operation.callers} calls "
+                             f"shared one run")
+            if error is None:
+                operation.future.set_result(result)
+            else:
+                operation.future.set_exception(error)
+
+    def _execute(self, operation: Operation, wait: float):
+        if self.tracer is None:
+            return operation.function(*operation.args)
+        self.tracer.record(f"queue {operation.name}", time.time() - wait,
+                           wait * 1000, priority=operation.priority)
+        with self.tracer.span(operation.name, callers=operation.callers):
+            return operation.function(*operation.args)
+
+    def stats(self) -> dict:
+        """Gets the queue depth, the running operation and, per operation,
+        runs, coalesced and rejected calls, wait and run times"""
+        with self._condition:
+            running = None
+            if self._running is not None:
+                running = {
+                    "name": self._running.name,
+                    "running_ms":
+                        (time.monotonic() - self._running.started) * 1000,
+                    "callers": self._running.callers
+                }
+            return {
+                "queue_depth": len(self._queue),
+                "queued": [operation.name for _, _, operation
+                           in sorted(self._queue)],
+                "running": running,
+                "operations": {name: stats.to_dict()
+                               for name, stats in self._stats.items()}
+            }
@@ -0,0 +1,73 @@
+"""Pushes controller state snapshots to the API whenever they change"""
+
+import http.client
+import json
+import threading
+import time
+import urllib.request
+
+from loguru import logger
+
+
+class SnapshotPublisher(threading.Thread):
+    """Posts controller.snapshot() to the API's /internal/snapshot route
+    after every change, so the API can serve /status without an RPC.
+
+    Changes are coalesced: bursts of changes (e.g. ffmpeg progress, or a
+    stop/start sequence) result in one push per min_interval seconds.
+    """
+
+    def __init__(self,
+                 snapshot,
+                 url: str,
+                 min_interval: float = 0.2,
+                 timeout: float = 1.0):
+        """
+        Args:
+            snapshot (callable): returns the current snapshot (dict)
+            url (str): API address (e.g. http://localhost:8000)
+            min_interval (float): minimum seconds between pushes
+            timeout (float): request timeout (seconds)
+        """
+        super(SnapshotPublisher, self).__init__(name="snapshot-publisher",
+                                                daemon=True)
+        self._snapshot = snapshot
+        self._url = f"{url.rstrip('/')}/internal/snapshot"
+        self._min_interval = min_interval
+        self._timeout = timeout
+        self._changed = threading.Event()
+        self._failing = False
+
+    def changed(self):
+        """Schedules a push (cheap, safe to call from any thread)"""
+        self._changed.set()
+
+    def run(self):
+        while True:
+            self._changed.wait()
+            self._changed.clear()
+            try:
+                self._push()
+            except Exception:
+                # (the thread must survive, or /status is never updated)
+                logger.exception("snapshot: push failed")
+            time.sleep(self._min_interval)  # coalesce further changes
+
+    def _push(self):
+        """Posts the current snapshot to the API"""
+        body = json.dumps(self._snapshot(), default=str).encode("utf-8")
+        request = urllib.request.Request(
+            self._url, data=body, method="POST",
+            headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self._timeout):
+                pass
+            if self._failing:
+                logger.info(f"snapshot: reached {self._url}")
+            self._failing = False
+        except (OSError, http.client.HTTPException) as exc:
+            # the API may not be running yet, it fetches on first use
+            if not self._failing:
+                logger.debug(f"snapshot: could not reach {self._url} "
+                             f"({exc})")
+            self._failing = True
@@ -0,0 +1,178 @@
+"""Template matching against frames from fast screenshot mode"""
+
+import collections
+import threading
+import time
+
+import cv2
+import numpy as np
+
+LEVELS = 3  # pyramid levels kept per template (full, 1/2, 1/4 size)
+DEFAULT_LEVEL = 1  # frames are matched at half resolution by default
+
+
+def downscale(image: np.ndarray, level: int) -> np.ndarray:
+    """Halves an image's size level times"""
+    scale = 2 ** level
+    return cv2.resize(image, (max(image.shape[1] // scale, 1),
+                              max(image.shape[0] // scale, 1)),
+                      interpolation=cv2.INTER_AREA)
+
+
+class Template:
+    """Reference image, converted to grayscale and downscaled once when
+    uploaded rather than on every match"""
+
+    def __init__(self, name: str, data: bytes):
+        """
+        Args:
+            name (str): template name
+            data (bytes): encoded image (png or jpg)
+
+        Raises:
+            ValueError: data is not an image
+        """
+        image = cv2.imdecode(np.frombuffer(data, np.uint8),
+                             cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            raise ValueError(f"template {name} is not a png/jpg image")
+
+        self.name = name
+        self.height, self.width = image.shape
+        # downscaled the same way as frames are (see match)
+        self.levels = [image]
+        for level in range(1, LEVELS):
+            self.levels.append(downscale(image, level))
+
+    def info(self) -> dict:
+        """Gets the template's name and size"""
+        return {
+            "name": self.name,
+            "width": self.width,
+            "height": self.height
+        }
+
+
+class TemplateStore:
+    """Uploaded templates by name, least recently used are dropped"""
+
+    def __init__(self, size: int = 32):
+        self._size = size
+        self._templates = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, data: bytes) -> Template:
+        """Adds (or replaces) a template
+
+        Raises:
+            ValueError: data is not an image
+        """
+        template = Template(name, data)
+        with self._lock:
+            self._templates[name] = template
+            self._templates.move_to_end(name)
+            while len(self._templates) > self._size:
+                self._templates.popitem(last=False)
+        return template
+
+    def get(self, name: str) -> Template:
+        """Gets a template (None if there is none with that name)"""
+        with self._lock:
+            template = self._templates.get(name)
+            if template is not None:
+                self._templates.move_to_end(name)
+            return template
+
+    def remove(self, name: str) -> bool:
+        """Removes a template, returns whether it existed"""
+        with self._lock:
+            return self._templates.pop(name, None) is not None
+
+    def list(self) -> list:
+        """Gets the info of every template"""
+        with self._lock:
+            return [t.info() for t in self._templates.values()]
+
+
+def match(template: Template, frame: np.ndarray, region: list = None,
+          level: int = DEFAULT_LEVEL) -> dict:
+    """Finds the best match of a template in a frame
+
+    Args:
+        template (Template): template
+        frame (np.ndarray): BGR frame
+        region (list, optional): x, y, width, height to search (full
+            resolution, default: whole frame)
+        level (int, optional): pyramid level to match at (0: full
+            resolution, each level halves it)
+
+    Returns:
+        dict: score (-1 to 1, normalized correlation), x, y, width, height
+            of the match (full resolution). score is None if the region is
+            smaller than the template.
+    """
+    x0, y0 = 0, 0
+    if region:
+        x0, y0, w, h = region
+        frame = frame[y0:y0 + h, x0:x0 + w]
+
+    # only the searched region is converted and downscaled
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    scale = 2 ** level
+    if level:
+        gray = downscale(gray, level)
+    needle = template.levels[level]
+
+    result = {"score": None, "x": x0, "y": y0,
+              "width": template.width, "height": template.height}
+    if gray.shape[0] < needle.shape[0] or gray.shape[1] < needle.shape[1]:
+        return result
+
+    scores = cv2.matchTemplate(gray, needle, cv2.TM_CCOEFF_NORMED)
+    _, score, _, (x, y) = cv2.minMaxLoc(scores)
+    result.update(score=float(score), x=x0 + x * scale, y=y0 + y * scale)
+    return result
+
+
+def wait_for_match(next_frame, template: Template, threshold: float,
+                   region: list = None, level: int = DEFAULT_LEVEL,
+                   timeout: float = 10.0) -> dict:
+    """Matches new frames until one scores at least threshold.
+
+    Matching runs in the caller's thread on the latest frame, so a slow
+    match skips frames instead of delaying the capture loop.
+
+    Args:
+        next_frame (callable): next_frame(after, timeout) returns the
+            (sequence, frame) read after frame number after, or None
+        template (Template): template
+        threshold (float): minimum score
+        region (list, optional): x, y, width, height to search
+        level (int, optional): pyramid level to match at
+        timeout (float, optional): seconds to wait (0: match once)
+
+    Returns:
+        dict: best match (see match), matched, sequence, matches (number of
+            frames matched)
+    """
+    deadline = time.monotonic() + timeout
+    best = {"score": None, "sequence": None}
+    sequence = 0
+    matches = 0
+    while True:
+        latest = next_frame(sequence, max(deadline - time.monotonic(), 0.1))
+        if latest is None:
+            break
+        sequence, frame = latest
+        result = match(template, frame, region, level)
+        matches += 1
+        if best["score"] is None or (result["score"] or -1) > best["score"]:
+            best = dict(result, sequence=sequence)
+        if (result["score"] or -1) >= threshold:
+            break
+        if time.monotonic() >= deadline:
+            break
+
+    best["matched"] = (best["score"] or -1) >= threshold
+    best["matches"] = matches
+    return best
@@ -0,0 +1,88 @@
+"""Timecode images for measuring glass-to-glass latency
+
+A timecode is a 32 bit value (milliseconds) drawn as two rows of black and
+white cells, the second row inverted. Both rows must agree when decoding,
+so frames captured mid-refresh (half old, half new) are rejected. Cells
+are large enough to survive scaling and MJPEG compression.
+"""
+
+import numpy as np
+
+BITS = 32
+GUARD = [1, 0]  # white, black cells at both ends (the decode reference)
+CELLS = len(GUARD) * 2 + BITS
+
+
+def _row(value: int) -> list:
+    bits = [(value >> (BITS - 1 - i)) & 1 for i in range(BITS)]
+    return GUARD + bits + GUARD[::-1]
+
+
+def render(value: int, width: int = 1920, height: int = 1080) -> np.ndarray:
+    """Draws a timecode
+
+    Args:
+        value (int): value (taken modulo 2 ** 32)
+        width (int, optional): image width
+        height (int, optional): image height
+
+    Returns:
+        np.ndarray: BGR image
+    """
+    value %= 2 ** BITS
+    rows = [_row(value), [1 - b for b in _row(value)]]
+    cells = np.array(rows, np.uint8) * 255
+    # nearest neighbour upscale, cell edges spread over the whole image
+    ys = np.arange(height) * len(rows) // height
+    xs = np.arange(width) * CELLS // width
+    image = cells[ys][:, xs]
+    return np.repeat(image[:, :, None], 3, axis=2)
+
+
+def _read_row(gray: np.ndarray, inverted: bool = False) -> list:
+    """Samples the middle half of each cell of a row
+
+    Returns:
+        list: cell values (None if the guard cells are not black/white)
+    """
+    width = gray.shape[1]
+    height = gray.shape[0]
+    levels = []
+    for cell in range(CELLS):
+        left = (cell * width) // CELLS
+        right = ((cell + 1) * width) // CELLS
+        margin_x = (right - left) // 4
+        margin_y = height // 4
+        levels.append(gray[margin_y:height - margin_y,
+                           left + margin_x:right - margin_x].mean())
+    white, black = levels[0], levels[1]
+    if inverted:
+        white, black = black, white
+    if white - black < 64:  # not a timecode (or too dark to read)
+        return None
+    threshold = (white + black) / 2
+    return [int(level > threshold) for level in levels]
+
+
+def decode(frame: np.ndarray):
+    """Reads a timecode from a frame showing one full-screen
+
+    Args:
+        frame (np.ndarray): BGR or grayscale frame
+
+    Returns:
+        int: value (None if there is no readable timecode)
+    """
+    gray = frame.mean(axis=2) if frame.ndim == 3 else frame
+    half = gray.shape[0] // 2
+    top = _read_row(gray[:half])
+    bottom = _read_row(gray[half:], inverted=True)
+    if top is None or bottom is None:
+        return None
+    bottom = [1 - b for b in bottom]
+    if top != bottom or top[:2] != GUARD or top[-2:] != GUARD[::-1]:
+        return None
+    value = 0
+    for bit in top[len(GUARD):len(GUARD) + BITS]:
+        value = value << 1 | bit
+    return value
@@ -0,0 +1,296 @@
+"""Timelapse capture
+
+One frame every interval seconds, appended to an MJPEG AVI file as it is
+captured. The header is brought up to date every few frames, so the file
+plays (without an index) even if the capture is interrupted. The index
+is written when the timelapse ends.
+
+With the v4l2 capture backend and MJPEG input, the card's JPEG bytes are
+written as they are (no decode or encode), and for long intervals
+streaming is stopped between frames, so the device sends nothing in
+between. Otherwise (YUYV input, or the cv2 backend) each frame is encoded
+as JPEG.
+"""
+
+import array
+import os
+import struct
+import threading
+import time
+
+import cv2
+from loguru import logger
+
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+MAX_FILE_SIZE = 2 ** 31 - 2 ** 24  # AVI 1.0 (32 bit offsets, some signed)
+
+PAUSE_INTERVAL = 2.0  # seconds between frames from which streaming stops
+SETTLE_FRAMES = 2  # frames skipped after streaming (re)starts
+FLUSH_FRAMES = 10  # frames between header updates
+
+
+class MjpegAviWriter:
+    """Writes JPEG frames to an AVI file, incrementally"""
+
+    # header offsets of the fields updated as frames are added
+    _RIFF_SIZE = 4
+    _TOTAL_FRAMES = 48
+    _SUGGESTED_BUFFER = 60
+    _STREAM_LENGTH = 140
+    _STREAM_BUFFER = 144
+    _MOVI_SIZE = 216
+    _MOVI = 220  # index offsets are relative to this
+
+    def __init__(self, path: str, width: int, height: int, fps: float):
+        """
+        Args:
+            path (str): file (overwritten)
+            width (int): frame width
+            height (int): frame height
+            fps (float): playback frame rate
+        """
+        self.path = path
+        self.frames = 0
+        self.size = 0
+        self._index = array.array("I")  # offset, size per frame
+        self._max_frame = 0
+        self._file = open(path, "wb")
+        self._write_header(width, height, fps)
+
+    def _write_header(self, width: int, height: int, fps: float):
+        rate = int(round(fps * 1000))
+        avih = struct.pack("<14I", int(1e6 / fps), 0, 0, AVIF_HASINDEX,
+                           0, 0, 1, 0, width, height, 0, 0, 0, 0)
+        strh = struct.pack("<4s4sIHHIIIIIIII4h", b"vids", b"MJPG", 0, 0, 0,
+                           0, 1000, rate, 0, 0, 0, 0xFFFFFFFF, 0,
+                           0, 0, width, height)
+        strf = struct.pack("<IiiHH4sIiiII", 40, width, height, 1, 24,
+                           b"MJPG", width * height * 3, 0, 0, 0, 0)
+        strl = b"strl" + chunk(b"strh", strh) + chunk(b"strf", strf)
+        hdrl = b"hdrl" + chunk(b"avih", avih) + chunk(b"LIST", strl)
+        header = b"AVI " + chunk(b"LIST", hdrl) + b"LIST" \
+            + struct.pack("<I", 4) + b"movi"
+        self._file.write(b"RIFF" + struct.pack("<I", len(header)) + header)
+        self.size = self._file.tell()
+        assert self.size == self._MOVI + 4
+
+    def write(self, jpeg):
+        """Appends a frame
+
+        Args:
+            jpeg (bytes-like): JPEG data
+        """
+        length = len(jpeg)
+        self._index.extend((self.size - self._MOVI, length))
+        self._file.write(b"00dc" + struct.pack("<I", length))
+        self._file.write(jpeg)
+        if length % 2:
+            self._file.write(b"\0")  # (chunks are word aligned)
+        self.size += 8 + length + length % 2
+        self._max_frame = max(self._max_frame, length)
+        self.frames += 1
+        if self.frames % FLUSH_FRAMES == 0:
+            self.flush()
+
+    def _patch(self, offset: int, value: int):
+        self._file.seek(offset)
+        self._file.write(struct.pack("<I", value))
+
+    def flush(self):
+        """Updates the header to the frames written so far"""
+        self._patch(self._RIFF_SIZE, self.size - 8)
+        self._patch(self._TOTAL_FRAMES, self.frames)
+        self._patch(self._SUGGESTED_BUFFER, self._max_frame)
+        self._patch(self._STREAM_LENGTH, self.frames)
+        self._patch(self._STREAM_BUFFER, self._max_frame)
+        self._patch(self._MOVI_SIZE, self.size - self._MOVI)
+        self._file.seek(self.size)
+        self._file.flush()
+
+    def close(self):
+        """Writes the index and closes the file"""
+        if self._file.closed:
+            return
+        self.flush()
+        entries = array.array("I")
+        tag, = struct.unpack("<I", b"00dc")
+        for i in range(0, len(self._index), 2):
+            entries.extend((tag, AVIIF_KEYFRAME, self._index[i],
+                            self._index[i + 1]))
+        self._file.write(chunk(b"idx1", entries.tobytes()))
+        self.size = self._file.tell()
+        self._patch(self._RIFF_SIZE, self.size - 8)
+        self._file.close()
+
+
+def chunk(fourcc: bytes, data: bytes) -> bytes:
+    """Gets a RIFF chunk"""
+    return fourcc + struct.pack("<I", len(data)) + data \
+        + (b"\0" if len(data) % 2 else b"")
+
+
+class Timelapse(threading.Thread):
+    """Captures a frame every interval seconds into MJPEG AVI files (a new
+    part once a file reaches MAX_FILE_SIZE)"""
+
+    def __init__(self, cam, path: str, interval: float, length: float = 0,
+                 fps: float = 10.0, quality: int = 90, cpu: int = -1,
+                 on_part=None):
+        """
+        Args:
+            cam (cv2.VideoCapture or v4l2.V4l2Capture): opened and
+                configured device
+            path (str): file of the first part (.avi)
+            interval (float): seconds between frames
+            length (float, optional): seconds to capture for (0: until
+                stopped)
+            fps (float, optional): playback frame rate
+            quality (int, optional): JPEG quality of encoded frames
+            cpu (int, optional): core the capture loop runs on (-1: any)
+            on_part (callable, optional): called with the path of each part
+                after the first
+        """
+        super().__init__(name="timelapse", daemon=True)
+        self.cam = cam
+        self.path = path
+        self.interval = interval
+        self.length = length
+        self.fps = fps
+        self.quality = quality
+        self.cpu = cpu
+        self.on_part = on_part
+
+        # MJPEG bytes written as captured (v4l2 backend only)
+        self.native = hasattr(cam, "start")  # (v4l2.V4l2Capture)
+        self.passthrough = self.native and \
+            cam.get(cv2.CAP_PROP_FOURCC) == cv2.VideoWriter_fourcc(*"MJPG")
+        self.pause = self.passthrough and interval >= PAUSE_INTERVAL
+
+        self.parts = [path]
+        self.part_frames = [0]  # per part
+        self.frames = 0  # in all parts
+        self.skipped = 0  # frames that could not be captured in time
+        self.started = None
+        self.cpu_time = 0.0  # seconds of this thread's CPU time
+        self.writer = None
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def _capture_passthrough(self):
+        """Gets the JPEG bytes of a new frame (v4l2)"""
+        if self.pause:
+            # streaming restarts on grab: skip frames queued before
+            for _ in range(SETTLE_FRAMES):
+                frame = self.cam.grab()
+                if frame is not None:
+                    frame.release()
+        frame = self.cam.grab(latest=True)
+        if frame is None:
+            return None
+        with frame:
+            self._write(frame.data, frame.width, frame.height)
+        if self.pause:
+            self.cam.stop()
+        return True
+
+    def _capture_encoded(self):
+        """Reads, then encodes a new frame as JPEG"""
+        if self.native:
+            frame = self.cam.grab(latest=True)  # (v4l2, YUYV)
+            if frame is None:
+                return None
+            with frame:
+                image = frame.bgr()
+        else:
+            # (cv2) frames buffered since the last one are stale: grab them
+            # without decoding, then decode the newest (the buffer size is
+            # 0 or -1 when the backend does not report it)
+            buffered = max(int(self.cam.get(cv2.CAP_PROP_BUFFERSIZE)), 0)
+            for _ in range(buffered or 4):
+                self.cam.grab()
+            ok, image = self.cam.retrieve()
+            if not ok:
+                return None
+        ok, jpeg = cv2.imencode(".jpg", image,
+                                [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        height, width = image.shape[:2]
+        self._write(jpeg, width, height)
+        return True
+
+    def _write(self, jpeg, width: int, height: int):
+        if self.writer is None:  # (first frame, size as captured)
+            self.writer = MjpegAviWriter(self.path, width, height, self.fps)
+        elif self.writer.size + len(jpeg) > MAX_FILE_SIZE:
+            self.writer.close()
+            name, ext = os.path.splitext(self.path)
+            path = f"{name}_part{len(self.parts) + 1}{ext}"
+            self.parts.append(path)
+            self.part_frames.append(0)
+            self.writer = MjpegAviWriter(path, width, height, self.fps)
+            if self.on_part is not None:
+                self.on_part(path)
+        self.writer.write(jpeg)
+        self.part_frames[-1] += 1
+        self.frames += 1
+
+    def run(self):
+        if self.cpu >= 0:
+            try:
+                os.sched_setaffinity(0, {self.cpu})  # (this thread)
+            except OSError as exc:
+                logger.warning(f"could not pin to core {self.cpu}: {exc}")
+
+        capture = self._capture_passthrough if self.passthrough \
+            else self._capture_encoded
+        cpu_start = time.thread_time()
+        self.started = time.monotonic()
+        next_time = self.started
+        try:
+            while not self._stop_event.wait(
+                    max(next_time - time.monotonic(), 0)):
+                if capture() is None:
+                    logger.warning("timelapse: no frame")
+                now = time.monotonic()
+                if self.length and now - self.started >= self.length:
+                    break
+                next_time += self.interval
+                if next_time < now:  # (capture took longer than interval)
+                    missed = int((now - next_time) // self.interval) + 1
+                    self.skipped += missed
+                    next_time += missed * self.interval
+                self.cpu_time = time.thread_time() - cpu_start
+        except Exception as exc:
+            logger.exception("timelapse failed")
+            self.error = f"{type(exc).__name__}: {exc}"
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+            self.cam.release()
+            self.cpu_time = time.thread_time() - cpu_start
+        logger.info(f"timelapse: {self.frames} frames in "
+                    f"{len(self.parts)} file(s)")
+
+    def stop(self, timeout: float = 10.0):
+        """Ends the capture and finishes the files"""
+        self._stop_event.set()
+        self.join(timeout)
+
+    def stats(self) -> dict:
+        """Gets frames captured, frames skipped, elapsed seconds, CPU
+        seconds (and fraction of a core), bytes written, parts"""
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        size = sum(os.path.getsize(part) for part in self.parts
+                   if os.path.exists(part))
+        return {
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "elapsed": elapsed,
+            "cpu_time": self.cpu_time,
+            "cpu_fraction": self.cpu_time / elapsed if elapsed else 0.0,
+            "size": size,
+            "parts": list(self.parts),
+            "running": self.is_alive(),
+            "passthrough": self.passthrough,
+            "error": self.error
+        }
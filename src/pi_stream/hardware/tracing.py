@@ -0,0 +1,358 @@
+"""Request tracing
+
+A trace follows one API request into the hardware service. The API sends
+its trace id with each XML-RPC call in a W3C traceparent header, and the
+spans recorded while the call is handled (queue wait, controller
+operation, janus stop, device open, warm-up frames, encoding, USB reset)
+belong to that trace.
+
+Recording a span costs a few microseconds. Spans are held per trace in a
+bounded buffer of recent traces, and are only kept (and exported) when
+the request turns out slow or sampled: the API decides once it has
+responded (trace_keep RPC), the hardware service for calls that did not
+come from a traced request.
+"""
+
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+
+from loguru import logger
+
+# span being recorded (spans started while it is active are its children)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+TRACEPARENT = re.compile(r"00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})")
+
+
+def new_id(size: int) -> str:
+    """Gets a random trace (16 bytes) or span (8 bytes) id, as hex"""
+    return os.urandom(size).hex()
+
+
+def parse_traceparent(header: str):
+    """Reads a W3C traceparent header
+
+    Returns:
+        tuple: trace id, parent span id, sampled (None if invalid)
+    """
+    match = TRACEPARENT.fullmatch((header or "").strip())
+    if match is None:
+        return None
+    trace_id, span_id, flags = match.groups()
+    return trace_id, span_id, bool(int(flags, 16) & 1)
+
+
+def traceparent(trace_id: str, span_id: str, sampled: bool = False) -> str:
+    """Gets a W3C traceparent header"""
+    return f"00-{trace_id}-{span_id}-{'01' if sampled else '00'}"
+
+
+class Span:
+    """A timed operation of a trace"""
+
+    __slots__ = ["name", "trace_id", "span_id", "parent_id", "service",
+                 "start", "duration_ms", "attributes", "error", "_start"]
+
+    def __init__(self, name: str, trace_id: str, parent_id: str,
+                 service: str, attributes: dict):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id(8)
+        self.parent_id = parent_id
+        self.service = service
+        self.start = time.time()  # unix time
+        self._start = time.perf_counter()
+        self.duration_ms = None
+        self.attributes = attributes
+        self.error = None
+
+    def finish(self):
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+
+    def to_dict(self) -> dict:
+        """Gets the span as sent over XML-RPC (no integers above 2^31)"""
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "service": self.service,
+            "start": self.start,
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+
+def otlp_value(value) -> dict:
+    """Gets an OTLP/JSON AnyValue"""
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_traces(spans: list) -> dict:
+    """Gets an OTLP/JSON ExportTraceServiceRequest (one resource per
+    service)
+
+    Args:
+        spans (list): span dicts (see Span.to_dict)
+    """
+    by_service = collections.defaultdict(list)
+    for span in spans:
+        start = int(span["start"] * 1e9)
+        end = start + int(span["duration_ms"] * 1e6)
+        otlp_span = {
+            "traceId": span["trace_id"],
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "kind": 1,  # internal
+            "startTimeUnixNano": str(start),
+            "endTimeUnixNano": str(end),
+            "attributes": [{"key": key, "value": otlp_value(value)}
+                           for key, value in span["attributes"].items()],
+            "status": {"code": 1}  # ok
+        }
+        if span["parent_id"]:
+            otlp_span["parentSpanId"] = span["parent_id"]
+        if span["error"]:
+            otlp_span["status"] = {"code": 2, "message": span["error"]}
+        by_service[span["service"]].append(otlp_span)
+
+    return {"resourceSpans": [{
+        "resource": {"attributes": [
+            {"key": "service.name", "value": {"stringValue": service}}]},
+        "scopeSpans": [{"scope": {"name": "pi-stream"}, "spans": spans}]
+    } for service, spans in by_service.items()]}
+
+
+class OtlpExporter(threading.Thread):
+    """Posts kept spans to an OTLP/HTTP collector as JSON, in batches on
+    its own thread (spans are dropped while the collector is slow)"""
+
+    def __init__(self, endpoint: str, batch_size: int = 256,
+                 interval: float = 2.0, timeout: float = 2.0):
+        """
+        Args:
+            endpoint (str): collector traces URL
+                (example: http://localhost:4318/v1/traces)
+            batch_size (int, optional): spans per request
+            interval (float, optional): seconds between requests
+            timeout (float, optional): request timeout (seconds)
+        """
+        super().__init__(name="otlp-exporter", daemon=True)
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self._spans = queue.Queue(batch_size * 16)
+        self.exported = 0
+        self.dropped = 0
+
+    def export(self, spans: list):
+        """Queues spans (dicts) for the next batch"""
+        for span in spans:
+            try:
+                self._spans.put_nowait(span)
+            except queue.Full:
+                self.dropped += 1
+
+    def post(self, spans: list):
+        request = urllib.request.Request(
+            self.endpoint, json.dumps(otlp_traces(spans)).encode("utf-8"),
+            {"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+    def run(self):
+        while True:
+            batch = [self._spans.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._spans.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.post(batch)
+                self.exported += len(batch)
+            except OSError as exc:  # (collector unreachable)
+                self.dropped += len(batch)
+                logger.debug(f"OTLP export failed: {exc}")
+            except Exception:
+                # (the thread must survive, or nothing is exported again)
+                self.dropped += len(batch)
+                logger.exception("OTLP export failed")
+
+
+class Tracer:
+    """Records spans, and keeps the traces of slow or sampled requests"""
+
+    def __init__(self, service: str = "hardware", slow_ms: float = 1000.0,
+                 sample_rate: float = 0.0, capacity: int = 64,
+                 recent: int = 256, exporter: OtlpExporter = None):
+        """
+        Args:
+            service (str, optional): name of this service in the spans
+            slow_ms (float, optional): traces whose (local) root span
+                takes at least this long are kept
+            sample_rate (float, optional): fraction of other traces kept
+            capacity (int, optional): kept traces (the oldest are dropped)
+            recent (int, optional): traces held until kept or dropped
+            exporter (OtlpExporter, optional): kept spans are exported
+        """
+        self.service = service
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.capacity = capacity
+        self.recent = recent
+        self.exporter = exporter
+        self._recent = collections.OrderedDict()  # trace id: [span dict]
+        self._kept = collections.OrderedDict()  # trace id: [span dict]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, parent: tuple = None, **attributes):
+        """Records the enclosed code as a span (a child of the active
+        span, or of a remote span)
+
+        Args:
+            name (str): operation
+            parent (tuple, optional): trace id, span id, sampled of a remote
+                parent (see parse_traceparent)
+            attributes: recorded with the span (str, bool, int or float)
+        """
+        active = current_span.get()
+        sampled = False
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+        elif active is not None:
+            trace_id, parent_id = active.trace_id, active.span_id
+        else:
+            trace_id, parent_id = new_id(16), None
+
+        span = Span(name, trace_id, parent_id, self.service, attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.error = f"{type(exc).__name__}: {exc}"
+            raise
+        finally:
+            current_span.reset(token)
+            span.finish()
+            self._add(span.to_dict())
+            if active is None:  # root of this service's part of the trace
+                if parent is None:  # (not from a traced request)
+                    sampled = sampled or span.duration_ms >= self.slow_ms \
+                        or random.random() < self.sample_rate
+                if sampled:
+                    self.keep(trace_id)
+
+    def record(self, name: str, start: float, duration_ms: float,
+               **attributes):
+        """Records a span that already ended, as a child of the active span
+        (nothing is recorded outside of a span)
+
+        Args:
+            name (str): operation
+            start (float): unix time it started
+            duration_ms (float): how long it took
+        """
+        active = current_span.get()
+        if active is None:
+            return
+        span = Span(name, active.trace_id, active.span_id, self.service,
+                    attributes)
+        span.start = start
+        span.duration_ms = duration_ms
+        self._add(span.to_dict())
+
+    def _add(self, span: dict):
+        with self._lock:
+            kept = self._kept.get(span["trace_id"])
+            if kept is not None:  # (spans after the trace was kept)
+                kept.append(span)
+            else:
+                spans = self._recent.setdefault(span["trace_id"], [])
+                spans.append(span)
+                while len(self._recent) > self.recent:
+                    self._recent.popitem(last=False)
+                return
+        if self.exporter is not None:
+            self.exporter.export([span])
+
+    def keep(self, trace_id: str, spans: list = ()) -> int:
+        """Keeps a trace: its recent spans, and those recorded afterwards
+
+        Args:
+            trace_id (str): trace
+            spans (list, optional): span dicts of other services (the API)
+
+        Returns:
+            int: spans of this service in the trace
+        """
+        with self._lock:
+            local = self._recent.pop(trace_id, [])
+            kept = self._kept.setdefault(trace_id, [])
+            self._kept.move_to_end(trace_id)
+            kept.extend(local)
+            kept.extend(spans)
+            while len(self._kept) > self.capacity:
+                self._kept.popitem(last=False)
+        if self.exporter is not None:
+            self.exporter.export(local + list(spans))
+        return len(local)
+
+    def traces(self, limit: int = 20, min_ms: float = 0.0) -> list:
+        """Gets the kept traces, newest first
+
+        Args:
+            limit (int, optional): number of traces
+            min_ms (float, optional): minimum root span duration
+
+        Returns:
+            list: trace_id, duration_ms (of the root span), spans (by start)
+        """
+        with self._lock:
+            kept = [(trace_id, list(spans))
+                    for trace_id, spans in reversed(self._kept.items())]
+
+        traces = []
+        for trace_id, spans in kept:
+            spans.sort(key=lambda span: span["start"])
+            ids = {span["span_id"] for span in spans}
+            roots = [span for span in spans if span["parent_id"] not in ids]
+            duration = max((span["duration_ms"] for span in roots),
+                           default=0.0)
+            if duration < min_ms:
+                continue
+            traces.append({
+                "trace_id": trace_id,
+                "name": roots[0]["name"] if roots else "",
+                "duration_ms": duration,
+                "spans": spans
+            })
+            if len(traces) == limit:
+                break
+        return traces
+
+
+# (configured by xmlrpc_server.py)
+tracer = Tracer()
@@ -1,52 +1,353 @@
 """Utility Functions"""
 
+import ctypes
+import fcntl
+import glob
 import os
+import re
+import signal
+import time
+from typing import NamedTuple
 
 from loguru import logger
-import sh
 
 
-def force_stop(command_name: str):
-    """Runs pkill with SIGINT on any process with this name on the device"""
+# clock ticks per second and page size, used to interpret /proc
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# /proc/<pid>/comm is truncated to this many characters
+COMM_LENGTH = 15
+
+# last (cpu ticks, timestamp) seen for each process, for cpu_percent
+_cpu_samples = {}
+
+
+class ProcessInfo(NamedTuple):
+    """A process found in /proc.
+    (pid, start_time) identifies a process even if its pid is recycled"""
+    pid: int
+    start_time: int  # clock ticks after boot
+    name: str
+    cmdline: str
+
+
+def _read_stat(pid: int) -> list:
+    """Reads /proc/<pid>/stat, returning the fields after the command name
+    (so index 0 is field 3, 'state'). None if the process does not exist"""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read().decode("utf-8", errors="replace")
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    # the command name may itself contain spaces and parentheses
+    return stat[stat.rindex(")") + 2:].split()
+
+
+def _matches(pid: int, basename: str) -> bool:
+    """Whether a process' name is exactly basename"""
+    try:
+        with open(f"/proc/{pid}/comm", "rb") as f:
+            comm = f.read().decode("utf-8", errors="replace").strip()
+    except OSError:
+        return False
+
+    if comm == basename:
+        return True
+    # comm is truncated, so long names are checked against argv[0]
+    if len(basename) > COMM_LENGTH and comm == basename[:COMM_LENGTH]:
+        argv = _read_cmdline(pid).split(" ", 1)[0]
+        return os.path.basename(argv) == basename
+    return False
+
+
+def _read_cmdline(pid: int) -> str:
+    """Reads the command line of a process (empty if unavailable)"""
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            cmdline = f.read()
+    except OSError:
+        return ""
+    return cmdline.rstrip(b"\0").replace(b"\0", b" ").decode(
+        "utf-8", errors="replace")
+
+
+def find_processes(command_name: str) -> list:
+    """Scans /proc for running processes named exactly like the command
+    (zombies are not included)
+
+    Args:
+        command_name (str): command name or path
+
+    Returns:
+        list: ProcessInfo for each process, ordered by pid
+    """
     basename = os.path.basename(command_name)
-    logger.info(f"Force-Stopping {basename} ({command_name})...")
+    own_pid = os.getpid()
+    found = []
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        pid = int(entry.name)
+        if pid == own_pid or not _matches(pid, basename):
+            continue
+        stat = _read_stat(pid)
+        if stat is None or stat[0] in "ZX":
+            continue
+        found.append(ProcessInfo(pid, int(stat[19]), basename,
+                                 _read_cmdline(pid)))
+    return sorted(found)
+
+
+def is_running(process: ProcessInfo) -> bool:
+    """Whether this exact process (not a recycled pid) is still running"""
+    stat = _read_stat(process.pid)
+    return (stat is not None
+            and stat[0] not in "ZX"
+            and int(stat[19]) == process.start_time)
+
+
+def process_resources(process: ProcessInfo) -> dict:
+    """Gets CPU and memory usage of a process.
+    cpu_percent is measured since the previous call for this process
+    (or since the process started, on the first call)"""
+    key = (process.pid, process.start_time)
+    stat = _read_stat(process.pid)
+    if stat is None or int(stat[19]) != process.start_time:
+        _cpu_samples.pop(key, None)
+        return {}
+
+    ticks = int(stat[11]) + int(stat[12])  # utime + stime
+    now = time.monotonic()
+    if key in _cpu_samples:
+        last_ticks, last_time = _cpu_samples[key]
+    else:
+        _prune_cpu_samples()  # (a new process, others may have exited)
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        last_ticks = 0
+        last_time = now - (uptime - process.start_time / CLOCK_TICKS)
+    _cpu_samples[key] = (ticks, now)
+
+    elapsed = now - last_time
+    cpu_percent = 0.0
+    if elapsed > 0:
+        cpu_percent = 100 * (ticks - last_ticks) / CLOCK_TICKS / elapsed
+
+    return {
+        "cpu_percent": round(cpu_percent, 1),
+        "rss": int(stat[21]) * PAGE_SIZE,
+        "threads": int(stat[17])
+    }
+
+
+def _prune_cpu_samples():
+    """Forgets the CPU samples of processes that are no longer running"""
+    for pid, start_time in list(_cpu_samples):
+        stat = _read_stat(pid)
+        if stat is None or stat[0] in "ZX" or int(stat[19]) != start_time:
+            del _cpu_samples[(pid, start_time)]
+
+
+def send_signal(process: ProcessInfo, sig: int) -> bool:
+    """Signals a process, making sure its pid was not recycled
+
+    Returns:
+        bool: whether the signal was sent
+    """
+    # a pidfd keeps referring to the same process, so the identity check
+    # cannot race with the pid being reused
+    pidfd = None
     try:
-        pkill = sh.Command("pkill")
-        pkill("--signal", "SIGINT", basename)
-    except sh.ErrorReturnCode as exc:
+        if hasattr(os, "pidfd_open"):
+            pidfd = os.pidfd_open(process.pid)
+        if not is_running(process):
+            return False
+        if pidfd is not None:
+            signal.pidfd_send_signal(pidfd, sig)
+        else:
+            os.kill(process.pid, sig)
+        return True
+    except (ProcessLookupError, PermissionError) as exc:
         logger.debug(exc)
+        return False
+    finally:
+        if pidfd is not None:
+            os.close(pidfd)
+
+
+def force_stop(command_name: str, timeout: float = 5.0,
+               arguments: str = None):
+    """Stops any process with this name on the device (and, if given, whose
+    command line contains 'arguments', e.g. one device's janus config).
+    Sends SIGINT, then SIGTERM, then SIGKILL to processes that are still
+    running after 'timeout' seconds. Fails, listing them in 'remaining',
+    if some could not be stopped (e.g. not permitted to signal them)"""
+    basename = os.path.basename(command_name)
+    logger.info(f"Force-Stopping {basename} ({command_name})...")
+
+    remaining = [p for p in find_processes(command_name)
+                 if arguments is None or arguments in p.cmdline]
+    if not remaining:
+        logger.info(f"No {basename} process exists")
         return {
             "success": False
         }
 
-    logger.success(f"Force-Stopped {basename}")
+    pids = [p.pid for p in remaining]
+    sig = None
+    for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGKILL]:
+        # (processes that could not be signalled but still run are kept)
+        remaining = [p for p in remaining
+                     if send_signal(p, sig) or is_running(p)]
+        deadline = time.monotonic() + timeout
+        while remaining and time.monotonic() < deadline:
+            time.sleep(0.01)
+            remaining = [p for p in remaining if is_running(p)]
+        if not remaining:
+            break
+        logger.warning(f"{basename} did not stop after {sig.name}")
+
+    if remaining:
+        remaining_pids = [p.pid for p in remaining]
+        logger.error(f"Could not stop {basename} {remaining_pids}")
+        return {
+            "success": False,
+            "pids": pids,
+            "remaining": remaining_pids,
+            "signal": sig.name
+        }
+
+    logger.success(f"Force-Stopped {basename} {pids} ({sig.name})")
     return {
         "success": True,
+        "pids": pids,
+        "signal": sig.name
     }
 
 
 def force_exists(command_name: str):
-    """Runs pgrep, looking for any process with this name on the machine.
+    """Scans /proc, looking for any process with this name on the machine.
     Useful if there is a Janus process that the API is not keeping track of"""
     basename = os.path.basename(command_name)
-    logger.info(f"Looking for process {basename} ({command_name})...")
-    try:
-        pgrep = sh.Command("pgrep")
-        result = pgrep(basename)
-        pid = result.stdout.decode("utf-8").strip()
-
-        logger.warning(f"{basename} exists at PID:{pid}")
-        return {
-            "success": True,
-            "pid": pid
-        }
-    except sh.ErrorReturnCode as exc:
-        logger.debug(exc)
-        logger.info(f"No {basename} process exists")
+    processes = find_processes(command_name)
+    if not processes:
+        logger.debug(f"No {basename} process exists")
         return {
             "success": False
         }
 
+    pid = "\n".join(str(p.pid) for p in processes)
+    logger.warning(f"{basename} exists at PID:{pid}")
+    return {
+        "success": True,
+        "pid": pid,
+        "processes": [{
+            "pid": p.pid,
+            "start_time": p.start_time / CLOCK_TICKS,  # seconds after boot
+            "cmdline": p.cmdline,
+            **process_resources(p)
+        } for p in processes]
+    }
+
+
+class _V4l2Format(ctypes.Structure):
+    """struct v4l2_format (only used to ask the driver for the format)"""
+    class _Fmt(ctypes.Union):
+        # the real union contains pointers, which sets its alignment
+        _fields_ = [("raw_data", ctypes.c_uint8 * 200),
+                    ("_align", ctypes.c_void_p)]
+
+    _fields_ = [("type", ctypes.c_uint32),
+                ("fmt", _Fmt)]
+
+
+# _IOWR('V', 4, struct v4l2_format)
+VIDIOC_G_FMT = (3 << 30) | (ctypes.sizeof(_V4l2Format) << 16) \
+    | (ord("V") << 8) | 4
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+
+
+def v4l2_ready(device: str) -> bool:
+    """Whether a V4L2 device node exists and answers a format query"""
+    try:
+        fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+    except OSError:
+        return False
+    try:
+        fmt = _V4l2Format(type=V4L2_BUF_TYPE_VIDEO_CAPTURE)
+        fcntl.ioctl(fd, VIDIOC_G_FMT, fmt)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def alsa_ready(name: str) -> bool:
+    """Whether an ALSA device (e.g. hw:1 or hw:CARD=MS2109,DEV=0)
+    has a capture PCM
+
+    Args:
+        name (str): ALSA device name
+    """
+    match = re.match(r"(?:plug)?hw:(?:CARD=)?([^,]+)(?:,(?:DEV=)?(\d+))?",
+                     name)
+    if not match:
+        return True  # not a hardware device, nothing to check
+    card, dev = match.group(1), match.group(2) or "0"
+    prefix = "card" if card.isdigit() else ""
+    return os.path.exists(f"/proc/asound/{prefix}{card}/pcm{dev}c/info")
+
+
+def find_usb_sysfs(id_vendor: int, id_product: int) -> str:
+    """Finds the sysfs directory of a USB device
+
+    Returns:
+        str: path (e.g. /sys/bus/usb/devices/1-1.3), None if not found
+    """
+    for path in glob.glob("/sys/bus/usb/devices/*"):
+        try:
+            with open(f"{path}/idVendor") as f:
+                vendor = int(f.read(), 16)
+            with open(f"{path}/idProduct") as f:
+                product = int(f.read(), 16)
+        except (OSError, ValueError):
+            continue
+        if (vendor, product) == (id_vendor, id_product):
+            return path
+    return None
+
+
+def process_age() -> float:
+    """Seconds since this process was started (including interpreter
+    startup and imports)"""
+    stat = _read_stat(os.getpid())
+    with open("/proc/uptime") as f:
+        uptime = float(f.read().split()[0])
+    return uptime - int(stat[19]) / CLOCK_TICKS
+
+
+class StartupTimer:
+    """Records how long each startup phase takes, for a report at boot"""
+
+    def __init__(self):
+        self._phases = [("imports", process_age())]
+        self._last = time.perf_counter()
+
+    def phase(self, name: str):
+        """Ends the current phase"""
+        now = time.perf_counter()
+        self._phases.append((name, now - self._last))
+        self._last = now
+
+    def report(self) -> str:
+        """Gets the phase durations and total as a log line"""
+        phases = ", ".join(f"{name} {duration * 1000:.0f} ms"
+                           for name, duration in self._phases)
+        total = sum(duration for _, duration in self._phases)
+        return f"Startup: {phases} (total {total * 1000:.0f} ms)"
+
 
 def video_length(path: str) -> float:
     """Gets the length of a video in seconds
@@ -64,6 +365,8 @@ def video_length(path: str) -> float:
             path
             ]
 
+    import sh  # slow to import, only needed here
+
     try:
         ffprobe = sh.Command("ffprobe")
         result = ffprobe(*(args))
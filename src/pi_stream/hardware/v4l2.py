@@ -0,0 +1,436 @@
+"""Native V4L2 capture (ioctl + mmap streaming I/O), without
+cv2.VideoCapture's extra buffering and copies
+
+Frames are handed out as views of the driver's mapped buffers and given
+back to the driver when released. V4l2Capture also implements the parts of
+the cv2.VideoCapture interface used in this project (open, set, get, read,
+isOpened, release), so it can be used in its place.
+"""
+
+import ctypes
+import fcntl
+import mmap
+import os
+import select
+import time
+
+import numpy as np
+from loguru import logger
+
+# cv2.CAP_PROP_* ids accepted by set/get (same values as cv2)
+CAP_PROP_POS_MSEC = 0
+CAP_PROP_FRAME_WIDTH = 3
+CAP_PROP_FRAME_HEIGHT = 4
+CAP_PROP_FPS = 5
+CAP_PROP_FOURCC = 6
+CAP_PROP_BUFFERSIZE = 38
+
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_MEMORY_MMAP = 1
+V4L2_FIELD_ANY = 0
+
+
+def fourcc(code: str) -> int:
+    """Gets a pixel format code (same as cv2.VideoWriter_fourcc)"""
+    return int.from_bytes(code.encode("ascii"), "little")
+
+
+V4L2_PIX_FMT_MJPEG = fourcc("MJPG")
+V4L2_PIX_FMT_YUYV = fourcc("YUYV")
+
+
+# structures (linux/videodev2.h)
+class v4l2_pix_format(ctypes.Structure):
+    _fields_ = [("width", ctypes.c_uint32),
+                ("height", ctypes.c_uint32),
+                ("pixelformat", ctypes.c_uint32),
+                ("field", ctypes.c_uint32),
+                ("bytesperline", ctypes.c_uint32),
+                ("sizeimage", ctypes.c_uint32),
+                ("colorspace", ctypes.c_uint32),
+                ("priv", ctypes.c_uint32),
+                ("flags", ctypes.c_uint32),
+                ("ycbcr_enc", ctypes.c_uint32),
+                ("quantization", ctypes.c_uint32),
+                ("xfer_func", ctypes.c_uint32)]
+
+
+class v4l2_format(ctypes.Structure):
+    class _Fmt(ctypes.Union):
+        # the real union contains pointers, which sets its alignment
+        _fields_ = [("pix", v4l2_pix_format),
+                    ("raw_data", ctypes.c_uint8 * 200),
+                    ("_align", ctypes.c_void_p)]
+
+    _fields_ = [("type", ctypes.c_uint32),
+                ("fmt", _Fmt)]
+
+
+class v4l2_requestbuffers(ctypes.Structure):
+    _fields_ = [("count", ctypes.c_uint32),
+                ("type", ctypes.c_uint32),
+                ("memory", ctypes.c_uint32),
+                ("capabilities", ctypes.c_uint32),
+                ("flags", ctypes.c_uint8),
+                ("reserved", ctypes.c_uint8 * 3)]
+
+
+class timeval(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long),
+                ("tv_usec", ctypes.c_long)]
+
+
+class v4l2_timecode(ctypes.Structure):
+    _fields_ = [("type", ctypes.c_uint32),
+                ("flags", ctypes.c_uint32),
+                ("frames", ctypes.c_uint8),
+                ("seconds", ctypes.c_uint8),
+                ("minutes", ctypes.c_uint8),
+                ("hours", ctypes.c_uint8),
+                ("userbits", ctypes.c_uint8 * 4)]
+
+
+class v4l2_buffer(ctypes.Structure):
+    class _M(ctypes.Union):
+        _fields_ = [("offset", ctypes.c_uint32),
+                    ("userptr", ctypes.c_ulong),
+                    ("planes", ctypes.c_void_p),
+                    ("fd", ctypes.c_int32)]
+
+    _fields_ = [("index", ctypes.c_uint32),
+                ("type", ctypes.c_uint32),
+                ("bytesused", ctypes.c_uint32),
+                ("flags", ctypes.c_uint32),
+                ("field", ctypes.c_uint32),
+                ("timestamp", timeval),
+                ("timecode", v4l2_timecode),
+                ("sequence", ctypes.c_uint32),
+                ("memory", ctypes.c_uint32),
+                ("m", _M),
+                ("length", ctypes.c_uint32),
+                ("reserved2", ctypes.c_uint32),
+                ("request_fd", ctypes.c_int32)]
+
+
+class v4l2_fract(ctypes.Structure):
+    _fields_ = [("numerator", ctypes.c_uint32),
+                ("denominator", ctypes.c_uint32)]
+
+
+class v4l2_captureparm(ctypes.Structure):
+    _fields_ = [("capability", ctypes.c_uint32),
+                ("capturemode", ctypes.c_uint32),
+                ("timeperframe", v4l2_fract),
+                ("extendedmode", ctypes.c_uint32),
+                ("readbuffers", ctypes.c_uint32),
+                ("reserved", ctypes.c_uint32 * 4)]
+
+
+class v4l2_streamparm(ctypes.Structure):
+    class _Parm(ctypes.Union):
+        _fields_ = [("capture", v4l2_captureparm),
+                    ("raw_data", ctypes.c_uint8 * 200)]
+
+    _fields_ = [("type", ctypes.c_uint32),
+                ("parm", _Parm)]
+
+
+def _iowr(nr: int, struct) -> int:
+    return (3 << 30) | (ctypes.sizeof(struct) << 16) | (ord("V") << 8) | nr
+
+
+def _iow(nr: int, struct) -> int:
+    return (1 << 30) | (ctypes.sizeof(struct) << 16) | (ord("V") << 8) | nr
+
+
+VIDIOC_S_FMT = _iowr(5, v4l2_format)
+VIDIOC_REQBUFS = _iowr(8, v4l2_requestbuffers)
+VIDIOC_QUERYBUF = _iowr(9, v4l2_buffer)
+VIDIOC_QBUF = _iowr(15, v4l2_buffer)
+VIDIOC_DQBUF = _iowr(17, v4l2_buffer)
+VIDIOC_STREAMON = _iow(18, ctypes.c_int)
+VIDIOC_STREAMOFF = _iow(19, ctypes.c_int)
+VIDIOC_S_PARM = _iowr(22, v4l2_streamparm)
+
+
+class Frame:
+    """A captured frame, a view of a driver buffer until released"""
+
+    def __init__(self, capture, buffer: v4l2_buffer, data: memoryview):
+        self._capture = capture
+        self.index = buffer.index
+        self.sequence = buffer.sequence  # driver frame counter
+        # time.monotonic clock (UVC drivers use CLOCK_MONOTONIC)
+        self.timestamp = buffer.timestamp.tv_sec \
+            + buffer.timestamp.tv_usec / 1e6
+        self.width = capture.width
+        self.height = capture.height
+        self.pixelformat = capture.pixelformat
+        self.data = data  # bytesused bytes of the mapped buffer
+
+    @property
+    def format(self) -> str:
+        """Pixel format name (YUYV, MJPG)"""
+        return self.pixelformat.to_bytes(4, "little").decode("ascii")
+
+    def array(self) -> np.ndarray:
+        """Gets the frame as an array (no copy): (height, width, 2) for
+        YUYV, the compressed bytes (1 dimensional) for MJPEG"""
+        data = np.frombuffer(self.data, np.uint8)
+        if self.pixelformat == V4L2_PIX_FMT_YUYV:
+            return data[:self.height * self.width * 2] \
+                .reshape(self.height, self.width, 2)
+        return data
+
+    def bgr(self) -> np.ndarray:
+        """Decodes (or converts) the frame to a new BGR image"""
+        import cv2
+        if self.pixelformat == V4L2_PIX_FMT_YUYV:
+            return cv2.cvtColor(self.array(), cv2.COLOR_YUV2BGR_YUYV)
+        return cv2.imdecode(self.array(), cv2.IMREAD_COLOR)
+
+    def release(self):
+        """Gives the buffer back to the driver (the frame can no longer be
+        used)"""
+        if self.data is not None:
+            self.data.release()
+            self.data = None
+            self._capture._queue(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class V4l2Capture:
+    """V4L2 streaming capture with mmap'd driver buffers"""
+
+    def __init__(self, device: str = None, buffers: int = 4):
+        """
+        Args:
+            device (str, optional): device path (or see open)
+            buffers (int, optional): driver buffers to request. Fewer means
+                less latency, more tolerates slower consumers.
+        """
+        self.device = device
+        self.buffers = buffers
+        self.width = 1920
+        self.height = 1080
+        self.pixelformat = V4L2_PIX_FMT_MJPEG
+        self.fps = 0  # driver default
+        self.bytesperline = 0
+
+        self._fd = None
+        self._maps = []
+        self._streaming = False
+        self._last_timestamp = 0.0
+
+        # copy of the last frame read as captured (format, shape, bytes),
+        # kept while keep_native is set
+        self.keep_native = False
+        self.native = None
+        if device is not None:
+            self.open(device)
+
+    # cv2.VideoCapture interface
+    def open(self, device: str) -> bool:
+        """Opens the device node (streaming starts on the first read)"""
+        self.release()
+        self.device = device
+        try:
+            self._fd = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+        except OSError as exc:
+            logger.error(f"v4l2: {exc}")
+            self._fd = None
+        return self._fd is not None
+
+    def isOpened(self) -> bool:
+        return self._fd is not None
+
+    def set(self, prop: int, value) -> bool:
+        """Sets a capture parameter (applied when streaming (re)starts)"""
+        settings = {
+            CAP_PROP_FRAME_WIDTH: "width",
+            CAP_PROP_FRAME_HEIGHT: "height",
+            CAP_PROP_FPS: "fps",
+            CAP_PROP_FOURCC: "pixelformat",
+            CAP_PROP_BUFFERSIZE: "buffers"
+        }
+        if prop not in settings:
+            return False
+        setattr(self, settings[prop], int(value))
+        if self._streaming:
+            self.stop()
+        return True
+
+    def get(self, prop: int) -> float:
+        settings = {
+            CAP_PROP_POS_MSEC: self._last_timestamp * 1000,
+            CAP_PROP_FRAME_WIDTH: self.width,
+            CAP_PROP_FRAME_HEIGHT: self.height,
+            CAP_PROP_FPS: self.fps,
+            CAP_PROP_FOURCC: self.pixelformat,
+            CAP_PROP_BUFFERSIZE: self.buffers
+        }
+        return float(settings.get(prop, 0))
+
+    def read(self, image=None) -> tuple:
+        """Reads the next frame as a BGR image
+
+        Returns:
+            tuple: success, image (None if no frame, as cv2)
+        """
+        frame = self.grab()
+        if frame is None:
+            return False, None
+        try:
+            with frame:
+                self.native = (frame.format, frame.array().shape,
+                               frame.data.tobytes()) \
+                    if self.keep_native else None
+                return True, frame.bgr()
+        except OSError as exc:  # (giving the buffer back, e.g. unplugged)
+            logger.error(f"v4l2: {exc}")
+            return False, None
+
+    def release(self):
+        """Stops streaming and closes the device"""
+        if self._fd is None:
+            return
+        self.stop()
+        os.close(self._fd)
+        self._fd = None
+
+    # streaming
+    def start(self):
+        """Sets the format, maps the driver's buffers and starts streaming
+
+        Raises:
+            OSError: the device rejected the format or buffers
+        """
+        fmt = v4l2_format(type=V4L2_BUF_TYPE_VIDEO_CAPTURE)
+        fmt.fmt.pix.width = self.width
+        fmt.fmt.pix.height = self.height
+        fmt.fmt.pix.pixelformat = self.pixelformat
+        fmt.fmt.pix.field = V4L2_FIELD_ANY
+        fcntl.ioctl(self._fd, VIDIOC_S_FMT, fmt)
+        # the driver may have adjusted the format
+        self.width = fmt.fmt.pix.width
+        self.height = fmt.fmt.pix.height
+        self.pixelformat = fmt.fmt.pix.pixelformat
+        self.bytesperline = fmt.fmt.pix.bytesperline
+
+        if self.fps:
+            parm = v4l2_streamparm(type=V4L2_BUF_TYPE_VIDEO_CAPTURE)
+            parm.parm.capture.timeperframe.numerator = 1
+            parm.parm.capture.timeperframe.denominator = self.fps
+            fcntl.ioctl(self._fd, VIDIOC_S_PARM, parm)
+
+        request = v4l2_requestbuffers(count=self.buffers,
+                                      type=V4L2_BUF_TYPE_VIDEO_CAPTURE,
+                                      memory=V4L2_MEMORY_MMAP)
+        fcntl.ioctl(self._fd, VIDIOC_REQBUFS, request)
+        try:
+            for index in range(request.count):
+                buffer = v4l2_buffer(index=index,
+                                     type=V4L2_BUF_TYPE_VIDEO_CAPTURE,
+                                     memory=V4L2_MEMORY_MMAP)
+                fcntl.ioctl(self._fd, VIDIOC_QUERYBUF, buffer)
+                self._maps.append(mmap.mmap(
+                    self._fd, buffer.length, mmap.MAP_SHARED,
+                    mmap.PROT_READ | mmap.PROT_WRITE,
+                    offset=buffer.m.offset))
+                self._queue(index)
+
+            fcntl.ioctl(self._fd, VIDIOC_STREAMON,
+                        ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+        except OSError:
+            for buffer_map in self._maps:  # (none handed out yet)
+                buffer_map.close()
+            self._maps = []
+            raise
+        self._streaming = True
+        logger.debug(f"v4l2: streaming {self.width}x{self.height} "
+                     f"{self.pixelformat.to_bytes(4, 'little').decode()} "
+                     f"with {request.count} buffers")
+
+    def stop(self):
+        """Stops streaming and frees the buffers (frames must have been
+        released)"""
+        if not self._streaming:
+            return
+        fcntl.ioctl(self._fd, VIDIOC_STREAMOFF,
+                    ctypes.c_int(V4L2_BUF_TYPE_VIDEO_CAPTURE))
+        for buffer_map in self._maps:
+            buffer_map.close()
+        self._maps = []
+        fcntl.ioctl(self._fd, VIDIOC_REQBUFS, v4l2_requestbuffers(
+            count=0, type=V4L2_BUF_TYPE_VIDEO_CAPTURE,
+            memory=V4L2_MEMORY_MMAP))
+        self._streaming = False
+
+    def grab(self, timeout: float = 2.0, latest: bool = False) -> Frame:
+        """Waits for the next frame
+
+        Args:
+            timeout (float, optional): seconds to wait
+            latest (bool, optional): skip frames that were already waiting
+                (e.g. after being idle), returning the newest one
+
+        Returns:
+            Frame: frame (release it when done), None on timeout or device
+                error (logged, as cv2)
+        """
+        if self._fd is None:
+            return None
+        try:
+            return self._grab(timeout, latest)
+        except OSError as exc:  # e.g. EBUSY (device in use), EIO (unplugged)
+            logger.error(f"v4l2: {exc}")
+            return None
+
+    def _grab(self, timeout: float, latest: bool) -> Frame:
+        if not self._streaming:
+            self.start()
+
+        deadline = time.monotonic() + timeout
+        buffer = None
+        while buffer is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            readable, _, _ = select.select([self._fd], [], [], remaining)
+            if readable:
+                buffer = self._dequeue()
+
+        if latest:
+            while True:
+                newer = self._dequeue()
+                if newer is None:
+                    break
+                self._queue(buffer.index)
+                buffer = newer
+
+        self._last_timestamp = buffer.timestamp.tv_sec \
+            + buffer.timestamp.tv_usec / 1e6
+        data = memoryview(self._maps[buffer.index])[:buffer.bytesused]
+        return Frame(self, buffer, data)
+
+    def _dequeue(self) -> v4l2_buffer:
+        """Takes a filled buffer from the driver (None if there is none)"""
+        buffer = v4l2_buffer(type=V4L2_BUF_TYPE_VIDEO_CAPTURE,
+                             memory=V4L2_MEMORY_MMAP)
+        try:
+            fcntl.ioctl(self._fd, VIDIOC_DQBUF, buffer)
+        except BlockingIOError:
+            return None
+        return buffer
+
+    def _queue(self, index: int):
+        """Gives a buffer to the driver to fill"""
+        buffer = v4l2_buffer(index=index,
+                             type=V4L2_BUF_TYPE_VIDEO_CAPTURE,
+                             memory=V4L2_MEMORY_MMAP)
+        fcntl.ioctl(self._fd, VIDIOC_QBUF, buffer)
@@ -1,12 +1,22 @@
 """XMLRPC server for controlling RPi hardware"""
 
-from xmlrpc.server import SimpleXMLRPCServer
+import os
+from socketserver import ThreadingMixIn
+from xmlrpc.server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
 
 from loguru import logger
 from pydantic import BaseSettings
 
+from audio import AUDIO_PROFILES, LATENCY_TRACER_ENV, RtpReceiver
+from audio import audio_pipeline
 from controller import Controller
-from background_process import BackgroundProcess
+from dispatcher import DeviceDispatcher, device_settings
+from scheduler import Scheduler
+from snapshot import SnapshotPublisher
+from tracing import OtlpExporter, current_span, parse_traceparent, tracer
+from background_process import BackgroundProcess, RestartPolicy
+from background_process import janus_admin_ping, output_watchdog
+from util import StartupTimer
 
 
 class Settings(BaseSettings):
@@ -16,11 +26,58 @@ class Settings(BaseSettings):
     # xmlrpc
     port: int = 1234
 
+    # API that state snapshots are pushed to (empty to disable)
+    api_addr: str = "http://localhost:8000"
+
     # STUN
     stun: bool = True  # use STUN (not needed on unrestrictive LAN)
     stun_addr: str = "stun.l.google.com:19302"  # STUN server address
 
+    # Janus admin API (see config/janus.transport.http.jcfg, janus.jcfg)
+    janus_admin_addr: str = "http://127.0.0.1:7088/admin"
+    janus_admin_secret: str = "janusoverlord"
+
+    # process supervision
+    stop_timeout: float = 5.0  # seconds to wait after each stop signal
+    auto_restart: bool = True  # restart janus/gstreamer if they exit
+    gstreamer_watchdog: float = 15.0  # seconds without output (0 disables)
+    process_log_size: int = 65536  # bytes of output kept per process
+    process_log_rate: float = 20.0  # lines/s forwarded to log when verbose
+
+    # audio
+    audio_profile: str = "default"  # see audio.AUDIO_PROFILES
+    audio_latency_trace: bool = False  # measure pipeline latency (tracer)
+    audio_ring_seconds: float = 30.0  # recent audio kept for clips (0: off)
+    audio_ring_port: int = 5004  # local port the ring receives RTP on
+    audio_silence_level: float = -60.0  # peak dBFS below which is silence
+
+    # screenshots
+    burst_max_frames: int = 60  # frames per burst (~6 MB each at 1080p)
+    capture_backend: str = "cv2"  # cv2 or v4l2 (native mmap capture)
+    # seconds the capture is kept open after a cv2 screenshot, serving
+    # the next ones (0: closed and USB reset after every screenshot)
+    screenshot_warm_ttl: float = 30.0
+
+    # timelapses (see timelapse.py)
+    timelapse_capture_fps: int = 5  # requested from the device
+    timelapse_quality: int = 90  # JPEG quality of encoded (YUYV) frames
+
+    # tracing (see tracing.py)
+    trace_slow_ms: float = 1000.0  # calls at least this slow are kept
+    trace_sample_rate: float = 0.0  # fraction of other calls kept
+    trace_capacity: int = 64  # kept traces
+    # OTLP/HTTP collector kept spans are exported to (empty to disable,
+    # example: http://localhost:4318/v1/traces)
+    otlp_endpoint: str = ""
+
     # Devices
+    device_id: str = "main"  # prefix of this device's methods (see devices)
+    # other devices: settings that differ from these, and device_id
+    # (example: [{"device_id": "hdmi2", "v4l2": "/dev/video2", ...}])
+    devices: list = []
+    cpu: int = -1  # core for the capture thread and processes (-1: any)
+    audio_port: int = 5002  # janus streaming mountpoint RTP port
+    janus_config_dir: str = ""  # janus -F (own mountpoint, ports)
     v4l2: str = "/dev/video0"  # v4l2 device path
     alsa: str = "hw:1"  # ALSA device name
     id_vendor: str = "0x534d"  # First half of 'lsusb' device id (hex)
@@ -34,43 +91,142 @@ class Settings(BaseSettings):
     recording_files_dir: str = "/home/pi/recordings"
 
 
-if __name__ == "__main__":
-    settings = Settings()
+class TracingRequestHandler(SimpleXMLRPCRequestHandler):
+    """Records each call as a span, continuing the caller's trace
+    (traceparent header)"""
 
-    # gstreamer settings
-    GSTREAMER_PIPELINE = f"""
-    alsasrc device=\"{settings.alsa}\" !
-        opusenc bitrate=48000 !
-            rtpopuspay ! udpsink host=127.0.0.1 port=5002
-    """
+    def do_POST(self):
+        parent = parse_traceparent(self.headers.get("traceparent"))
+        with tracer.span("xmlrpc", parent):
+            super().do_POST()
 
-    # Create server
-    addr = ('localhost', settings.port)
-    with SimpleXMLRPCServer(addr, allow_none=True) as server:
-        server.register_introspection_functions()
 
-        # create janus process wrapper
-        janus_args = ""
-        if settings.stun:
-            janus_args = f"-P {settings.plugins_dir} -S {settings.stun_addr}"
-        else:
-            janus_args = f"-P {settings.plugins_dir}"
+class ThreadingXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """Serves each request on its own thread, so long polls and status
+    calls are not held up by a running operation (operations that change
+    the controller's state are serialized by its Scheduler)"""
+    daemon_threads = True
 
-        janus = BackgroundProcess("janus",
-                                  janus_args,
-                                  verbose=settings.verbose)
+    def _dispatch(self, method, params):
+        span = current_span.get()
+        if span is not None:
+            span.name = f"xmlrpc {method}"
+        return super()._dispatch(method, params)
 
-        # create gstreamer process wrapper
-        gstreamer = BackgroundProcess("gst-launch-1.0",
-                                      GSTREAMER_PIPELINE,
-                                      verbose=settings.verbose)
 
-        # create ffmpeg process wrapper (args provided at start-time)
-        ffmpeg = BackgroundProcess("ffmpeg",
-                                   verbose=settings.verbose)
+def create_controller(settings: Settings) -> Controller:
+    """Creates the processes and controller of a device"""
+    # gstreamer settings
+    ring_port = settings.audio_ring_port if settings.audio_ring_seconds else 0
+    GSTREAMER_PIPELINE = audio_pipeline(settings.alsa,
+                                        AUDIO_PROFILES[settings.audio_profile],
+                                        settings.audio_port,
+                                        ring_port)
+    cpus = {settings.cpu} if settings.cpu >= 0 else None
+
+    # create janus process wrapper
+    janus_args = ""
+    if settings.stun:
+        janus_args = f"-P {settings.plugins_dir} -S {settings.stun_addr}"
+    else:
+        janus_args = f"-P {settings.plugins_dir}"
+    if settings.janus_config_dir:
+        janus_args += f" -F {settings.janus_config_dir}"
+
+    restart_policy = None
+    if settings.auto_restart:
+        restart_policy = RestartPolicy()
+
+    janus = BackgroundProcess(
+        "janus",
+        janus_args,
+        verbose=settings.verbose,
+        restart_policy=restart_policy,
+        health_check=janus_admin_ping(settings.janus_admin_addr,
+                                      settings.janus_admin_secret),
+        stop_timeout=settings.stop_timeout,
+        log_size=settings.process_log_size,
+        log_rate=settings.process_log_rate)
+
+    # create gstreamer process wrapper
+    # (progressreport prints every 5 s, feeding the output watchdog)
+    gstreamer_health = None
+    if settings.gstreamer_watchdog > 0:
+        gstreamer_health = output_watchdog(settings.gstreamer_watchdog)
+    gstreamer = BackgroundProcess("gst-launch-1.0",
+                                  GSTREAMER_PIPELINE,
+                                  verbose=settings.verbose,
+                                  restart_policy=restart_policy,
+                                  health_check=gstreamer_health,
+                                  stop_timeout=settings.stop_timeout,
+                                  log_size=settings.process_log_size,
+                                  log_rate=settings.process_log_rate,
+                                  env=LATENCY_TRACER_ENV
+                                  if settings.audio_latency_trace
+                                  else None,
+                                  cpus=cpus)
+
+    # create ffmpeg process wrapper (args provided at start-time)
+    # (never restarted automatically, recordings have a fixed length)
+    ffmpeg = BackgroundProcess("ffmpeg",
+                               verbose=settings.verbose,
+                               stop_timeout=settings.stop_timeout,
+                               log_size=settings.process_log_size,
+                               log_rate=settings.process_log_rate,
+                               cpus=cpus)
+
+    os.makedirs(settings.recording_files_dir, exist_ok=True)
+    controller = Controller(janus, gstreamer, ffmpeg, settings)
+    if ring_port:
+        RtpReceiver(controller.audio_ring, ring_port).start()
+
+    if settings.verbose:
+        logger.debug(f"{settings.device_id}: ALSA device: {settings.alsa}, "
+                     f"v4l2 device: {settings.v4l2}, USB id "
+                     f"{settings.id_vendor}:{settings.id_product}, "
+                     f"core: {settings.cpu if cpus else 'any'}")
+    return controller
 
-        controller = Controller(janus, gstreamer, ffmpeg, settings)
-        server.register_instance(controller)
+
+if __name__ == "__main__":
+    timer = StartupTimer()
+    settings = Settings()
+    timer.phase("settings")
+
+    # Create server
+    addr = ('localhost', settings.port)
+    tracer.slow_ms = settings.trace_slow_ms
+    tracer.sample_rate = settings.trace_sample_rate
+    tracer.capacity = settings.trace_capacity
+    if settings.otlp_endpoint:
+        tracer.exporter = OtlpExporter(settings.otlp_endpoint)
+        tracer.exporter.start()
+
+    with ThreadingXMLRPCServer(addr, requestHandler=TracingRequestHandler,
+                               allow_none=True) as server:
+        server.register_introspection_functions()
+        server.register_multicall_functions()  # batches (see API /batch)
+
+        controllers = {}
+        schedulers = {}
+        for device in device_settings(settings):
+            controller = create_controller(device)
+            controller.scheduler = Scheduler(
+                f"scheduler-{device.device_id}", tracer)
+            controllers[device.device_id] = controller
+            schedulers[device.device_id] = controller.scheduler
+        controller = controllers[settings.device_id]  # main device
+        server.register_instance(DeviceDispatcher(controllers, schedulers,
+                                                  tracer))
+        timer.phase("controllers")
+
+        # push state changes to the API (served from its /status cache)
+        if settings.api_addr:
+            publisher = SnapshotPublisher(controller.snapshot,
+                                          settings.api_addr)
+            controller.listeners.append(publisher.changed)
+            publisher.start()
+            publisher.changed()  # initial snapshot
 
         # Run the server's main loop
         if settings.verbose:
@@ -78,12 +234,9 @@ if __name__ == "__main__":
                 logger.debug(f"Using STUN: {settings.stun_addr}")
             else:
                 logger.debug(f"Using LAN (No STUN)")
-            logger.debug(f"Using ALSA device: {settings.alsa}")
-            logger.debug(f"Using v4l2 device: {settings.v4l2}")
-
-            idv = settings.id_vendor
-            idp = settings.id_product
-            logger.debug(f"USB id_vendor:{idv},id_product:{idp}")
+            logger.debug(f"Devices: {', '.join(controllers)}")
 
+        timer.phase("publisher")
+        logger.info(timer.report())
         logger.info(f"Server Started at {addr}")
         server.serve_forever()
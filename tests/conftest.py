@@ -0,0 +1,46 @@
+"""Fixtures shared by the tests"""
+
+import importlib
+import pathlib
+import sys
+import types
+
+import pytest
+
+SRC = pathlib.Path(__file__).resolve().parent.parent / "src" / "pi_stream"
+
+
+@pytest.fixture
+def service_module(monkeypatch):
+    """Imports a module of a service (hardware or api) the way the service
+    runs it: from its directory, importing its siblings by name.
+
+    The service's modules are forgotten afterwards, as both services have
+    modules of the same name (tracing)"""
+    before = set(sys.modules)
+    loaded = []
+
+    def load(service: str, name: str):
+        directory = str(SRC / service)
+        loaded.append(directory)
+        monkeypatch.syspath_prepend(directory)
+        return importlib.import_module(name)
+
+    yield load
+    for name in set(sys.modules) - before:
+        path = getattr(sys.modules[name], "__file__", None) or ""
+        if any(path.startswith(directory) for directory in loaded):
+            del sys.modules[name]
+
+
+@pytest.fixture
+def controller(service_module):
+    """Controller of a device that is not there (fake processes)"""
+    module = service_module("hardware", "controller")
+    process = types.SimpleNamespace(listeners=[])
+    settings = types.SimpleNamespace(v4l2="/dev/video0", alsa="hw:1",
+                                     id_vendor="0x534d", id_product="0x2109",
+                                     audio_profile="default",
+                                     audio_silence_level=-60.0,
+                                     audio_ring_seconds=1.0)
+    return module.Controller(process, process, process, settings)
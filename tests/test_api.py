@@ -0,0 +1,244 @@
+"""Tests for the API (stub hardware service)"""
+
+import contextlib
+import socket
+import threading
+import time
+from xmlrpc.server import SimpleXMLRPCServer
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+def snapshot(version: int, instance: str = "a1b2c3d4", **state) -> dict:
+    return dict({"instance": instance, "version": version,
+                 "controller_state": "IDLE", "transitions": []}, **state)
+
+
+class FakeHardware:
+    """Answers the hardware RPCs used by the tested routes"""
+    def __init__(self):
+        self.calls = []
+        self.snapshot = snapshot(7)
+
+    def get_snapshot(self):
+        self.calls.append("get_snapshot")
+        return self.snapshot
+
+    def get_format(self):
+        self.calls.append("get_format")
+        return {"success": True, "width": 1920, "height": 1080,
+                "pixelformat": "MJPG", "fps": 30}
+
+    def recordings_list(self):
+        self.calls.append("recordings_list")
+        return {"success": True, "data": [
+            {"id": 1, "size": 1000, "length": 10.0, "timestamp": 100},
+            {"id": 2, "size": None, "length": 2.5, "timestamp": 300},
+            {"id": 3, "size": 500, "length": None, "timestamp": 200}
+        ]}
+
+    def screenshot_bytes(self):
+        self.calls.append("screenshot_bytes")
+        return b"\x89PNG"
+
+
+@contextlib.contextmanager
+def serve(port: int = 0):
+    """Runs a hardware service stub (FakeHardware)"""
+    server = SimpleXMLRPCServer(("127.0.0.1", port), logRequests=False,
+                                allow_none=True)
+    server.register_instance(FakeHardware())
+    server.register_multicall_functions()
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+@pytest.fixture
+def hardware(monkeypatch):
+    with serve() as server:
+        monkeypatch.setenv("XMLRPC_ADDR",
+                           f"http://127.0.0.1:{server.server_address[1]}")
+        yield server.instance
+
+
+@pytest.fixture
+def api(service_module, hardware):
+    return service_module("api", "fastapi_server")
+
+
+def local(app):
+    """Serves app as if requests came from the hardware service's host
+    (TestClient requests come from 'testclient')"""
+    async def asgi(scope, receive, send):
+        await app(dict(scope, client=("127.0.0.1", 50000)), receive, send)
+    return asgi
+
+
+@pytest.fixture
+def client(api):
+    return TestClient(local(api.app))
+
+
+class TestStatus:
+    """Tests for /status served from pushed snapshots"""
+    def test_pushed(self, client, hardware):
+        assert client.post("/internal/snapshot",
+                           json=snapshot(1)).json()["success"]
+        response = client.get("/status")
+        assert response.json()["version"] == 1
+        etag = response.headers["etag"]
+        assert etag == '"a1b2c3d4-1"'
+        assert hardware.calls == []  # (no RPC)
+
+        response = client.get("/status", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+
+        client.post("/internal/snapshot", json=snapshot(2))
+        response = client.get("/status", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] == '"a1b2c3d4-2"'
+
+    def test_older_ignored(self, client):
+        """Pushes arriving out of order do not go back in time"""
+        client.post("/internal/snapshot", json=snapshot(3))
+        client.post("/internal/snapshot", json=snapshot(2))
+        assert client.get("/status").json()["version"] == 3
+        client.post("/internal/snapshot", json=snapshot(1, "e5f6a7b8"))
+        assert client.get("/status").json()["version"] == 1  # (restarted)
+
+    def test_fetched(self, client, hardware):
+        """Without a pushed snapshot, /status asks the hardware service"""
+        response = client.get("/status")
+        assert response.headers["etag"] == '"a1b2c3d4-7"'
+        assert hardware.calls == ["get_snapshot"]
+        client.get("/status")
+        assert hardware.calls == ["get_snapshot"]  # (cached)
+
+    def test_remote_push(self, api):
+        """Only the hardware service's host may push snapshots"""
+        client = TestClient(api.app)
+        response = client.post("/internal/snapshot", json=snapshot(1))
+        assert response.status_code == 403
+        assert api.snapshot_cache["snapshot"] is None
+
+
+class TestWebSocket:
+    """Tests for the /ws control channel"""
+    def test_events(self, client):
+        """Transitions since the previous snapshot are pushed, then the
+        snapshot"""
+        client.post("/internal/snapshot", json=snapshot(1))
+        with client.websocket_connect("/ws") as ws:
+            assert ws.receive_json() == {"event": "snapshot",
+                                         "snapshot": snapshot(1)}
+            transitions = [
+                {"source": "janus", "from": "STOPPED", "to": "RUNNING",
+                 "version": version} for version in [1, 2, 3]]
+            pushed = snapshot(3, transitions=transitions)
+            client.post("/internal/snapshot", json=pushed)
+            assert ws.receive_json() == dict(transitions[1],
+                                             event="transition")
+            assert ws.receive_json() == dict(transitions[2],
+                                             event="transition")
+            assert ws.receive_json() == {"event": "snapshot",
+                                         "snapshot": pushed}
+
+    def test_commands(self, client, hardware):
+        """Commands are answered in order, errors included"""
+        with client.websocket_connect("/ws") as ws:
+            ws.send_json({"id": 1, "method": "get_snapshot"})
+            ws.send_json({"id": 2, "method": "no_such_method"})
+            ws.send_json({"id": 3, "method": "system.listMethods"})
+            ws.send_text("not json")
+            assert ws.receive_json() == {"id": 1, "result": snapshot(7)}
+            response = ws.receive_json()
+            assert response["id"] == 2
+            assert "no_such_method" in response["error"]
+            assert ws.receive_json() == {
+                "id": 3, "error": "invalid command: system.listMethods"}
+            assert ws.receive_json() == {"id": None,
+                                         "error": "invalid command: "}
+        assert hardware.calls == ["get_snapshot"]
+
+
+class TestMulticall:
+    """Tests for routes making several RPCs in one request"""
+    def test_batch(self, client, hardware):
+        """Results (or errors) are returned in order"""
+        response = client.post("/batch", json=[
+            {"method": "get_format"},
+            {"method": "no_such_method"},
+            {"method": "screenshot_bytes", "params": []}
+        ])
+        first, second, third = response.json()
+        assert first == {"result": FakeHardware().get_format()}
+        assert "no_such_method" in second["error"]
+        assert third == {"result": "iVBORw=="}  # (base64)
+        assert hardware.calls == ["get_format", "screenshot_bytes"]
+
+    def test_batch_invalid(self, client, hardware):
+        """Nothing is called when a method name is invalid"""
+        response = client.post("/batch", json=[
+            {"method": "get_format"},
+            {"method": "system.shutdown"}
+        ])
+        assert response.json() == {"success": False,
+                                   "error": "invalid method: system.shutdown"}
+        assert hardware.calls == []
+
+    def test_dashboard(self, client, hardware):
+        dashboard = client.post("/dashboard").json()
+        assert dashboard["status"] == snapshot(7)
+        assert dashboard["format"]["width"] == 1920
+        assert dashboard["recordings"] == {
+            "count": 3,
+            "total_size": 1500,
+            "total_length": 12.5,
+            "latest": {"id": 2, "size": None, "length": 2.5,
+                       "timestamp": 300}
+        }
+        assert sorted(hardware.calls) == ["get_format", "get_snapshot",
+                                          "recordings_list"]
+        client.get("/status")  # (dashboard cached the snapshot)
+        assert hardware.calls.count("get_snapshot") == 1
+
+    def test_dashboard_errors(self, client, hardware, monkeypatch):
+        """A failing call is reported in place of its part"""
+        def fail():
+            raise RuntimeError("catalog unavailable")
+        monkeypatch.setattr(hardware, "recordings_list", fail)
+        dashboard = client.post("/dashboard").json()
+        assert dashboard["format"]["width"] == 1920
+        assert "catalog unavailable" in dashboard["recordings"]["error"]
+
+
+def test_hardware_down(service_module, monkeypatch):
+    """The API starts without the hardware service, answering 503 until it
+    is up"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setenv("XMLRPC_ADDR", f"http://127.0.0.1:{port}")
+    api = service_module("api", "fastapi_server")
+
+    with TestClient(api.app) as client:
+        response = client.get("/status")
+        assert response.status_code == 503
+        assert not response.json()["success"]
+
+        connect_task = api.app.state.connect_task
+        assert not connect_task.done()  # (retrying in the background)
+        with serve(port):
+            deadline = time.monotonic() + 5.0
+            while not connect_task.done() and time.monotonic() < deadline:
+                time.sleep(0.05)
+            assert connect_task.done()
+            assert client.get("/status").headers["etag"] == '"a1b2c3d4-7"'
@@ -0,0 +1,150 @@
+"""Tests for audio pipeline profiles and latency measurement"""
+
+from pi_stream.hardware.audio import AUDIO_PROFILES, AudioRing
+from pi_stream.hardware.audio import LatencyMonitor, LevelMonitor
+from pi_stream.hardware.audio import audio_pipeline, ogg_crc, opus_samples
+from pi_stream.hardware.audio import rtp_payload
+
+TRACE = ("0:00:01.000000000 123 0x1 TRACE GST_TRACER :0:: latency, "
+         "src-element-id=(string)0x2, src-element=(string)alsasrc0, "
+         "src=(string)src, sink-element-id=(string)0x3, "
+         "sink-element=(string)udpsink0, sink=(string)sink, "
+         "time=(guint64){}, ts=(guint64)1000;\n")
+
+ELEMENT_TRACE = ("0:00:01.000000000 123 0x1 TRACE GST_TRACER :0:: "
+                 "element-latency, element-id=(string)0x4, "
+                 "element=(string)opusenc0, src=(string)src, "
+                 "time=(guint64)99000000, ts=(guint64)1000;\n")
+
+
+class TestPipeline:
+    """Tests for building pipelines from profiles"""
+    def test_low_latency(self):
+        """Profile parameters end up on the right elements"""
+        pipeline = audio_pipeline("hw:1", AUDIO_PROFILES["low-latency"])
+        assert 'alsasrc device="hw:1" buffer-time=20000 latency-time=5000' \
+            in pipeline
+        assert "frame-size=10" in pipeline.split()
+        assert "audio-type=restricted-lowdelay" in pipeline
+
+    def test_default(self):
+        """The default profile leaves ALSA buffering at its defaults"""
+        pipeline = audio_pipeline("hw:1", AUDIO_PROFILES["default"])
+        assert "buffer-time" not in pipeline
+        assert "bitrate=48000" in pipeline
+
+
+class TestLatencyMonitor:
+    """Tests for parsing latency tracer output"""
+    def test_stats(self):
+        """Source to sink times are collected (ms)"""
+        monitor = LatencyMonitor()
+        for time in [10000000, 20000000, 30000000]:
+            monitor.feed(TRACE.format(time))
+        stats = monitor.stats()
+        assert stats["count"] == 3
+        assert stats["mean"] == 20.0
+        assert stats["min"] == 10.0
+        assert stats["last"] == 30.0
+
+    def test_element_latency(self):
+        """element-latency lines are not pipeline latency"""
+        monitor = LatencyMonitor()
+        monitor.feed(ELEMENT_TRACE)
+        assert monitor.stats() == {"count": 0}
+
+    def test_split_lines(self):
+        """Output may arrive in arbitrary chunks"""
+        monitor = LatencyMonitor()
+        data = TRACE.format(5000000).encode("utf-8")
+        for i in range(0, len(data), 9):
+            monitor.feed(data[i:i + 9])
+        assert monitor.stats()["last"] == 5.0
+
+
+def rtp(payload: bytes, timestamp: int = 0) -> bytes:
+    """RTP packet as sent by rtpopuspay (version 2, payload type 96)"""
+    return bytes([0x80, 96, 0, 1]) + timestamp.to_bytes(4, "big") \
+        + b"\0\0\0\1" + payload
+
+
+# CELT 20 ms stereo frame (config 31, s=1, code 0)
+OPUS_20MS = bytes([31 << 3 | 0x4]) + b"\x55" * 80
+
+
+def ogg_pages(data: bytes) -> list:
+    """Splits an Ogg file into (header_type, granule, crc ok) per page"""
+    pages = []
+    while data:
+        assert data[:4] == b"OggS"
+        segments = data[26]
+        size = 27 + segments + sum(data[27:27 + segments])
+        page = bytearray(data[:size])
+        crc = int.from_bytes(page[22:26], "little")
+        page[22:26] = b"\0\0\0\0"
+        pages.append((data[5], int.from_bytes(data[6:14], "little"),
+                      ogg_crc(page) == crc))
+        data = data[size:]
+    return pages
+
+
+class TestLevelMonitor:
+    """Tests for parsing level messages"""
+    MESSAGE = ('Got message #42 from element "level0" (element): level, '
+               'endtime=(guint64)500000000, timestamp=(guint64)250000000, '
+               'rms=(double){{ {0}, {0} }}, peak=(double){{ {1}, {1} }}, '
+               'decay=(double){{ {1}, {1} }};\n')
+
+    def test_levels(self):
+        """RMS and peak per channel"""
+        monitor = LevelMonitor()
+        monitor.feed(self.MESSAGE.format(-20.5, -6.25))
+        stats = monitor.stats()
+        assert stats["rms"] == [-20.5, -20.5]
+        assert stats["peak"] == [-6.25, -6.25]
+        assert not stats["silent"]
+
+    def test_silence(self):
+        """Silent once the peak drops below the silence level"""
+        monitor = LevelMonitor(silence=-60)
+        monitor.feed(self.MESSAGE.format(-90, -80))
+        assert monitor.stats()["silent"]
+        monitor.feed(self.MESSAGE.format(-20, -6))
+        assert not monitor.stats()["silent"]
+
+
+class TestAudioRing:
+    """Tests for keeping recent audio and writing clips"""
+    def test_opus_samples(self):
+        """Packet durations from the TOC byte"""
+        assert opus_samples(OPUS_20MS) == 960
+        assert opus_samples(bytes([1 << 3])) == 960  # SILK 20 ms
+        assert opus_samples(bytes([16 << 3 | 3, 3])) == 3 * 120  # 3x2.5 ms
+
+    def test_rtp_payload(self):
+        """RTP headers are removed"""
+        assert rtp_payload(rtp(b"opus", 1234)) == (1234, b"opus")
+        assert rtp_payload(b"not rtp") is None
+
+    def test_bounded(self):
+        """Only the last seconds are kept"""
+        ring = AudioRing(seconds=1)
+        for i in range(200):
+            ring.add(rtp(OPUS_20MS, i * 960))
+        assert ring.clip(10)[1] == 1.0
+
+    def test_clip(self):
+        """Clips are valid Ogg/Opus"""
+        ring = AudioRing(seconds=10)
+        for i in range(100):
+            ring.add(rtp(OPUS_20MS, i * 960))
+        data, duration = ring.clip(1.5)
+        assert duration == 1.5
+
+        assert ogg_crc(b"123456789") == 0x89a1897f
+        pages = ogg_pages(data)
+        assert all(crc_ok for _, _, crc_ok in pages)
+        assert pages[0][0] == 0x02  # beginning of stream
+        assert pages[-1][0] == 0x04  # end of stream
+        assert pages[-1][1] == 75 * 960  # granule: total samples
+        assert data[28 + 9] == 2  # OpusHead channels
@@ -1,6 +1,8 @@
 """pytest unit tests for background_process.py"""
+import os
+import time
+
 import pytest
-import sh
 from pi_stream.hardware.background_process import *
 
 NO_ARGS_COMMAND = "cat"
@@ -14,6 +16,12 @@ INVALID_COMMAND = "nao"
 INSTANT_COMMAND = "pwd"
 INSTANT_ARGS = "-L"
 
+# argument string cannot contain spaces
+IGNORE_SIGINT_COMMAND = "python3"
+IGNORE_SIGINT_ARGS = ("-c signal=__import__('signal');"
+                      "signal.signal(signal.SIGINT,signal.SIG_IGN);"
+                      "__import__('time').sleep(30)")
+
 FILTER = "ignore::pytest.PytestUnhandledThreadExceptionWarning"
 
 
@@ -34,7 +42,7 @@ class TestConstructor:
 
     def test_invalid(self):
         """Calling constructor with a nonexistant command"""
-        with pytest.raises(sh.CommandNotFound):
+        with pytest.raises(CommandNotFound):
             BackgroundProcess(INVALID_COMMAND)
 
 
@@ -43,30 +51,32 @@ class TestStart:
     def test_no_args(self):
         """Starting a process normally with no arguments"""
         process = BackgroundProcess(NO_ARGS_COMMAND)
-        assert process.start()["code"] == ProcessErrorCode.SUCCESS
+        assert process.start()["process_code"] == ProcessErrorCode.SUCCESS
 
     def test_args(self):
         """Starting a process normally with arguments"""
         process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
-        assert process.start()["code"] == ProcessErrorCode.SUCCESS
+        assert process.start()["process_code"] == ProcessErrorCode.SUCCESS
 
     def test_stopped_restart(self):
         """Starting a process with the restart flag.
         Should be no different than a normal start in this case"""
         process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
-        assert process.start(restart=True)["code"] == ProcessErrorCode.SUCCESS
+        code = process.start(restart=True)["process_code"]
+        assert code == ProcessErrorCode.SUCCESS
 
     def test_started(self):
         """Trying to start a process that is already started"""
         process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
         process.start()
-        assert process.start()["code"] == ProcessErrorCode.INVALID_STATE
+        code = process.start()["process_code"]
+        assert code == ProcessErrorCode.INVALID_STATE
 
     def test_started_restart(self):
         """Trying to start a process that is already started"""
         process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
         process.start()
-        code = process.start(restart=True)["code"]
+        code = process.start(restart=True)["process_code"]
         assert code == ProcessErrorCode.INVALID_STATE
 
     def test_restarting(self):
@@ -74,7 +84,8 @@ class TestStart:
         process = process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
         process.start()
         process.state = ProcessState.RESTARTING  # manual set
-        assert process.start()["code"] == ProcessErrorCode.IN_RESTART_PROCESS
+        code = process.start()["process_code"]
+        assert code == ProcessErrorCode.IN_RESTART_PROCESS
 
 
 @pytest.mark.filterwarnings(FILTER)
@@ -84,21 +95,21 @@ class TestStop:
         """Stop a started process"""
         process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
         process.start()
-        assert process.stop()["code"] == ProcessErrorCode.SUCCESS
+        assert process.stop()["process_code"] == ProcessErrorCode.SUCCESS
 
     def test_stopped(self):
         """Try to stop an already stopped process"""
         process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
         process.stop()
-        assert process.stop()["code"] == ProcessErrorCode.INVALID_STATE
+        assert process.stop()["process_code"] == ProcessErrorCode.INVALID_STATE
 
     def test_started_restart(self):
         """Initiate a restart process"""
         process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
         process.start()
         result = process.stop(restart=True)
-        assert result["code"] == ProcessErrorCode.SUCCESS
-        assert result["state"] == ProcessState.RESTARTING
+        assert result["process_code"] == ProcessErrorCode.SUCCESS
+        assert result["process_state"] == ProcessState.RESTARTING
 
     def test_instant(self):
         """Stop a started process that ends on its own ("instantly")
@@ -106,4 +117,90 @@ class TestStop:
         process = BackgroundProcess(INSTANT_COMMAND, INSTANT_ARGS)
         process.start()
         process.wait()  # wait for command to complete
-        assert process.stop()["code"] == ProcessErrorCode.STOPPED_SELF
+        assert process.stop()["process_code"] == ProcessErrorCode.STOPPED_SELF
+
+
+class TestSupervisor:
+    """Tests for stop escalation, auto-restart and health checks"""
+    def test_escalation(self):
+        """A process ignoring SIGINT is stopped with SIGTERM"""
+        process = BackgroundProcess(IGNORE_SIGINT_COMMAND,
+                                    IGNORE_SIGINT_ARGS,
+                                    stop_timeout=0.5)
+        process.start()
+        time.sleep(0.5)  # let the interpreter install its handler
+        result = process.stop()
+        assert result["success"]
+        assert result["signal"] == "SIGTERM"
+        assert process.state == ProcessState.STOPPED
+
+    def test_restart(self):
+        """A process that exits on its own is restarted"""
+        policy = RestartPolicy(initial_delay=0.05)
+        process = BackgroundProcess(INSTANT_COMMAND, INSTANT_ARGS,
+                                    restart_policy=policy)
+        process.start()
+        time.sleep(0.5)
+        assert process.status()["restart"]["restarts"] > 0
+
+    def test_max_restarts(self):
+        """Restarts stop after max_restarts consecutive attempts"""
+        policy = RestartPolicy(initial_delay=0.01, max_restarts=2)
+        process = BackgroundProcess(INSTANT_COMMAND, INSTANT_ARGS,
+                                    restart_policy=policy)
+        process.start()
+        time.sleep(0.5)
+        assert process.status()["restart"]["restarts"] == 2
+        assert process.state == ProcessState.STOPPED
+
+    def test_health_check(self):
+        """A process failing its health check is killed"""
+        async def unhealthy(process):
+            return False
+
+        process = BackgroundProcess(NO_ARGS_COMMAND,
+                                    health_check=unhealthy,
+                                    health_interval=0.01,
+                                    start_grace=0)
+        process.start()
+        process.wait(timeout=2)
+        assert process.state == ProcessState.STOPPED
+        assert not process.status()["is_alive"]
+
+
+class TestLogRing:
+    """Tests for the in-memory output buffer"""
+    def test_tail(self):
+        """Lines are split on read"""
+        ring = LogRing(64)
+        ring.write(b"one\ntwo\nthree\n")
+        assert ring.tail(2) == ["two", "three"]
+
+    def test_wrap(self):
+        """Oldest output is overwritten, partial first line dropped"""
+        ring = LogRing(16)
+        for i in range(10):
+            ring.write(f"line{i}\n".encode("utf-8"))
+        assert ring.tail(10) == ["line8", "line9"]
+        assert ring.written == 60
+
+    def test_large_write(self):
+        """A write larger than the buffer keeps its end"""
+        ring = LogRing(8)
+        ring.write(b"0123456789abcdef")
+        assert ring.read() == b"89abcdef"
+
+    def test_process_output(self):
+        """Process output is captured"""
+        process = BackgroundProcess(INSTANT_COMMAND, INSTANT_ARGS)
+        process.start()
+        process.wait(timeout=2)
+        assert process.tail(1)["lines"] == [os.getcwd()]
+
+    def test_env(self):
+        """Variables in env are added to the process's environment"""
+        process = BackgroundProcess("printenv", "PI_STREAM_TEST",
+                                    env={"PI_STREAM_TEST": "value"})
+        process.start()
+        process.wait(timeout=2)
+        assert process.tail(1)["lines"] == ["value"]
@@ -0,0 +1,75 @@
+"""Tests for device capabilities and format validation (fake v4l2-ctl)"""
+
+import types
+
+import pytest
+import sh
+
+LIST_FORMATS_EXT = """\
+ioctl: VIDIOC_ENUM_FMT
+\tType: Video Capture
+
+\t[0]: 'MJPG' (Motion-JPEG, compressed)
+\t\tSize: Discrete 1920x1080
+\t\t\tInterval: Discrete 0.033s (30.000 fps)
+\t\t\tInterval: Discrete 0.050s (20.000 fps)
+\t\tSize: Discrete 1280x720
+\t\t\tInterval: Discrete 0.017s (60.000 fps)
+\t[1]: 'YUYV' (YUYV 4:2:2)
+\t\tSize: Discrete 1920x1080
+\t\t\tInterval: Discrete 0.200s (5.000 fps)
+"""
+
+
+class FakeV4l2Ctl:
+    """Stands in for sh.Command("v4l2-ctl"), recording its calls"""
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, *args):
+        self.calls.append(args)
+        stdout = LIST_FORMATS_EXT if "--list-formats-ext" in args else ""
+        return types.SimpleNamespace(stdout=stdout.encode("utf-8"))
+
+    def bake(self, *args):
+        return lambda *more: self(*args, *more)
+
+
+@pytest.fixture
+def v4l2_ctl(monkeypatch):
+    fake = FakeV4l2Ctl()
+    monkeypatch.setattr(sh, "Command", lambda name: fake)
+    return fake
+
+
+def test_parse(controller, v4l2_ctl):
+    result = controller.get_capabilities()
+    assert result["success"]
+    assert result["capabilities"] == {
+        "MJPG": {"1920x1080": [30.0, 20.0], "1280x720": [60.0]},
+        "YUYV": {"1920x1080": [5.0]}
+    }
+    assert v4l2_ctl.calls == [("-d", "/dev/video0", "--list-formats-ext")]
+
+
+def test_cached(controller, v4l2_ctl):
+    controller.get_capabilities()
+    controller.get_capabilities()
+    assert len(v4l2_ctl.calls) == 1
+    controller.get_capabilities(refresh=True)
+    assert len(v4l2_ctl.calls) == 2
+
+
+@pytest.mark.parametrize("width, height, pixelformat, fps", [
+    (1920, 1080, "H264", 30),  # pixel format
+    (640, 480, "MJPG", 30),  # resolution
+    (1920, 1080, "YUYV", 30),  # framerate
+])
+def test_invalid_format(controller, v4l2_ctl, width, height, pixelformat,
+                        fps):
+    """Unsupported formats are rejected before anything is changed"""
+    result = controller.set_format(width, height, pixelformat, fps)
+    assert not result["success"]
+    assert result["controller_code"] == "INVALID_FORMAT"
+    assert "MJPG" in result["capabilities"]
+    assert v4l2_ctl.calls == [("-d", "/dev/video0", "--list-formats-ext")]
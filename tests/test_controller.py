@@ -18,6 +18,7 @@ class Settings(BaseSettings):
     id_product: str = "0x2109"  # Second half of 'lsusb' device id (hex)
     ss_dir: str = "/home/pi"  # (development)
     plugins_dir: str = "/home/pi/plugins"  # (development)
+    screenshot_warm_ttl: float = 30.0  # seconds the capture stays open
     verbose: bool = False
 
 
@@ -73,6 +74,20 @@ class TestScreenshot:
         result = con.screenshot("cv2", INP_FMT, OUT_FMT, WIDTH, HEIGHT)
         # TODO: Assert
 
+    def test_cv2_warm(self):
+        """Second cv2 screenshot served from the warm capture"""
+        INP_FMT = "png"
+        OUT_FMT = "png"
+        WIDTH = 1920
+        HEIGHT = 1080
+        con = Controller(janus, gstreamer, settings)
+        first = con.screenshot("cv2", INP_FMT, OUT_FMT, WIDTH, HEIGHT)
+        assert first["success"] and first["warm"] and not first["reused"]
+        second = con.screenshot("cv2", INP_FMT, OUT_FMT, WIDTH, HEIGHT)
+        assert second["success"] and second["reused"]
+        con.start_janus()  # releases the capture
+        assert con.snapshot()["screenshot_warm"] is False
+
     def test_ffmpeg(self):
         """ffmpeg screenshot test"""
         INP_FMT = "png"
@@ -0,0 +1,51 @@
+"""Tests for addressing devices through the API"""
+
+import asyncio
+
+from pi_stream.api.devices import DeviceProxy, DevicePrefixMiddleware
+from pi_stream.api.devices import current_device, device_method
+
+
+class FakeProxy:
+    """Records the names of the methods called"""
+    def __getattr__(self, name):
+        return lambda *params: name
+
+
+def handle(path: str) -> dict:
+    """Runs a request through the middleware, returning what the app saw"""
+    seen = {}
+
+    async def app(scope, receive, send):
+        seen["path"] = scope["path"]
+        seen["device"] = current_device.get()
+        seen["method"] = DeviceProxy(FakeProxy()).screenshot()
+
+    middleware = DevicePrefixMiddleware(app)
+    asyncio.run(middleware({"type": "http", "path": path}, None, None))
+    return seen
+
+
+class TestDevices:
+    """Tests for the /devices/{device_id} prefix"""
+    def test_main(self):
+        assert handle("/screenshot") == {
+            "path": "/screenshot", "device": None, "method": "screenshot"}
+
+    def test_prefix(self):
+        assert handle("/devices/hdmi2/screenshot") == {
+            "path": "/screenshot", "device": "hdmi2",
+            "method": "hdmi2.screenshot"}
+        assert current_device.get() is None  # reset after the request
+
+    def test_list(self):
+        """/devices itself is not a device request"""
+        assert handle("/devices")["device"] is None
+
+    def test_system(self):
+        token = current_device.set("hdmi2")
+        try:
+            assert device_method("get_format") == "hdmi2.get_format"
+            assert DeviceProxy(FakeProxy()).system() == "system"
+        finally:
+            current_device.reset(token)
@@ -0,0 +1,118 @@
+"""Tests for routing RPCs to several devices"""
+
+import time
+
+import pytest
+from pydantic import BaseSettings
+from pi_stream.hardware.dispatcher import DeviceDispatcher, device_settings
+from pi_stream.hardware.scheduler import Scheduler
+
+
+class Settings(BaseSettings):
+    """The hardware settings used by the dispatcher"""
+    device_id: str = "main"
+    devices: list = []
+    v4l2: str = "/dev/video0"
+    alsa: str = "hw:1"
+    cpu: int = -1
+    recording_files_dir: str = "/recordings"
+
+
+class State:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeController:
+    CONCURRENT_METHODS = {"get_format"}
+    PRIORITIES = {"screenshot": 0}
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.state = State("IDLE")
+
+    def get_format(self):
+        return {"device": self.settings.device_id}
+
+    def screenshot(self, seconds: float):
+        time.sleep(seconds)
+        return {"success": True}
+
+    @property
+    def catalog(self):
+        raise AssertionError("opened by listing methods")
+
+    def _private(self):
+        return None
+
+
+def dispatcher(settings) -> DeviceDispatcher:
+    return DeviceDispatcher({s.device_id: FakeController(s)
+                             for s in device_settings(settings)})
+
+
+class TestDeviceSettings:
+    """Tests for per-device settings"""
+    def test_single(self):
+        settings = Settings()
+        assert device_settings(settings) == [settings]
+
+    def test_overrides(self):
+        settings = Settings(devices=[{"device_id": "hdmi2",
+                                      "v4l2": "/dev/video2", "cpu": 2}])
+        main, second = device_settings(settings)
+        assert main.v4l2 == "/dev/video0" and main.cpu == -1
+        assert second.device_id == "hdmi2"
+        assert second.v4l2 == "/dev/video2" and second.cpu == 2
+        assert second.alsa == "hw:1"  # inherited
+        assert second.recording_files_dir == "/recordings/hdmi2"
+        assert second.devices == []
+
+    @pytest.mark.parametrize("devices", [[{"v4l2": "/dev/video2"}],
+                                         [{"device_id": "main"}]])
+    def test_invalid(self, devices):
+        with pytest.raises(ValueError):
+            device_settings(Settings(devices=devices))
+
+
+class TestDeviceDispatcher:
+    """Tests for routing "<device_id>.<method>" calls"""
+    def test_routing(self):
+        rpc = dispatcher(Settings(devices=[{"device_id": "hdmi2"}]))
+        assert rpc._dispatch("get_format", ()) == {"device": "main"}
+        assert rpc._dispatch("main.get_format", ()) == {"device": "main"}
+        assert rpc._dispatch("hdmi2.get_format", ()) == {"device": "hdmi2"}
+
+    @pytest.mark.parametrize("method", ["hdmi3.get_format", "_private",
+                                        "hdmi2._private", "settings",
+                                        "missing"])
+    def test_unsupported(self, method):
+        rpc = dispatcher(Settings(devices=[{"device_id": "hdmi2"}]))
+        with pytest.raises(Exception):
+            rpc._dispatch(method, ())
+
+    def test_list(self):
+        rpc = dispatcher(Settings(devices=[{"device_id": "hdmi2"}]))
+        devices = rpc._dispatch("hdmi2.list_devices", ())
+        assert devices["main"] == "main"
+        assert [d["device_id"] for d in devices["devices"]] == \
+            ["main", "hdmi2"]
+        assert "get_format" in rpc._listMethods()
+        assert "_private" not in rpc._listMethods()
+        assert "catalog" not in rpc._listMethods()
+
+    def test_scheduled(self):
+        """Operations are queued, with a deadline when scheduled"""
+        controllers = {"main": FakeController(Settings())}
+        rpc = DeviceDispatcher(controllers, {"main": Scheduler()})
+        assert rpc._dispatch("screenshot", (0.1,)) == {"success": True}
+        assert rpc._dispatch("schedule", ("screenshot", [0.1], 1, 10)) == \
+            {"success": True}
+        result = rpc._dispatch("schedule", ("screenshot", [0.2], 1, 0.01))
+        assert result["controller_code"] == "DEADLINE_EXCEEDED"
+        assert result["controller_state"] == "IDLE"
+
+        stats = rpc._dispatch("main.scheduler_stats", ())
+        assert stats["success"]
+        assert stats["operations"]["screenshot"]["count"] == 2
+        assert "get_format" not in stats["operations"]  # (concurrent)
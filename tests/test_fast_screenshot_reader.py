@@ -0,0 +1,241 @@
+"""Tests for fast screenshot mode bursts (with a fake capture device)"""
+
+import mmap
+import threading
+import time
+
+import cv2
+import numpy as np
+import pytest
+from pi_stream.hardware import fast_screenshot_reader
+from pi_stream.hardware.fast_screenshot_reader import FastScreenshotReader
+
+FRAME_TIME = 0.01  # seconds per frame read
+
+
+class FakeCamera:
+    """Stands in for cv2.VideoCapture, frame i is filled with i"""
+    def __init__(self):
+        self.count = 0
+        self.released = False
+
+    def open(self, device):
+        pass
+
+    def set(self, prop, value):
+        pass
+
+    def get(self, prop):
+        return 0  # no buffer timestamps
+
+    def release(self):
+        self.released = True
+
+    def read(self):
+        time.sleep(FRAME_TIME)
+        if self.released:
+            return False, None
+        self.count += 1
+        return True, np.full((48, 64, 3), self.count % 256, np.uint8)
+
+
+class StillCamera(FakeCamera):
+    """Returns (a copy of) image every read"""
+    def __init__(self):
+        super(StillCamera, self).__init__()
+        self.image = np.zeros((240, 320, 3), np.uint8)
+
+    def read(self):
+        ok, frame = super(StillCamera, self).read()
+        return ok, (self.image.copy() if ok else None)
+
+
+class MappedCamera(FakeCamera):
+    """Holds a view of a mapped buffer while reading, like
+    v4l2.V4l2Capture, whose buffers cannot be unmapped while in use"""
+    def __init__(self):
+        super(MappedCamera, self).__init__()
+        self.buffer = mmap.mmap(-1, 48 * 64 * 3)
+        self.reading = threading.Event()
+        self.error = None
+
+    def read(self):
+        with memoryview(self.buffer) as data:
+            self.reading.set()
+            time.sleep(5 * FRAME_TIME)
+            image = np.frombuffer(data, np.uint8).reshape(48, 64, 3).copy()
+        return True, image
+
+    def release(self):
+        try:
+            self.buffer.close()
+        except BufferError as exc:
+            self.error = exc
+        super(MappedCamera, self).release()
+
+
+def start_reader(camera):
+    reader = FastScreenshotReader("jpg", "png", 64, 48)
+    reader.cam = camera
+    reader.start()
+    return reader
+
+
+@pytest.fixture
+def reader():
+    reader = start_reader(FakeCamera())
+    yield reader
+    reader.stop()
+    reader.join()
+
+
+@pytest.fixture
+def still():
+    reader = start_reader(StillCamera())
+    yield reader
+    reader.stop()
+    reader.join()
+
+
+class TestBurst:
+    """Tests for capturing a sequence of frames"""
+    def test_consecutive(self, reader):
+        """interval 0 captures consecutive frames"""
+        result = reader.get_burst(5)
+        assert result["success"]
+        assert len(result["data"]) == 5
+        values = [cv2.imdecode(np.frombuffer(data, np.uint8), 1)[0, 0, 0]
+                  for data in result["data"]]
+        assert np.all(np.diff(values) == 1)
+
+    def test_interval(self, reader):
+        """Frames are at least interval seconds apart"""
+        result = reader.get_burst(4, interval=3 * FRAME_TIME)
+        assert result["success"]
+        assert min(np.diff(result["timestamps"])) >= 3 * FRAME_TIME
+
+    def test_capture_timestamps(self):
+        """Timestamps are the driver's (unix time), not when read"""
+        class DelayedCamera(FakeCamera):
+            def get(self, prop):  # frames captured a second before read
+                if prop == cv2.CAP_PROP_POS_MSEC:
+                    return (time.monotonic() - 1.0) * 1000
+                return 0
+
+        reader = start_reader(DelayedCamera())
+        try:
+            result = reader.get_burst(3)
+        finally:
+            reader.stop()
+        assert result["success"]
+        for timestamp in result["timestamps"]:
+            assert time.time() - timestamp == pytest.approx(1.0, abs=0.2)
+
+    def test_timeout(self, reader):
+        """Fails if the frames are not captured in time"""
+        result = reader.get_burst(100, timeout=0.1)
+        assert not result["success"]
+        assert 0 < result["captured"] < 100
+
+
+class TestGetFrame:
+    """Tests for single frames"""
+    def test_timings(self, still):
+        """Frames carry capture, encode and serve times"""
+        result = still.get_frame()
+        assert result["success"]
+        assert result["captured"] <= result["served"] <= time.monotonic()
+        assert result["encode_ms"] > 0
+
+
+class TestStop:
+    """Tests for stopping the frame-loop"""
+    def test_stop_while_reading(self):
+        """The device is released by the frame-loop once the frame it holds
+        is done with"""
+        camera = MappedCamera()
+        reader = start_reader(camera)
+        assert camera.reading.wait(1)
+        assert reader.stop()["success"]
+        assert not reader.is_alive()
+        assert camera.released and camera.error is None
+
+    def test_stop_unstarted(self):
+        """A reader that never ran releases the device itself"""
+        reader = FastScreenshotReader("jpg", "png", 64, 48)
+        reader.cam = FakeCamera()
+        assert reader.stop()["success"]
+        assert reader.cam.released
+
+
+    def test_loop_ended(self):
+        """Fails instead of waiting forever once the frame-loop ends"""
+        camera = FakeCamera()
+        camera.released = True  # (reads fail)
+        reader = start_reader(camera)
+        start = time.monotonic()
+        result = reader.get_frame(timeout=5)
+        assert not result["success"]
+        assert time.monotonic() - start < 1
+
+    def test_timeout(self):
+        """Fails when no frame is read in time"""
+        class SlowCamera(FakeCamera):
+            def read(self):
+                time.sleep(0.2)
+                return super(SlowCamera, self).read()
+
+        reader = start_reader(SlowCamera())
+        try:
+            assert not reader.get_frame(timeout=0.05)["success"]
+            assert reader.get_frame(timeout=1)["success"]
+        finally:
+            reader.stop()
+
+
+class TestWaitForChange:
+    """Tests for waiting until the frame changes"""
+    def test_no_change(self, still):
+        """Times out without a change"""
+        result = still.wait_for_change(timeout=0.1)
+        assert result["success"]
+        assert not result["changed"]
+
+    def test_change(self, still):
+        """Returns the changed frame and the box of the change"""
+        sequence = still.get_frame()["sequence"]
+        still.cam.image[80:160, 160:240] = 255
+        result = still.wait_for_change(sequence, timeout=1)
+        assert result["changed"]
+        assert result["sequence"] > sequence
+        assert result["box"] == [160, 80, 80, 80]
+        assert result["fraction"] == pytest.approx(1 / 12)
+
+    def test_roi(self, still):
+        """Changes outside of the ROI are ignored"""
+        sequence = still.get_frame()["sequence"]
+        still.cam.image[0:80, 0:80] = 255
+        result = still.wait_for_change(sequence, roi=[160, 80, 80, 80],
+                                       timeout=0.2)
+        assert not result["changed"]
+
+    def test_downsampled_on_demand(self, monkeypatch):
+        """Frames are only downsampled when served or while watched"""
+        calls = []
+        downsample = fast_screenshot_reader.downsample
+        monkeypatch.setattr(fast_screenshot_reader, "downsample",
+                            lambda frame: calls.append(1) or downsample(frame))
+        reader = start_reader(StillCamera())
+        try:
+            sequence = reader.get_frame()["sequence"]
+            time.sleep(10 * FRAME_TIME)
+            assert len(calls) == 1  # (the frame served)
+            reader.wait_for_change(sequence, timeout=5 * FRAME_TIME)
+            assert len(calls) > 1
+        finally:
+            reader.stop()
+
+    def test_unavailable(self, still):
+        """References must still be in the history"""
+        result = still.wait_for_change(10 ** 6, timeout=0.1)
+        assert not result["success"]
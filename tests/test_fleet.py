@@ -0,0 +1,141 @@
+"""Tests for fanning out calls to nodes (local stub nodes)"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from pi_stream.api.fleet import ConnectionPool, Fleet
+
+
+class StubNode(BaseHTTPRequestHandler):
+    """Answers like a node's API: /status, /screenshot, /slow"""
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True  # (headers and body are sent apart)
+
+    def respond(self, data: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith("/slow"):
+            time.sleep(1.0)
+        self.server.requests += 1
+        if self.path.startswith("/screenshot"):
+            self.respond(b"\x89PNG", "image/png")
+        elif self.path.startswith("/truncated"):
+            self.respond(b'{"success": tr', "application/json")
+        else:
+            body = {"success": True, "port": self.server.server_port}
+            self.respond(json.dumps(body).encode(), "application/json")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        self.server.requests += 1
+        if self.path == "/fail":
+            body = {"success": False, "controller_code": "INVALID_STATE"}
+        self.respond(json.dumps({"success": True, "body": body}
+                                if self.path != "/fail" else body).encode(),
+                     "application/json")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def nodes():
+    servers = []
+    for _ in range(3):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubNode)
+        server.requests = 0
+        server.daemon_threads = True  # (keep-alive connections stay open)
+        threading.Thread(target=server.serve_forever, args=(0.05,),
+                         daemon=True).start()
+        servers.append(server)
+    yield servers
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def address(server) -> str:
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+class TestFleet:
+    """Tests for Fleet and ConnectionPool"""
+    def test_fan_out(self, nodes):
+        fleet = Fleet([address(n) for n in nodes])
+        results = fleet.call("POST", "/recording/list", {"x": 1})
+        assert list(results) == [address(n) for n in nodes]
+        for result in results.values():
+            assert result["success"]
+            assert result["data"] == {"success": True, "body": {"x": 1}}
+        fleet.close()
+
+    def test_binary(self, nodes):
+        fleet = Fleet([address(nodes[0])])
+        result = fleet.call("GET", "/screenshot?out_fmt=png")
+        assert result[address(nodes[0])]["data"] == b"\x89PNG"
+        fleet.close()
+
+    def test_keep_alive(self, nodes):
+        """Consecutive requests reuse the connection"""
+        pool = ConnectionPool(address(nodes[0]))
+        pool.request("GET", "/status")
+        connection = pool._idle.queue[0]
+        pool.request("GET", "/status")
+        assert pool._idle.queue == [connection]
+        assert nodes[0].requests == 2
+        pool.close()
+
+    def test_api_error(self, nodes):
+        """API failures (success false) are failed results"""
+        fleet = Fleet([address(nodes[0])])
+        result = fleet.call("POST", "/fail")[address(nodes[0])]
+        assert not result["success"]
+        assert result["data"]["controller_code"] == "INVALID_STATE"
+        fleet.close()
+
+    def test_invalid_json(self, nodes):
+        """A response that is not valid JSON is that node's error"""
+        fleet = Fleet([address(nodes[0])])
+        result = fleet.call("GET", "/truncated")[address(nodes[0])]
+        assert not result["success"]
+        assert result["error"].startswith("invalid JSON response")
+        assert fleet.call("GET", "/status")[address(nodes[0])]["success"]
+        fleet.close()
+
+    def test_timeout(self, nodes):
+        """A slow or unreachable node does not delay the others' results"""
+        fleet = Fleet([address(nodes[0]), "http://127.0.0.1:1"])
+        start = time.monotonic()
+        results = fleet.call("GET", "/slow", timeout=0.2)
+        assert time.monotonic() - start < 1.0
+        assert not any(r["success"] for r in results.values())
+        assert "error" in results["http://127.0.0.1:1"]
+        assert fleet.call("GET", "/status")[address(nodes[0])]["success"]
+        fleet.close()
+
+    def test_status_cache(self, nodes):
+        fleet = Fleet([address(n) for n in nodes], status_ttl=60)
+        first = fleet.status()
+        assert all(r["success"] for r in first.values())
+        second = fleet.status()
+        assert all(r["cached"] for r in second.values())
+        assert sum(n.requests for n in nodes) == 3
+        fleet.status(max_age=0)
+        assert sum(n.requests for n in nodes) == 6
+        fleet.close()
+
+    def test_unknown_node(self, nodes):
+        fleet = Fleet([address(nodes[0])])
+        result = fleet.call("GET", "/status", nodes=["http://other:8000"])
+        assert result == {"http://other:8000": {"success": False,
+                                                "error": "unknown node"}}
+        fleet.close()
@@ -0,0 +1,51 @@
+"""Tests for screenshot latency histograms"""
+
+import time
+
+from pi_stream.api.latency import LatencyHistogram, LatencyStats
+from pi_stream.api.latency import stage_timings, timing_headers
+
+
+class TestHistogram:
+    """Tests for bucketed latency histograms"""
+    def test_quantiles(self):
+        """Quantiles are bucket upper bounds"""
+        histogram = LatencyHistogram()
+        for ms in [3] * 90 + [40] * 9 + [700]:
+            histogram.record(ms)
+        summary = histogram.summary()
+        assert summary["count"] == 100
+        assert summary["p50"] == 5
+        assert summary["p95"] == 50
+        assert summary["p99"] == 50
+        assert summary["max"] == 700
+        assert summary["buckets"]["le_1000"] == 1
+
+    def test_overflow(self):
+        """Latencies above the last bucket report the maximum"""
+        histogram = LatencyHistogram()
+        histogram.record(60000)
+        assert histogram.summary()["p50"] == 60000
+        assert histogram.summary()["buckets"]["le_inf"] == 1
+
+
+class TestTimings:
+    """Tests for per-stage timings"""
+    def test_stages(self):
+        """Stages come from the hardware's monotonic timestamps"""
+        now = time.monotonic()
+        result = {"captured": now - 0.050, "served": now - 0.010,
+                  "encode_ms": 12.0}
+        timings = stage_timings(result, received=now - 0.002)
+        assert round(timings["capture_age"]) == 40
+        assert round(timings["rpc"]) == 8
+        assert timings["age"] >= 50
+        assert timing_headers(timings)["X-Encode-Ms"] == "12.0"
+
+    def test_stats(self):
+        """Histograms are kept per route and stage"""
+        stats = LatencyStats()
+        stats.record("fast_screenshot", {"encode": 4.0, "age": 30.0})
+        summary = stats.summary()
+        assert summary["fast_screenshot"]["encode"]["count"] == 1
+        assert summary["fast_screenshot"]["age"]["mean"] == 30.0
@@ -0,0 +1,46 @@
+"""Tests for raw frame export"""
+
+import numpy as np
+import pytest
+from pi_stream.hardware.raw import compression_available, pack, unpack
+
+
+class TestRaw:
+    """Tests for packing and unpacking raw frames"""
+    def test_bgr(self):
+        frame = np.random.randint(0, 255, (48, 64, 3), np.uint8)
+        header, array = unpack(pack(frame, "BGR"))
+        assert header == {"shape": [48, 64, 3], "dtype": "|u1",
+                          "format": "BGR", "compression": ""}
+        assert np.array_equal(array, frame)
+
+    def test_view(self):
+        """Non contiguous arrays (e.g. crops) are packed in C order"""
+        frame = np.arange(48 * 64 * 3, dtype=np.uint16).reshape(48, 64, 3)
+        crop = frame[10:20, 5:25]
+        header, array = unpack(pack(crop, "BGR"))
+        assert header["dtype"] == "<u2"
+        assert np.array_equal(array, crop)
+
+    def test_native(self):
+        """Capture format bytes keep the shape given"""
+        yuyv = bytes(range(256)) * 24
+        header, array = unpack(pack(yuyv, "YUYV", (48, 64, 2)))
+        assert header["format"] == "YUYV"
+        assert array.shape == (48, 64, 2)
+        assert array.tobytes() == yuyv
+
+    def test_compression(self):
+        assert compression_available("")
+        assert not compression_available("zip")
+
+    def test_lz4(self):
+        pytest.importorskip("lz4.frame")
+        frame = np.zeros((480, 640, 3), np.uint8)
+        raw = pack(frame, "BGR", compression="lz4")
+        assert len(raw) < frame.nbytes // 10
+        assert np.array_equal(unpack(raw)[1], frame)
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            unpack(b"\x89PNG\r\n")
@@ -0,0 +1,107 @@
+"""Tests for the recording catalog"""
+
+import sqlite3
+import threading
+
+import pytest
+from pi_stream.hardware.recording import Catalog, Recording, MIGRATIONS
+
+LEGACY_SCHEMA = """CREATE TABLE recordings (
+    id INTEGER NOT NULL PRIMARY KEY,
+    path VARCHAR,
+    length FLOAT,
+    size INTEGER,
+    timestamp DATETIME DEFAULT (CURRENT_TIMESTAMP),
+    name VARCHAR
+)"""
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = Catalog(str(tmp_path / "db.db"))
+    yield catalog
+    catalog.close()
+
+
+class TestMigrations:
+    """Tests for creating and upgrading the database"""
+    def test_new(self, tmp_path):
+        """A new database gets the latest schema in WAL mode"""
+        path = str(tmp_path / "db.db")
+        Catalog(path).close()
+        conn = sqlite3.connect(path)
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        assert version == len(MIGRATIONS)
+        assert mode == "wal"
+
+    def test_legacy(self, tmp_path):
+        """A database from before migrations gets the new columns and keeps
+        its rows"""
+        path = str(tmp_path / "db.db")
+        conn = sqlite3.connect(path)
+        conn.execute(LEGACY_SCHEMA)
+        conn.execute("INSERT INTO recordings (path) VALUES ('old.mp4')")
+        conn.commit()
+        conn.close()
+
+        catalog = Catalog(path)
+        recordings = catalog.recordings()
+        catalog.close()
+        assert recordings[0]["path"] == "old.mp4"
+        assert "drop_frames" in recordings[0]
+
+
+class TestCatalog:
+    """Tests for reading and writing recordings"""
+    def test_save(self, catalog):
+        """Inserting then updating a recording"""
+        recording = Recording(path="a.mp4", length=10)
+        catalog.save(recording)
+        assert recording.id is not None
+
+        recording.fps = 29.97
+        catalog.save(recording)
+        recordings = catalog.recordings()
+        assert len(recordings) == 1
+        assert recordings[0]["fps"] == 29.97
+        assert recordings[0]["timestamp"] is not None
+
+    def test_update(self, catalog):
+        """Queued updates are committed"""
+        recording_id = catalog.save(Recording(path="a.mp4"))
+        assert catalog.update(recording_id, {"size": 5}).result() == 1
+        assert catalog.recordings()[0]["size"] == 5
+
+    def test_delete(self, catalog):
+        """Deleting by path"""
+        catalog.save(Recording(path="a.mp4"))
+        assert catalog.delete("a.mp4") == 1
+        assert catalog.delete("a.mp4") == 0
+        assert catalog.recordings() == []
+
+    def test_failed_write(self, catalog):
+        """A failing write does not affect the rest of its batch"""
+        def fail(session):
+            raise ValueError("failed")
+
+        failed = catalog.write(fail)
+        catalog.save(Recording(path="a.mp4"))
+        with pytest.raises(ValueError):
+            failed.result()
+        assert len(catalog.recordings()) == 1
+
+    def test_concurrent(self, catalog):
+        """Writes and reads from many threads"""
+        def worker(i):
+            for j in range(10):
+                catalog.save(Recording(path=f"{i}-{j}.mp4"))
+                catalog.recordings()
+
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(catalog.recordings()) == 80
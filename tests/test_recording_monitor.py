@@ -0,0 +1,89 @@
+"""Tests for parsing ffmpeg progress output"""
+
+from pi_stream.hardware.recording_monitor import RecordingMonitor
+
+BLOCK = """frame=300
+fps=29.97
+stream_0_0_q=-0.0
+bitrate=2048.5kbits/s
+total_size=2621440
+out_time_us=10000000
+out_time_ms=10000000
+out_time=00:00:10.000000
+dup_frames=2
+drop_frames=0
+speed=1.01x
+progress=continue
+"""
+
+SLOW_BLOCK = BLOCK.replace("speed=1.01x", "speed=0.85x") \
+                  .replace("drop_frames=0", "drop_frames=4")
+
+END_BLOCK = BLOCK.replace("progress=continue", "progress=end")
+
+
+class TestFeed:
+    """Tests for feeding output into the monitor"""
+    def test_block(self):
+        """A complete block is published"""
+        monitor = RecordingMonitor(warmup=0)
+        monitor.feed(BLOCK)
+        stats = monitor.stats()
+        assert stats["frame"] == 300
+        assert stats["fps"] == 29.97
+        assert stats["bitrate_kbps"] == 2048.5
+        assert stats["total_size"] == 2621440
+        assert stats["dup_frames"] == 2
+        assert stats["speed"] == 1.01
+        assert stats["out_time"] == 10.0
+        assert stats["alerts"] == []
+
+    def test_incomplete_block(self):
+        """Nothing is published until 'progress=' is read"""
+        monitor = RecordingMonitor(warmup=0)
+        monitor.feed(BLOCK.split("progress")[0])
+        assert "frame" not in monitor.stats()
+
+    def test_split_lines(self):
+        """Output may arrive in arbitrary chunks"""
+        monitor = RecordingMonitor(warmup=0)
+        for i in range(0, len(BLOCK), 7):
+            monitor.feed(BLOCK[i:i + 7].encode("utf-8"))
+        assert monitor.stats()["frame"] == 300
+
+    def test_not_available(self):
+        """'N/A' values become None"""
+        monitor = RecordingMonitor(warmup=0)
+        monitor.feed(BLOCK.replace("speed=1.01x", "speed=N/A"))
+        assert monitor.stats()["speed"] is None
+
+    def test_end(self):
+        """progress=end marks the recording as finished"""
+        monitor = RecordingMonitor(warmup=0)
+        monitor.feed(END_BLOCK)
+        assert monitor.finished
+
+
+class TestAlerts:
+    """Tests for real-time and dropped frame alerts"""
+    def test_slow(self):
+        """Speed below 1.0x raises alerts"""
+        monitor = RecordingMonitor(warmup=0)
+        monitor.feed(SLOW_BLOCK)
+        stats = monitor.stats()
+        assert "BEHIND_REALTIME" in stats["alerts"]
+        assert "DROPPED_FRAMES" in stats["alerts"]
+        assert stats["slow_periods"] == 1
+
+    def test_recovered(self):
+        """BEHIND_REALTIME clears once speed recovers"""
+        monitor = RecordingMonitor(warmup=0)
+        monitor.feed(SLOW_BLOCK)
+        monitor.feed(BLOCK)
+        assert "BEHIND_REALTIME" not in monitor.alerts()
+
+    def test_warmup(self):
+        """No alerts during warmup"""
+        monitor = RecordingMonitor(warmup=60)
+        monitor.feed(SLOW_BLOCK)
+        assert monitor.alerts() == []
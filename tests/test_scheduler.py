@@ -0,0 +1,120 @@
+"""Tests for the controller operation scheduler"""
+
+import threading
+import time
+
+import pytest
+from pi_stream.hardware.scheduler import HIGH, LOW, NORMAL
+from pi_stream.hardware.scheduler import DeadlineExceeded, Scheduler
+
+
+class Blocker:
+    """Operation that runs until released"""
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.started.set()
+        self.release.wait(5)
+        return "blocked"
+
+
+class TestScheduler:
+    """Tests for queueing, coalescing and deadlines"""
+    def test_single_flight(self):
+        """Identical calls made while one is queued or running share it"""
+        scheduler = Scheduler()
+        calls = []
+
+        def screenshot(fmt):
+            calls.append(fmt)
+            time.sleep(0.1)
+            return {"success": True, "format": fmt}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            scheduler.call("screenshot", screenshot, ("png",))))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert calls == ["png"]
+        assert results == [{"success": True, "format": "png"}] * 5
+        stats = scheduler.stats()["operations"]["screenshot"]
+        assert stats["count"] == 1 and stats["coalesced"] == 4
+
+        # a later call runs again
+        scheduler.call("screenshot", screenshot, ("png",))
+        assert calls == ["png", "png"]
+
+    def test_different_arguments(self):
+        scheduler = Scheduler()
+        blocker = Blocker()
+        scheduler.submit("block", blocker)
+        blocker.started.wait(5)
+        png = scheduler.submit("screenshot", lambda fmt: fmt, ("png",))
+        jpg = scheduler.submit("screenshot", lambda fmt: fmt, ("jpg",))
+        blocker.release.set()
+        assert (png.result(5), jpg.result(5)) == ("png", "jpg")
+
+    def test_priority(self):
+        """Higher priority operations run first, then in order of arrival"""
+        scheduler = Scheduler()
+        blocker = Blocker()
+        order = []
+        scheduler.submit("block", blocker)
+        blocker.started.wait(5)
+        assert scheduler.stats()["running"]["name"] == "block"
+
+        futures = [
+            scheduler.submit("reset_usb", order.append, ("low",), LOW),
+            scheduler.submit("screenshot", order.append, ("first",), NORMAL),
+            scheduler.submit("screenshot", order.append, ("second",)),
+            scheduler.submit("stop", order.append, ("high",), HIGH)
+        ]
+        stats = scheduler.stats()
+        assert stats["queue_depth"] == 4
+        assert stats["queued"] == ["stop", "screenshot", "screenshot",
+                                   "reset_usb"]
+        blocker.release.set()
+        for future in futures:
+            future.result(5)
+        assert order == ["high", "first", "second", "low"]
+
+    def test_deadline(self):
+        """Calls that would finish after their deadline are rejected"""
+        scheduler = Scheduler()
+        scheduler.call("screenshot", time.sleep, (0.2,))  # learns ~0.2 s
+        with pytest.raises(DeadlineExceeded):
+            scheduler.call("screenshot", time.sleep, (0.21,), deadline=0.05)
+        assert scheduler.call("screenshot", time.sleep, (0.01,),
+                              deadline=1.0) is None
+        stats = scheduler.stats()["operations"]["screenshot"]
+        assert stats["rejected"] == 1 and stats["count"] == 2
+        assert isinstance(DeadlineExceeded(), TimeoutError)
+
+    def test_deadline_while_queued(self):
+        """A call whose deadline passes while it waits does not run"""
+        scheduler = Scheduler()
+        blocker = Blocker()
+        scheduler.submit("block", blocker)
+        blocker.started.wait(5)
+        ran = []
+        future = scheduler.submit("screenshot", ran.append, (1,),
+                                  deadline=0.05)
+        time.sleep(0.1)
+        blocker.release.set()
+        with pytest.raises(DeadlineExceeded):
+            future.result(5)
+        assert ran == []
+
+    def test_error(self):
+        """Errors reach every caller, the scheduler keeps running"""
+        scheduler = Scheduler()
+        with pytest.raises(ZeroDivisionError):
+            scheduler.call("divide", lambda: 1 / 0)
+        assert scheduler.call("add", lambda: 1 + 1) == 2
+        assert scheduler.stats()["queue_depth"] == 0
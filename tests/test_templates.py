@@ -0,0 +1,93 @@
+"""Tests for template matching"""
+
+import cv2
+import numpy as np
+import pytest
+from pi_stream.hardware.templates import Template, TemplateStore
+from pi_stream.hardware.templates import match, wait_for_match
+
+
+def make_frame(x: int = 300, y: int = 200) -> np.ndarray:
+    """Noisy 640x480 frame with a 'button' (checkerboard) at x, y"""
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 60, (480, 640, 3), dtype=np.uint8)
+    button = np.kron([[1, 0] * 4, [0, 1] * 4] * 2, np.ones((10, 10)))
+    frame[y:y + 40, x:x + 80] = (button[..., None] * 255).astype(np.uint8)
+    return frame
+
+
+def encode(image: np.ndarray) -> bytes:
+    return cv2.imencode(".png", image)[1].tobytes()
+
+
+@pytest.fixture
+def template():
+    return Template("button", encode(make_frame()[200:240, 300:380]))
+
+
+class TestTemplate:
+    """Tests for uploading templates"""
+    def test_levels(self, template):
+        """Templates are grayscale with a pyramid"""
+        assert template.info() == {"name": "button", "width": 80,
+                                   "height": 40}
+        assert [level.shape for level in template.levels] == \
+            [(40, 80), (20, 40), (10, 20)]
+
+    def test_invalid(self):
+        """Data must be an image"""
+        with pytest.raises(ValueError):
+            Template("invalid", b"not an image")
+
+    def test_store(self):
+        """The least recently used templates are dropped"""
+        store = TemplateStore(size=2)
+        data = encode(make_frame()[200:240, 300:380])
+        store.add("a", data)
+        store.add("b", data)
+        store.get("a")
+        store.add("c", data)
+        assert [t["name"] for t in store.list()] == ["a", "c"]
+        assert store.remove("a")
+        assert not store.remove("a")
+
+
+class TestMatch:
+    """Tests for finding templates in frames"""
+    @pytest.mark.parametrize("level", [0, 1, 2])
+    def test_found(self, template, level):
+        """The match is at the template's location (full resolution)"""
+        result = match(template, make_frame(), level=level)
+        assert result["score"] > 0.9
+        assert abs(result["x"] - 300) <= 2 ** level
+        assert abs(result["y"] - 200) <= 2 ** level
+
+    def test_region(self, template):
+        """Searching a region that does not contain the template"""
+        result = match(template, make_frame(), region=[0, 0, 200, 200])
+        assert result["score"] < 0.5
+
+    def test_region_too_small(self, template):
+        """No score if the region is smaller than the template"""
+        result = match(template, make_frame(), region=[0, 0, 20, 20])
+        assert result["score"] is None
+
+    def test_wait(self, template):
+        """Waits until a frame matches"""
+        frames = [make_frame(0, 0) * 0, make_frame(0, 0) * 0, make_frame()]
+
+        def next_frame(after, timeout):
+            return after + 1, frames[min(after, len(frames) - 1)]
+
+        result = wait_for_match(next_frame, template, 0.9, timeout=1)
+        assert result["matched"]
+        assert result["matches"] == 3
+        assert result["sequence"] == 3
+
+    def test_wait_timeout(self, template):
+        """Returns the best match when the timeout expires"""
+        def next_frame(after, timeout):
+            return after + 1, np.zeros((480, 640, 3), np.uint8)
+
+        result = wait_for_match(next_frame, template, 0.9, timeout=0.05)
+        assert not result["matched"]
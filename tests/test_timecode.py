@@ -0,0 +1,36 @@
+"""Tests for timecode images (simulated HDMI source)"""
+
+import cv2
+import numpy as np
+import pytest
+from pi_stream.hardware.timecode import decode, render
+
+
+def capture(image: np.ndarray, width: int = 1280, height: int = 720,
+            quality: int = 60) -> np.ndarray:
+    """Simulates the capture card: scaling and MJPEG compression"""
+    image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+    data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1]
+    return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+
+class TestTimecode:
+    """Tests for rendering and reading back timecodes"""
+    @pytest.mark.parametrize("value", [0, 1, 123456789, 2 ** 32 - 1])
+    def test_round_trip(self, value):
+        """Values survive scaling and compression"""
+        assert decode(capture(render(value))) == value
+
+    def test_wrap(self):
+        """Values are taken modulo 2 ** 32"""
+        assert decode(render(2 ** 32 + 5)) == 5
+
+    def test_torn(self):
+        """A frame captured mid-refresh is rejected"""
+        old, new = render(0x0f0f0f0f), render(0xf0f0f0f0)
+        torn = np.vstack([old[:700], new[700:]])
+        assert decode(capture(torn)) is None
+
+    def test_not_timecode(self):
+        """Frames without a timecode are rejected"""
+        assert decode(np.zeros((720, 1280, 3), np.uint8)) is None
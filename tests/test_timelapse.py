@@ -0,0 +1,197 @@
+"""Tests for timelapse capture (with fake capture devices)"""
+
+import shutil
+import time
+
+import cv2
+import numpy as np
+import pytest
+from pi_stream.hardware import timelapse
+from pi_stream.hardware.timelapse import MjpegAviWriter, Timelapse
+
+WIDTH = 64
+HEIGHT = 48
+
+
+def jpeg(level: int) -> bytes:
+    image = np.full((HEIGHT, WIDTH, 3), level, np.uint8)
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+
+def read_levels(path: str) -> list:
+    """Gets the mean level of each frame of a video"""
+    video = cv2.VideoCapture(str(path))
+    levels = []
+    while True:
+        ok, frame = video.read()
+        if not ok:
+            return levels
+        levels.append(round(frame.mean() / 10) * 10)
+
+
+class FakeCamera:
+    """Stands in for cv2.VideoCapture"""
+    def __init__(self, buffer_size: int = 0):
+        self.buffer_size = buffer_size
+        self.count = 0
+        self.released = False
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_BUFFERSIZE:
+            return self.buffer_size
+        return 0
+
+    def grab(self):
+        self.count += 1
+        return True
+
+    def retrieve(self):
+        return True, np.full((HEIGHT, WIDTH, 3), 100, np.uint8)
+
+    def release(self):
+        self.released = True
+
+
+class FakeFrame:
+    def __init__(self, capture, data: bytes):
+        self.capture = capture
+        self.data = memoryview(data)
+        self.width = WIDTH
+        self.height = HEIGHT
+
+    def release(self):
+        self.capture.queued += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class FakeV4l2Capture:
+    """Stands in for v4l2.V4l2Capture in MJPEG mode"""
+    def __init__(self):
+        self.streaming = False
+        self.starts = 0
+        self.grabs = 0
+        self.queued = 0
+        self.released = False
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FOURCC:
+            return cv2.VideoWriter_fourcc(*"MJPG")
+        return 0
+
+    def start(self):
+        self.streaming = True
+        self.starts += 1
+
+    def stop(self):
+        self.streaming = False
+
+    def grab(self, timeout: float = 2.0, latest: bool = False):
+        if not self.streaming:
+            self.start()
+        self.grabs += 1
+        return FakeFrame(self, jpeg(200))
+
+    def release(self):
+        self.released = True
+
+
+def test_writer(tmp_path):
+    path = tmp_path / "timelapse.avi"
+    writer = MjpegAviWriter(str(path), WIDTH, HEIGHT, 10)
+    for i in range(25):
+        writer.write(jpeg(i * 10))
+    writer.close()
+    assert writer.frames == 25
+    assert writer.size == path.stat().st_size
+    assert read_levels(path) == [i * 10 for i in range(25)]
+    assert cv2.VideoCapture(str(path)).get(cv2.CAP_PROP_FPS) == 10
+
+
+def test_writer_interrupted(tmp_path):
+    """A file that was never closed (no index) still plays"""
+    writer = MjpegAviWriter(str(tmp_path / "timelapse.avi"), WIDTH, HEIGHT,
+                            10)
+    for i in range(15):
+        writer.write(jpeg(i * 10))
+    writer._file.flush()
+    shutil.copy(tmp_path / "timelapse.avi", tmp_path / "copy.avi")
+    writer.close()
+    assert len(read_levels(tmp_path / "copy.avi")) >= 10
+
+
+def test_encoded(tmp_path):
+    """cv2 capture: stale frames grabbed, the newest decoded and encoded"""
+    cam = FakeCamera()
+    path = tmp_path / "timelapse.avi"
+    capture = Timelapse(cam, str(path), interval=0.02, length=0.1)
+    assert not capture.passthrough
+    capture.start()
+    capture.join(5)
+    assert not capture.is_alive() and cam.released
+    stats = capture.stats()
+    assert stats["error"] is None and stats["running"] is False
+    assert 4 <= stats["frames"] <= 7
+    assert cam.count == 4 * stats["frames"]
+    assert read_levels(path) == [100] * stats["frames"]
+
+
+@pytest.mark.parametrize("buffer_size, grabs", [(0, 4), (-1, 4), (2, 2)])
+def test_buffer_size(tmp_path, buffer_size, grabs):
+    """Buffered frames are skipped, 4 if the backend reports no size"""
+    cam = FakeCamera(buffer_size)
+    capture = Timelapse(cam, str(tmp_path / "timelapse.avi"), interval=1)
+    assert capture._capture_encoded()
+    capture.writer.close()
+    assert cam.count == grabs
+
+
+def test_passthrough_paused(tmp_path):
+    """MJPEG bytes written as captured, streaming off between frames"""
+    cam = FakeV4l2Capture()
+    path = tmp_path / "timelapse.avi"
+    capture = Timelapse(cam, str(path), interval=2.5)
+    assert capture.passthrough and capture.pause
+    capture.start()
+    while capture.frames < 1:
+        time.sleep(0.01)
+    capture.stop()
+    assert capture.frames == 1
+    assert cam.starts == 1 and not cam.streaming
+    assert cam.grabs == 1 + timelapse.SETTLE_FRAMES
+    assert cam.queued == cam.grabs  # every buffer given back
+    assert read_levels(path) == [200]
+
+
+def test_parts(tmp_path, monkeypatch):
+    monkeypatch.setattr(timelapse, "MAX_FILE_SIZE", 2000)
+    parts = []
+    path = tmp_path / "timelapse.avi"
+    capture = Timelapse(FakeV4l2Capture(), str(path), interval=0.01,
+                        length=0.2, on_part=parts.append)
+    capture.start()
+    capture.join(5)
+    assert len(capture.parts) > 1
+    assert parts == capture.parts[1:]
+    assert parts[0] == str(tmp_path / "timelapse_part2.avi")
+    assert sum(capture.part_frames) == capture.frames
+    for part, frames in zip(capture.parts, capture.part_frames):
+        assert len(read_levels(part)) == frames
+
+
+def test_schedule_skips_missed_frames(tmp_path):
+    class SlowCamera(FakeCamera):
+        def retrieve(self):
+            time.sleep(0.05)
+            return super().retrieve()
+
+    capture = Timelapse(SlowCamera(), str(tmp_path / "timelapse.avi"),
+                        interval=0.02, length=0.2)
+    capture.start()
+    capture.join(5)
+    assert capture.skipped > 0
+    assert capture.frames + capture.skipped >= 8
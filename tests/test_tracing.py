@@ -0,0 +1,222 @@
+"""Tests for request tracing (API and hardware sides)"""
+
+import asyncio
+import threading
+import time
+import xmlrpc.client
+from xmlrpc.server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
+
+import pytest
+from pi_stream.api.tracing import RequestTrace, TraceMiddleware
+from pi_stream.api.tracing import TracingTransport, current_trace
+from pi_stream.hardware.scheduler import Scheduler
+from pi_stream.hardware.tracing import OtlpExporter, Tracer, otlp_traces
+from pi_stream.hardware.tracing import parse_traceparent, traceparent
+
+TRACE_ID = "0af7651916cd43dd8448eb211c80319c"
+SPAN_ID = "b7ad6b7169203331"
+
+
+def test_traceparent():
+    header = traceparent(TRACE_ID, SPAN_ID, True)
+    assert header == f"00-{TRACE_ID}-{SPAN_ID}-01"
+    assert parse_traceparent(header) == (TRACE_ID, SPAN_ID, True)
+    assert parse_traceparent("nonsense") is None
+    assert parse_traceparent(None) is None
+
+
+def test_nested_spans():
+    tracer = Tracer(slow_ms=0.0)  # keep everything
+    with tracer.span("root") as root:
+        with tracer.span("child", frames=3):
+            tracer.record("done", root.start, 1.0)
+    [trace] = tracer.traces()
+    assert trace["trace_id"] == root.trace_id
+    assert trace["name"] == "root"
+    spans = {span["name"]: span for span in trace["spans"]}
+    assert spans["child"]["parent_id"] == root.span_id
+    assert spans["child"]["attributes"] == {"frames": 3}
+    assert spans["done"]["parent_id"] == spans["child"]["span_id"]
+
+
+def test_fast_traces_dropped():
+    tracer = Tracer(slow_ms=10000.0)
+    with tracer.span("fast"):
+        pass
+    assert tracer.traces() == []
+
+
+def test_error_recorded():
+    tracer = Tracer(slow_ms=0.0)
+    with pytest.raises(ValueError):
+        with tracer.span("fails"):
+            raise ValueError("bad")
+    assert tracer.traces()[0]["spans"][0]["error"] == "ValueError: bad"
+
+
+def test_remote_trace_kept_by_caller():
+    """Spans of a call from a traced request wait for trace_keep"""
+    tracer = Tracer(slow_ms=0.0)
+    with tracer.span("xmlrpc screenshot", (TRACE_ID, SPAN_ID, False)):
+        with tracer.span("screenshot"):
+            pass
+    assert tracer.traces() == []  # (the API decides)
+
+    api_span = {"name": "GET /screenshot", "trace_id": TRACE_ID,
+                "span_id": SPAN_ID, "parent_id": None, "service": "api",
+                "start": 0.0, "duration_ms": 2000.0, "attributes": {},
+                "error": None}
+    assert tracer.keep(TRACE_ID, [api_span]) == 2
+    [trace] = tracer.traces()
+    assert trace["name"] == "GET /screenshot"
+    assert trace["duration_ms"] == 2000.0
+    assert len(trace["spans"]) == 3
+
+
+def test_capacity():
+    tracer = Tracer(slow_ms=0.0, capacity=3)
+    for i in range(5):
+        with tracer.span(f"call {i}"):
+            pass
+    assert [t["name"] for t in tracer.traces()] == \
+        ["call 4", "call 3", "call 2"]
+    assert len(tracer.traces(limit=1)) == 1
+
+
+def test_otlp_payload():
+    tracer = Tracer(service="hardware", slow_ms=0.0)
+    with tracer.span("root", attempt=1, ok=True, ratio=0.5, mode="cv2"):
+        with tracer.span("child"):
+            pass
+    spans = tracer.traces()[0]["spans"]
+    payload = otlp_traces(spans)
+    [resource] = payload["resourceSpans"]
+    assert resource["resource"]["attributes"][0]["value"] == \
+        {"stringValue": "hardware"}
+    root, child = resource["scopeSpans"][0]["spans"]
+    assert "parentSpanId" not in root
+    assert child["parentSpanId"] == root["spanId"]
+    assert int(root["endTimeUnixNano"]) >= int(root["startTimeUnixNano"])
+    assert root["attributes"] == [
+        {"key": "attempt", "value": {"intValue": "1"}},
+        {"key": "ok", "value": {"boolValue": True}},
+        {"key": "ratio", "value": {"doubleValue": 0.5}},
+        {"key": "mode", "value": {"stringValue": "cv2"}}]
+
+
+def test_otlp_export_error():
+    """A failing export drops its batch, the exporter keeps running"""
+    class Exporter(OtlpExporter):
+        def post(self, spans):
+            if spans[0]["name"] == "bad":
+                raise TypeError("not JSON serializable")
+            self.posted = spans
+
+    exporter = Exporter("http://127.0.0.1:1/v1/traces", interval=0.0)
+    exporter.start()
+    exporter.export([{"name": "bad"}])
+    exporter.export([{"name": "good"}])
+    deadline = time.monotonic() + 5.0
+    while exporter.exported == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert exporter.is_alive()
+    assert exporter.dropped == 1
+    assert exporter.posted == [{"name": "good"}]
+
+
+def test_scheduler_continues_trace():
+    """Operations run on the scheduler's thread, in the caller's trace"""
+    tracer = Tracer(slow_ms=0.0)
+    scheduler = Scheduler(tracer=tracer)
+
+    def operation():
+        with tracer.span("device.open"):
+            return threading.current_thread().name
+
+    with tracer.span("xmlrpc screenshot") as root:
+        assert scheduler.call("screenshot", operation) == "scheduler"
+    spans = {span["name"]: span for span in tracer.traces()[0]["spans"]}
+    assert spans["queue screenshot"]["parent_id"] == root.span_id
+    assert spans["screenshot"]["parent_id"] == root.span_id
+    assert spans["device.open"]["parent_id"] == \
+        spans["screenshot"]["span_id"]
+
+
+class HeaderHandler(SimpleXMLRPCRequestHandler):
+    def do_POST(self):
+        self.server.traceparents.append(self.headers.get("traceparent"))
+        super().do_POST()
+
+
+@pytest.fixture
+def server():
+    server = SimpleXMLRPCServer(("127.0.0.1", 0), HeaderHandler,
+                                logRequests=False)
+    server.traceparents = []
+    server.register_function(lambda: "pong", "ping")
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def test_transport_propagates_trace(server):
+    address = f"http://127.0.0.1:{server.server_address[1]}"
+    proxy = xmlrpc.client.ServerProxy(address, transport=TracingTransport())
+    assert proxy.ping() == "pong"  # (no request being handled)
+
+    trace = RequestTrace("GET /ping", f"00-{TRACE_ID}-{SPAN_ID}-01")
+    token = current_trace.set(trace)
+    try:
+        assert proxy.ping() == "pong"
+    finally:
+        current_trace.reset(token)
+
+    root, call = trace.spans
+    assert root["parent_id"] == SPAN_ID
+    assert call["name"] == "xmlrpc ping"
+    assert call["parent_id"] == root["span_id"]
+    assert call["duration_ms"] is not None
+    assert server.traceparents == [
+        None, f"00-{TRACE_ID}-{call['span_id']}-01"]
+
+
+def test_middleware_keeps_slow_requests():
+    kept = []
+
+    async def keep(trace):
+        kept.append(trace)
+
+    async def app(scope, receive, send):
+        if scope["path"] == "/slow":
+            await asyncio.sleep(0.05)
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    async def request(path: str) -> list:
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": path,
+                 "headers": []}
+        await middleware(scope, None, send)
+        return messages
+
+    middleware = TraceMiddleware(app, keep, slow_ms=30.0)
+    messages = asyncio.run(request("/fast"))
+    assert kept == []
+    trace_id = dict(messages[0]["headers"])[b"x-trace-id"].decode()
+
+    asyncio.run(request("/slow"))
+    [trace] = kept
+    assert trace.trace_id != trace_id
+    assert trace.duration_ms >= 30.0
+    [span] = trace.finished_spans()
+    assert span["name"] == "GET /slow"
+    assert span["attributes"]["status"] == 200
+    assert "_start" not in span
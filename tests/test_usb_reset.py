@@ -0,0 +1,68 @@
+"""Tests for USB reset readiness polling (fake sysfs and devices)"""
+
+import sys
+import time
+
+import pytest
+
+
+class FakeDevice:
+    """Answers readiness polls from a script, then keeps the last answer"""
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.polls = 0
+
+    def __call__(self, name):
+        self.polls += 1
+        if len(self.answers) > 1:
+            return self.answers.pop(0)
+        return self.answers[0]
+
+
+@pytest.fixture
+def sysfs(controller, tmp_path, monkeypatch):
+    """Device reset through a fake sysfs 'authorized' file"""
+    (tmp_path / "authorized").write_text("1")
+    module = sys.modules["controller"]
+    monkeypatch.setattr(module, "find_usb_sysfs", lambda id_1, id_2:
+                        str(tmp_path))
+    monkeypatch.setattr(module, "alsa_ready", FakeDevice(True))
+    return tmp_path
+
+
+def use_v4l2(monkeypatch, device: FakeDevice):
+    monkeypatch.setattr(sys.modules["controller"], "v4l2_ready", device)
+
+
+def test_comes_back(controller, sysfs, monkeypatch):
+    """Ready once the device has disappeared and come back"""
+    device = FakeDevice(True, False, False, False, True)
+    use_v4l2(monkeypatch, device)
+    result = controller.reset_usb(wait=True)
+    assert result["success"] and not result["in_progress"]
+    assert result["last_reset"]["method"] == "sysfs"
+    assert result["last_reset"]["ready"]
+    assert device.polls == 5
+    assert (sysfs / "authorized").read_text() == "1"
+    assert result["controller_state"] == "IDLE"
+
+
+def test_never_down(controller, sysfs, monkeypatch):
+    """A device that never disappears is ready after MIN_DOWN"""
+    use_v4l2(monkeypatch, FakeDevice(True))
+    result = controller.reset_usb(wait=True)
+    assert result["last_reset"]["ready"]
+    assert result["last_reset"]["recovery_time"] >= 0.1
+    assert result["controller_state"] == "IDLE"
+
+
+def test_not_ready(controller, monkeypatch):
+    """A device that does not come back is reported as not ready"""
+    use_v4l2(monkeypatch, FakeDevice(False))
+    controller._usb_reset = {"method": "sysfs", "ready": False,
+                             "recovery_time": None}
+    controller._recover_usb(time.monotonic() - 9.8)  # (TIMEOUT is 10 s)
+    status = controller.usb_status()
+    assert status["last_reset"]["ready"] is False
+    assert status["last_reset"]["recovery_time"] >= 10.0
+    assert status["controller_state"] == "IDLE"
@@ -1,8 +1,15 @@
 """Tests for Utility Functions"""
 
+import re
+import signal
+import time
+
 import pytest
+from pi_stream.hardware import util
 from pi_stream.hardware.background_process import BackgroundProcess
 from pi_stream.hardware.util import force_exists, force_stop
+from pi_stream.hardware.util import ProcessInfo, find_processes, is_running
+from pi_stream.hardware.util import process_resources, send_signal
 
 NO_ARGS_COMMAND = "cat"
 
@@ -33,6 +40,26 @@ class TestForceStop:
         process.wait()  # wait for command to complete
         assert not force_stop(ARGS_COMMAND)["success"]
 
+    def test_arguments(self):
+        """Only processes with these arguments are stopped"""
+        process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
+        process.start()
+        assert not force_stop(ARGS_COMMAND, arguments="-n")["success"]
+        assert len(find_processes(ARGS_COMMAND)) == 1
+        assert force_stop(ARGS_COMMAND, arguments=ARGS_ARGS)["success"]
+
+    def test_not_permitted(self, monkeypatch):
+        """Processes that cannot be signalled are reported, not stopped"""
+        process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
+        process.start()
+        monkeypatch.setattr(util, "send_signal", lambda p, sig: False)
+        result = force_stop(ARGS_COMMAND, timeout=0.05)
+        assert not result["success"]
+        assert result["remaining"] == [p.pid for p in
+                                       find_processes(ARGS_COMMAND)]
+        monkeypatch.undo()
+        process.stop()
+
 
 @pytest.mark.filterwarnings(FILTER)
 class TestForceExists:
@@ -46,5 +73,76 @@ class TestForceExists:
 
     def test_stopped(self):
         """Verify a stopped process with the name does not exist"""
-        process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
+        BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)  # (never started)
         assert not force_exists(ARGS_COMMAND)["success"]
+
+
+@pytest.mark.filterwarnings(FILTER)
+class TestProcessTable:
+    """Tests for /proc process discovery"""
+    def test_exact_match(self):
+        """Only processes with exactly this name are found"""
+        process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
+        process.start()
+        assert len(find_processes(ARGS_COMMAND)) == 1
+        assert find_processes(ARGS_COMMAND[:-1]) == []
+        process.stop()
+
+    def test_resources(self):
+        """CPU and memory usage are reported"""
+        process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
+        process.start()
+        info = find_processes(ARGS_COMMAND)[0]
+        resources = process_resources(info)
+        assert resources["rss"] > 0
+        assert resources["cpu_percent"] >= 0
+        process.stop()
+
+    def test_cpu_samples_pruned(self):
+        """CPU samples of exited processes are forgotten"""
+        process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
+        process.start()
+        info = find_processes(ARGS_COMMAND)[0]
+        process_resources(info)
+        assert (info.pid, info.start_time) in util._cpu_samples
+        process.stop()
+        process.start()  # (a new process is sampled)
+        process_resources(find_processes(ARGS_COMMAND)[0])
+        assert (info.pid, info.start_time) not in util._cpu_samples
+        process.stop()
+
+    def test_recycled_pid(self):
+        """A process whose start time does not match is never signalled"""
+        process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
+        process.start()
+        info = find_processes(ARGS_COMMAND)[0]
+        stale = ProcessInfo(info.pid, info.start_time - 1,
+                            info.name, info.cmdline)
+        assert not is_running(stale)
+        assert not send_signal(stale, signal.SIGINT)
+        assert is_running(info)
+        process.stop()
+
+    def test_stopped(self):
+        """A stopped process is no longer running"""
+        process = BackgroundProcess(ARGS_COMMAND, ARGS_ARGS)
+        process.start()
+        info = find_processes(ARGS_COMMAND)[0]
+        process.stop()
+        assert not is_running(info)
+
+
+def test_startup_timer():
+    """Phases are timed from the end of the previous one"""
+    timer = util.StartupTimer()
+    time.sleep(0.05)
+    timer.phase("settings")
+    timer.phase("controllers")
+    (imports, age), (settings, slept), (controllers, _) = timer._phases
+    assert (imports, settings, controllers) == ("imports", "settings",
+                                                "controllers")
+    assert age > 0  # (since the process started)
+    assert slept >= 0.05
+    assert re.fullmatch(r"Startup: imports \d+ ms, settings \d+ ms, "
+                        r"controllers \d+ ms \(total \d+ ms\)",
+                        timer.report())
@@ -0,0 +1,120 @@
+"""Tests for the native V4L2 capture structures and frame conversion (no
+device needed)"""
+
+import ctypes
+import errno
+import os
+
+import cv2
+import numpy as np
+import pytest
+from pi_stream.hardware import v4l2
+
+
+class FakeCapture:
+    """Stands in for V4l2Capture, recording re-queued buffers"""
+    def __init__(self, pixelformat: int, width: int = 64, height: int = 48):
+        self.pixelformat = pixelformat
+        self.width = width
+        self.height = height
+        self.queued = []
+
+    def _queue(self, index: int):
+        self.queued.append(index)
+
+
+def make_frame(capture: FakeCapture, data: bytes, index: int = 2):
+    buffer = v4l2.v4l2_buffer(index=index, sequence=7, bytesused=len(data))
+    buffer.timestamp.tv_sec = 12
+    buffer.timestamp.tv_usec = 500000
+    return v4l2.Frame(capture, buffer, memoryview(bytearray(data)))
+
+
+@pytest.mark.skipif(ctypes.sizeof(ctypes.c_void_p) != 8,
+                    reason="sizes are for 64 bit ABIs")
+class TestStructures:
+    """Structures and ioctl numbers match linux/videodev2.h (64 bit)"""
+    def test_sizes(self):
+        assert ctypes.sizeof(v4l2.v4l2_format) == 208
+        assert ctypes.sizeof(v4l2.v4l2_requestbuffers) == 20
+        assert ctypes.sizeof(v4l2.v4l2_buffer) == 88
+        assert ctypes.sizeof(v4l2.v4l2_streamparm) == 204
+
+    def test_ioctls(self):
+        assert v4l2.VIDIOC_S_FMT == 0xc0d05605
+        assert v4l2.VIDIOC_REQBUFS == 0xc0145608
+        assert v4l2.VIDIOC_QUERYBUF == 0xc0585609
+        assert v4l2.VIDIOC_QBUF == 0xc058560f
+        assert v4l2.VIDIOC_DQBUF == 0xc0585611
+        assert v4l2.VIDIOC_STREAMON == 0x40045612
+        assert v4l2.VIDIOC_STREAMOFF == 0x40045613
+        assert v4l2.VIDIOC_S_PARM == 0xc0cc5616
+
+
+class TestFrame:
+    """Tests for converting and releasing mapped frames"""
+    def test_fourcc(self):
+        assert v4l2.V4L2_PIX_FMT_MJPEG == cv2.VideoWriter_fourcc(*"MJPG")
+        assert v4l2.V4L2_PIX_FMT_YUYV == cv2.VideoWriter_fourcc(*"YUYV")
+
+    def test_yuyv(self):
+        """A YUYV buffer is viewed without copying and converted to BGR"""
+        capture = FakeCapture(v4l2.V4L2_PIX_FMT_YUYV)
+        yuyv = np.zeros((48, 64, 2), np.uint8)
+        yuyv[:, :, 0] = 235  # white luma
+        yuyv[:, :, 1] = 128  # no chroma
+        frame = make_frame(capture, yuyv.tobytes())
+        assert frame.array().shape == (48, 64, 2)
+        image = frame.bgr()
+        assert image.shape == (48, 64, 3)
+        assert image.min() > 240
+        assert frame.timestamp == 12.5
+        assert frame.sequence == 7
+
+    def test_mjpeg(self):
+        capture = FakeCapture(v4l2.V4L2_PIX_FMT_MJPEG)
+        image = np.full((48, 64, 3), 200, np.uint8)
+        frame = make_frame(capture, cv2.imencode(".jpg", image)[1].tobytes())
+        decoded = frame.bgr()
+        assert decoded.shape == (48, 64, 3)
+        assert abs(int(decoded.mean()) - 200) < 3
+
+    def test_release(self):
+        """Releasing re-queues the buffer once"""
+        capture = FakeCapture(v4l2.V4L2_PIX_FMT_MJPEG)
+        with make_frame(capture, b"\xff\xd8", index=3) as frame:
+            assert capture.queued == []
+        frame.release()
+        assert capture.queued == [3]
+        assert frame.data is None
+
+    def test_unopened(self):
+        """Behaves like cv2.VideoCapture when there is no device"""
+        capture = v4l2.V4l2Capture()
+        assert not capture.open("/dev/does-not-exist")
+        assert not capture.isOpened()
+        assert capture.read() == (False, None)
+        assert capture.set(v4l2.CAP_PROP_FRAME_WIDTH, 1280)
+        assert capture.get(v4l2.CAP_PROP_FRAME_WIDTH) == 1280
+
+    def test_device_errors(self, monkeypatch):
+        """Device errors are logged and read as no frame, like cv2"""
+        capture = v4l2.V4l2Capture()
+        capture._fd = os.open(os.devnull, os.O_RDONLY)
+
+        def busy():
+            raise OSError(errno.EBUSY, "Device or resource busy")
+
+        monkeypatch.setattr(capture, "start", busy)
+        assert capture.grab() is None
+        assert capture.read() == (False, None)
+
+        def unplugged():
+            raise OSError(errno.EIO, "Input/output error")
+
+        capture._streaming = True
+        monkeypatch.setattr(v4l2.select, "select",
+                            lambda r, w, x, t: (r, [], []))
+        monkeypatch.setattr(capture, "_dequeue", unplugged)
+        assert capture.read() == (False, None)
+        os.close(capture._fd)
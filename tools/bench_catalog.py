@@ -0,0 +1,106 @@
+"""Measures recordings_list latency while recordings are being written
+
+Compares the previous setup (one shared session, rollback journal, calls
+serialized by a lock) with the Catalog (WAL, single batched writer,
+read-only connections). Run from the repository root:
+
+    python tools/bench_catalog.py
+"""
+
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "../src/pi_stream/hardware"))
+from recording import Base, Catalog, Recording  # noqa: E402
+
+DURATION = 3.0  # seconds per setup
+READERS = 4
+WRITERS = 2
+INITIAL_ROWS = 200  # catalog size before the benchmark
+
+
+class SharedSession:
+    """Previous setup: one session used by every RPC call"""
+
+    def __init__(self, path: str):
+        engine = create_engine(f"sqlite:///{path}",
+                               connect_args={"check_same_thread": False})
+        Base.metadata.create_all(bind=engine)
+        self.session = sessionmaker(bind=engine)()
+        self.lock = threading.Lock()
+
+    def save(self, recording: Recording):
+        with self.lock:
+            self.session.add(recording)
+            self.session.commit()
+
+    def recordings(self) -> list:
+        with self.lock:
+            return [r.to_dict() for r in self.session.query(Recording)]
+
+    def close(self):
+        self.session.close()
+
+
+def run(catalog) -> tuple:
+    """Runs readers and writers for DURATION seconds
+
+    Returns:
+        tuple: list latencies (seconds), number of writes
+    """
+    for i in range(INITIAL_ROWS):
+        catalog.save(Recording(path=f"initial-{i}.mp4", length=10))
+
+    stop = threading.Event()
+    latencies = []
+    writes = [0] * WRITERS
+
+    def reader():
+        while not stop.is_set():
+            start = time.perf_counter()
+            catalog.recordings()
+            latencies.append(time.perf_counter() - start)
+
+    def writer(n):
+        while not stop.is_set():
+            recording = Recording(path=f"{n}-{writes[n]}.mp4", length=10)
+            catalog.save(recording)
+            recording.size = 1024
+            catalog.save(recording)
+            writes[n] += 2
+
+    threads = [threading.Thread(target=reader) for _ in range(READERS)]
+    threads += [threading.Thread(target=writer, args=(n,))
+                for n in range(WRITERS)]
+    for thread in threads:
+        thread.start()
+    time.sleep(DURATION)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return latencies, sum(writes)
+
+
+def report(name: str, latencies: list, writes: int):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies)
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f"{name:8} list p50 {p50 * 1000:6.2f} ms  p99 {p99 * 1000:6.2f} ms  "
+          f"max {latencies[-1] * 1000:6.2f} ms  lists {len(latencies):5}  "
+          f"writes/s {writes / DURATION:6.0f}")
+
+
+print(f"{READERS} readers, {WRITERS} writers, {DURATION:.0f} s each")
+for name, factory in [("shared", SharedSession), ("catalog", Catalog)]:
+    with tempfile.TemporaryDirectory() as directory:
+        catalog = factory(os.path.join(directory, "db.db"))
+        report(name, *run(catalog))
+        catalog.close()
@@ -0,0 +1,110 @@
+"""Measures fan-out latency to 50 simulated nodes
+
+Each node is a local HTTP server answering /status after a simulated
+processing delay. Compares calling the nodes one at a time with a new
+connection per call (urllib) with Fleet (concurrent calls, persistent
+connections). Run from the repository root:
+
+    python tools/bench_fleet.py --nodes 50 --delay 0.02
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "../src/pi_stream/api"))
+from fleet import Fleet  # noqa: E402
+
+BODY = json.dumps({"success": True, "controller_state": "IDLE"}).encode()
+
+
+def stub_node(delay: float) -> ThreadingHTTPServer:
+    class Node(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # (headers and body are sent apart)
+
+        def do_POST(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Node)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def sequential(nodes: list):
+    for node in nodes:
+        request = urllib.request.Request(f"{node}/status", data=b"{}",
+                                         method="POST")
+        with urllib.request.urlopen(request, timeout=10) as response:
+            json.load(response)
+
+
+def report(name: str, times: list):
+    times = sorted(t * 1000 for t in times)
+    print(f"{name:28s} median {statistics.median(times):7.1f} ms  "
+          f"p95 {times[int(len(times) * 0.95)]:7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--nodes", type=int, default=50)
+    parser.add_argument("--delay", type=float, default=0.02,
+                        help="simulated node processing time (seconds)")
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    servers = [stub_node(args.delay) for _ in range(args.nodes)]
+    nodes = [f"http://127.0.0.1:{s.server_port}" for s in servers]
+
+    times = []
+    for _ in range(max(3, args.rounds // 4)):
+        start = time.perf_counter()
+        sequential(nodes)
+        times.append(time.perf_counter() - start)
+    report("sequential, new connections", times)
+
+    fleet = Fleet(nodes, workers=args.nodes)
+    start = time.perf_counter()
+    results = fleet.call("POST", "/status")
+    cold = time.perf_counter() - start
+    assert all(r["success"] for r in results.values())
+    print(f"{'fan-out, first (connect)':28s} {cold * 1000:7.1f} ms")
+
+    times = []
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        fleet.call("POST", "/status")
+        times.append(time.perf_counter() - start)
+    report("fan-out, pooled", times)
+
+    fleet.status()  # fills the cache
+    times = []
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        fleet.status()
+        times.append(time.perf_counter() - start)
+    report("fan-out status, cached", times)
+
+    fleet.close()
+    for server in servers:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
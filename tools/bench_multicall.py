@@ -0,0 +1,77 @@
+"""Measures round-trip savings of system.multicall against a stubbed
+hardware XML-RPC server (no capture card needed)
+
+Compares the dashboard calls (get_snapshot, get_format, recordings_list)
+made one request at a time with the same calls made in one multicall.
+"""
+
+import threading
+import time
+import xmlrpc.client
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+ITERATIONS = 200
+REQUEST_DELAY = 0.002  # simulated per-request overhead on the Pi (seconds)
+
+CALLS = ["get_snapshot", "get_format", "recordings_list"]
+
+
+class DelayedHandler(SimpleXMLRPCRequestHandler):
+    """Request handler adding a fixed delay to every HTTP request"""
+    def do_POST(self):
+        time.sleep(REQUEST_DELAY)
+        super().do_POST()
+
+
+def get_snapshot():
+    return {"instance": "bench", "version": 1, "controller_state": "IDLE",
+            "janus": {"name": "janus", "process_state": "STOPPED"},
+            "gstreamer": {"name": "gst-launch-1.0",
+                          "process_state": "STOPPED"}}
+
+
+def get_format():
+    return {"success": True, "status": {"Width/Height": "1920/1080",
+                                        "Pixel Format": "'MJPG'"}}
+
+
+def recordings_list():
+    return {"success": True, "count": 0, "data": [], "files": []}
+
+
+# start stub server
+server = SimpleXMLRPCServer(("127.0.0.1", 0), requestHandler=DelayedHandler,
+                            allow_none=True, logRequests=False)
+server.register_introspection_functions()
+server.register_multicall_functions()
+for function in [get_snapshot, get_format, recordings_list]:
+    server.register_function(function)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+addr = f"http://127.0.0.1:{server.server_address[1]}"
+xc = xmlrpc.client.ServerProxy(addr, allow_none=True)
+
+# separate calls
+start = time.perf_counter()
+for _ in range(ITERATIONS):
+    for call in CALLS:
+        getattr(xc, call)()
+separate = (time.perf_counter() - start) / ITERATIONS
+
+# multicall
+start = time.perf_counter()
+for _ in range(ITERATIONS):
+    batch = xmlrpc.client.MultiCall(xc)
+    for call in CALLS:
+        getattr(batch, call)()
+    list(batch())
+batched = (time.perf_counter() - start) / ITERATIONS
+
+print(f"{len(CALLS)} calls, {ITERATIONS} iterations, "
+      f"{REQUEST_DELAY * 1000:.1f} ms simulated request overhead")
+print(f"separate:  {separate * 1000:.2f} ms per dashboard")
+print(f"multicall: {batched * 1000:.2f} ms per dashboard")
+print(f"saved:     {(separate - batched) * 1000:.2f} ms "
+      f"({100 * (1 - batched / separate):.0f}%)")
+
+server.shutdown()
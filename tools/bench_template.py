@@ -0,0 +1,45 @@
+"""Measures template matches/second on 1080p frames (CPU)
+
+For each pyramid level, matches a 160x60 template against a synthetic
+1080p frame, searching the whole frame and a 640x360 region. Run from the
+repository root:
+
+    python tools/bench_template.py
+"""
+
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "../src/pi_stream/hardware"))
+from templates import LEVELS, Template, match  # noqa: E402
+
+DURATION = 2.0  # seconds per case
+X, Y = 1200, 700  # template location
+REGION = [960, 540, 640, 360]
+
+# noisy frame with a checkerboard "button"
+rng = np.random.default_rng(0)
+frame = rng.integers(0, 60, (1080, 1920, 3), dtype=np.uint8)
+button = np.kron([[1, 0] * 8, [0, 1] * 8] * 3, np.ones((10, 10)))
+frame[Y:Y + 60, X:X + 160] = (button[..., None] * 255).astype(np.uint8)
+template = Template("button", cv2.imencode(".png",
+                                           frame[Y:Y + 60, X:X + 160])[1])
+
+print(f"cv2 {cv2.__version__}, {cv2.getNumThreads()} threads, "
+      f"{os.cpu_count()} cores")
+for level in range(LEVELS):
+    for name, region in [("frame", None), ("region", REGION)]:
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < DURATION:
+            result = match(template, frame, region, level)
+            count += 1
+        elapsed = time.perf_counter() - start
+        print(f"level {level} {name:6}  {count / elapsed:7.1f} matches/s  "
+              f"{elapsed / count * 1000:6.2f} ms  "
+              f"score {result['score']:.3f} at {result['x']},{result['y']}")
@@ -0,0 +1,149 @@
+"""Measures CPU time and disk space per hour of timelapse
+
+Without a device, simulates a 1080p source (a screen with text and some
+gradients) and times the work done per frame by each capture path:
+
+* passthrough: the card's MJPEG bytes are written as they are (v4l2
+  backend, inp_fmt jpg)
+* yuyv: YUYV converted to BGR and encoded as JPEG (v4l2 backend, inp_fmt
+  png)
+* mjpeg decode: MJPEG decoded and re-encoded (cv2 backend)
+
+It then extrapolates to an hour at the given interval. With --device, it
+runs a real timelapse for --seconds instead, and reports the capture
+thread's CPU time and the bytes written. Run from the repository root:
+
+    python tools/bench_timelapse.py --interval 5
+    python tools/bench_timelapse.py --device /dev/video0 --backend v4l2 \\
+        --interval 2 --seconds 60
+
+Kernel time spent receiving frames over USB is not included: it depends
+on the frame rate the device sends (TIMELAPSE_CAPTURE_FPS), and stops
+altogether while streaming is paused (passthrough, intervals of 2 s or
+more). Compare with `top` on the Pi, where recording_start (ffmpeg,
+H.264 at full frame rate) takes most of a core.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "../src/pi_stream/hardware"))
+from timelapse import MjpegAviWriter, Timelapse  # noqa: E402
+from fast_screenshot_reader import video_capture  # noqa: E402
+
+WIDTH = 1920
+HEIGHT = 1080
+
+
+def screen(i: int) -> np.ndarray:
+    """Gets a synthetic desktop-like BGR frame"""
+    image = np.empty((HEIGHT, WIDTH, 3), np.uint8)
+    image[:] = np.linspace(40, 90, WIDTH, dtype=np.uint8)[None, :, None]
+    cv2.rectangle(image, (200, 150), (1700, 950), (235, 235, 235), -1)
+    for row in range(40):
+        cv2.putText(image, f"line {row} of frame {i}: lorem ipsum dolor",
+                    (230, 190 + row * 19), cv2.FONT_HERSHEY_SIMPLEX, 0.55,
+                    (30, 30, 30), 1)
+    return image
+
+
+def per_frame(function, frames: int) -> float:
+    """Gets the CPU seconds per call of function(i)"""
+    function(0)  # (warm up)
+    start = time.process_time()
+    for i in range(frames):
+        function(i)
+    return (time.process_time() - start) / frames
+
+
+def simulate(args):
+    bgr = [screen(i) for i in range(4)]
+    mjpeg = [cv2.imencode(".jpg", image)[1].tobytes() for image in bgr]
+    yuyv = [cv2.cvtColor(image, cv2.COLOR_BGR2YUV_YUYV) for image in bgr]
+    params = [cv2.IMWRITE_JPEG_QUALITY, args.quality]
+    frames_per_hour = 3600 / args.interval
+
+    with tempfile.TemporaryDirectory() as directory:
+        writer = MjpegAviWriter(f"{directory}/bench.avi", WIDTH, HEIGHT, 10)
+        paths = {
+            "passthrough": lambda i: writer.write(mjpeg[i % 4]),
+            "yuyv": lambda i: writer.write(cv2.imencode(
+                ".jpg", cv2.cvtColor(yuyv[i % 4], cv2.COLOR_YUV2BGR_YUYV),
+                params)[1]),
+            "mjpeg decode": lambda i: writer.write(cv2.imencode(
+                ".jpg", cv2.imdecode(np.frombuffer(mjpeg[i % 4], np.uint8),
+                                     cv2.IMREAD_COLOR), params)[1])
+        }
+        sizes = {
+            "passthrough": np.mean([len(data) for data in mjpeg]),
+            "yuyv": np.mean([len(cv2.imencode(".jpg", image, params)[1])
+                             for image in bgr]),
+        }
+        sizes["mjpeg decode"] = sizes["yuyv"]
+
+        print(f"{WIDTH}x{HEIGHT}, one frame every {args.interval} s "
+              f"({frames_per_hour:.0f} frames/hour)")
+        for name, function in paths.items():
+            seconds = per_frame(function, args.frames)
+            print(f"{name:14s} {seconds * 1000:7.2f} ms/frame  "
+                  f"{seconds * frames_per_hour:7.2f} CPU s/hour  "
+                  f"{seconds / args.interval * 100:6.3f} % of a core  "
+                  f"{sizes[name] * frames_per_hour / 2 ** 20:6.0f} MB/hour")
+        writer.close()
+
+
+def measure(args):
+    cam = video_capture(args.backend)
+    cam.open(args.device)
+    cam.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(
+        *("MJPG" if args.inp_fmt == "jpg" else "YUYV")))
+    cam.set(cv2.CAP_PROP_FRAME_WIDTH, WIDTH)
+    cam.set(cv2.CAP_PROP_FRAME_HEIGHT, HEIGHT)
+    cam.set(cv2.CAP_PROP_FPS, args.capture_fps)
+    if not cam.isOpened():
+        sys.exit(f"could not open {args.device}")
+
+    directory = tempfile.mkdtemp()
+    capture = Timelapse(cam, f"{directory}/bench.avi", args.interval,
+                        args.seconds, quality=args.quality)
+    capture.start()
+    capture.join()
+    stats = capture.stats()
+    shutil.rmtree(directory)
+
+    scale = 3600 / stats["elapsed"]
+    print(f"{args.backend} {args.inp_fmt}, passthrough "
+          f"{stats['passthrough']}: {stats['frames']} frames "
+          f"({stats['skipped']} skipped) in {stats['elapsed']:.0f} s")
+    print(f"{stats['cpu_time'] * scale:.1f} CPU s/hour "
+          f"({stats['cpu_fraction'] * 100:.3f} % of a core), "
+          f"{stats['size'] * scale / 2 ** 20:.0f} MB/hour")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--interval", type=float, default=5.0,
+                        help="seconds between frames")
+    parser.add_argument("--quality", type=int, default=90,
+                        help="JPEG quality of encoded frames")
+    parser.add_argument("--frames", type=int, default=50,
+                        help="frames timed per path (simulation)")
+    parser.add_argument("--device", help="capture device (default: "
+                        "simulate)")
+    parser.add_argument("--backend", default="v4l2", help="cv2 or v4l2")
+    parser.add_argument("--inp-fmt", default="jpg", help="jpg or png")
+    parser.add_argument("--capture-fps", type=int, default=5)
+    parser.add_argument("--seconds", type=float, default=60.0)
+    args = parser.parse_args()
+    if args.device:
+        measure(args)
+    else:
+        simulate(args)
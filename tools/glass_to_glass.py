@@ -0,0 +1,108 @@
+"""Measures glass-to-glass latency: run on the machine whose HDMI output
+is captured by the Pi
+
+Shows a timecode (this machine's clock, ms) full screen, reads it back
+through the API's /fast_screenshot, and compares it with the clock when
+the response arrives. No clock synchronization is needed since both
+times come from this machine. The result includes this machine's display
+latency, capture, encoding, and the network both ways. The API's
+X-Age-Ms header gives the part from capture to send.
+
+    python tools/glass_to_glass.py http://raspberrypi:8000 --samples 100
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "../src/pi_stream/hardware"))
+import timecode  # noqa: E402
+
+WINDOW = "timecode"
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000) % 2 ** timecode.BITS
+
+
+def post(url: str, body: dict = None):
+    data = json.dumps(body or {}).encode("utf-8")
+    request = urllib.request.Request(url, data=data, method="POST", headers={
+        "Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.load(response)
+
+
+def measure(api: str, samples: int, results: list, done: threading.Event):
+    """Reads the timecode back through the API"""
+    failures = 0
+    while len(results) < samples and failures < samples:
+        with urllib.request.urlopen(f"{api}/fast_screenshot",
+                                    timeout=10) as response:
+            data = response.read()
+            age = float(response.headers.get("X-Age-Ms", "nan"))
+        received = now_ms()
+        frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        value = timecode.decode(frame) if frame is not None else None
+        if value is None:
+            failures += 1
+            continue
+        results.append(((received - value) % 2 ** timecode.BITS, age))
+    done.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("api", help="API address, e.g. http://pi:8000")
+    parser.add_argument("--samples", type=int, default=100)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    args = parser.parse_args()
+    api = args.api.rstrip("/")
+
+    post(f"{api}/fast_screenshot/start", {
+        "inp_fmt": "jpg", "out_fmt": "jpg",
+        "width": args.width, "height": args.height})
+
+    cv2.namedWindow(WINDOW, cv2.WND_PROP_FULLSCREEN)
+    cv2.setWindowProperty(WINDOW, cv2.WND_PROP_FULLSCREEN,
+                          cv2.WINDOW_FULLSCREEN)
+
+    results = []
+    done = threading.Event()
+    threading.Thread(target=measure, args=(api, args.samples, results, done),
+                     daemon=True).start()
+    try:
+        while not done.is_set():
+            cv2.imshow(WINDOW, timecode.render(now_ms(), args.width,
+                                               args.height))
+            if cv2.waitKey(1) == 27:  # escape
+                break
+    finally:
+        cv2.destroyAllWindows()
+        post(f"{api}/fast_screenshot/stop")
+
+    if not results:
+        print("no timecodes read (is the window on the captured display?)")
+        return
+    latencies = sorted(latency for latency, _ in results)
+    ages = [age for _, age in results]
+    print(f"{len(results)} samples")
+    print(f"glass-to-glass: median {statistics.median(latencies):.0f} ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95)]:.0f} ms, "
+          f"min {latencies[0]:.0f} ms")
+    print(f"capture to API send (X-Age-Ms): median "
+          f"{statistics.median(ages):.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
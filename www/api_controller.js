@@ -63,3 +63,23 @@ document.addEventListener("DOMContentLoaded", () => {
         api_operations.appendChild(btn);
     });
 });
+
+
+// State transitions pushed over the WebSocket control channel
+document.addEventListener("DOMContentLoaded", () => {
+    const protocol = window.location.protocol === "https:" ? "wss:" : "ws:";
+    const ws = new WebSocket(`${protocol}//${window.location.host}/ws`);
+
+    ws.addEventListener("message", (message) => {
+        const data = JSON.parse(message.data);
+        if (data.event === "transition") {
+            console.log(`${data.source}: ${data.from} to ${data.to}`);
+        }
+        else if (data.id !== undefined) {
+            console.log(data);
+        }
+    });
+    ws.addEventListener("close", () => {
+        console.log("WebSocket control channel closed");
+    });
+});